@@ -0,0 +1,27 @@
+"""task cache hit count
+
+Revision ID: 20261016_0002
+Revises: 20260116_0001
+Create Date: 2026-10-16 00:02:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "20261016_0002"
+down_revision = "20260116_0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "tasks",
+        sa.Column("cache_hit_count", sa.Integer(), server_default=sa.text("0"), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("tasks", "cache_hit_count")
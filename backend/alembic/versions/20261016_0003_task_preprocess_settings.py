@@ -0,0 +1,25 @@
+"""task preprocess settings
+
+Revision ID: 20261016_0003
+Revises: 20261016_0002
+Create Date: 2026-10-16 00:03:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "20261016_0003"
+down_revision = "20261016_0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("tasks", sa.Column("preprocess_settings", postgresql.JSONB(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("tasks", "preprocess_settings")
@@ -0,0 +1,26 @@
+"""upload perceptual hash
+
+Revision ID: 20261016_0004
+Revises: 20261016_0003
+Create Date: 2026-10-16 00:04:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "20261016_0004"
+down_revision = "20261016_0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("uploads", sa.Column("phash", sa.String(length=16), nullable=True))
+    op.create_index("ix_uploads_phash", "uploads", ["phash"])
+
+
+def downgrade():
+    op.drop_index("ix_uploads_phash", table_name="uploads")
+    op.drop_column("uploads", "phash")
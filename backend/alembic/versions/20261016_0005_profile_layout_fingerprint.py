@@ -0,0 +1,25 @@
+"""profile layout fingerprint
+
+Revision ID: 20261016_0005
+Revises: 20261016_0004
+Create Date: 2026-10-16 00:05:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "20261016_0005"
+down_revision = "20261016_0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("prompt_profiles", sa.Column("layout_fingerprint", postgresql.JSONB(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("prompt_profiles", "layout_fingerprint")
@@ -0,0 +1,40 @@
+"""model responses
+
+Revision ID: 20261016_0006
+Revises: 20261016_0005
+Create Date: 2026-10-16 00:06:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "20261016_0006"
+down_revision = "20261016_0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "model_responses",
+        sa.Column("id", postgresql.UUID(as_uuid=True), primary_key=True),
+        sa.Column("task_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("upload_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("model", sa.String(length=255), nullable=True),
+        sa.Column("prompt_hash", sa.String(length=64), nullable=True),
+        sa.Column("prompt_tokens", sa.Integer(), server_default=sa.text("0"), nullable=False),
+        sa.Column("completion_tokens", sa.Integer(), server_default=sa.text("0"), nullable=False),
+        sa.Column("payload", sa.LargeBinary(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=False),
+        sa.ForeignKeyConstraint(["task_id"], ["tasks.id"]),
+        sa.ForeignKeyConstraint(["upload_id"], ["uploads.id"]),
+    )
+    op.create_index("ix_model_responses_task_upload", "model_responses", ["task_id", "upload_id"])
+
+
+def downgrade():
+    op.drop_index("ix_model_responses_task_upload", table_name="model_responses")
+    op.drop_table("model_responses")
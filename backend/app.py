@@ -8,8 +8,9 @@ import sys
 import uuid
 import asyncio
 import hashlib
-from typing import List, Optional
-from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
 from pathlib import Path
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Form
@@ -20,12 +21,28 @@ from pydantic import BaseModel
 # 添加父目录到路径，以便导入核心模块
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from ocr_processor import OCRProcessor, PromptProfile
-from table_processor import CSVParser
+from ocr_processor import OCRProcessor, PromptProfile, ProcessingStats
+from model_cascade import ModelCascade
+from table_processor import CSVParser, WIRE_FORMATS
 from excel_writer import ExcelWriter
 from llm_config import get_config, LLMConfig, LLMConfigManager, get_config_manager
+from result_cache import get_result_cache
+from image_preprocessor import PreprocessSettings, TileSettings, BatchSettings, DetailSettings
+from endpoint_health import HedgePolicy
+from key_pool import list_key_pools
+from local_ocr import LocalOCRSettings
+from table_layout import LayoutSettings, layout_fingerprint
+from page_quality import QualityGateSettings, PAGE_OK, PAGE_BLANK, assess_page
+from page_hash import (
+    MAX_CANDIDATES, MAX_CONFIRMATIONS, DedupSettings, HashIndex, ink_mask, ink_pixels, perceptual_hash, pixel_difference
+)
+from profile_router import ProfileRoutingSettings, ProfileIndex
+from response_store import (
+    RESPONSE_STORE_ENABLED, pack_responses, unpack_responses, summarize_responses, reparse_record
+)
 from db import get_db_session
 import models
+import http_client
 
 
 # ==================== 数据模型 ====================
@@ -45,6 +62,98 @@ class RuntimeLLMConfig(BaseModel):
     temperature: float = 0.01
     max_tokens: int = 4096
     timeout: int = 180
+    stream: bool = False
+    api_keys: List[str] = []  # 同一提供商的其他密钥，与 api_key 组成密钥池
+    rpm_limit: Optional[int] = None  # 每分钟请求数上限（覆盖提供商默认值）
+    tpm_limit: Optional[int] = None  # 每分钟token数上限（默认不限制）
+
+
+class PreprocessOptions(BaseModel):
+    """请求级别的图片预处理配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    max_long_edge: Optional[int] = None
+    grayscale: Optional[bool] = None
+    output_format: Optional[str] = None
+    quality: Optional[int] = None
+    fix_orientation: Optional[bool] = None
+
+
+class TilingOptions(BaseModel):
+    """请求级别的长图分条配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    max_band_aspect: Optional[float] = None
+    overlap: Optional[float] = None
+    max_bands: Optional[int] = None
+
+
+class BatchingOptions(BaseModel):
+    """请求级别的小图合并配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    max_images: Optional[int] = None
+    small_pixels: Optional[int] = None
+    max_total_pixels: Optional[int] = None
+
+
+class DetailOptions(BaseModel):
+    """请求级别的自适应图片精度配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    low_long_edge: Optional[int] = None
+    low_max_pixels: Optional[int] = None
+    low_max_columns: Optional[int] = None
+    low_max_ink: Optional[float] = None
+
+
+class LocalOCROptions(BaseModel):
+    """请求级别的本地OCR配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    lang: Optional[str] = None
+    min_confidence: Optional[float] = None
+    max_low_confidence_ratio: Optional[float] = None
+
+
+class LayoutOptions(BaseModel):
+    """请求级别的版面分析配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    gap_ink: Optional[float] = None
+    min_column_gap: Optional[float] = None
+    block_gap: Optional[float] = None
+    padding: Optional[float] = None
+
+
+class QualityGateOptions(BaseModel):
+    """请求级别的页面质量检查配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    blank_max_ink: Optional[float] = None
+    blank_max_stddev: Optional[float] = None
+    min_short_side: Optional[int] = None
+    min_sharpness: Optional[float] = None
+    skip_unreadable: Optional[bool] = None
+
+
+class DedupOptions(BaseModel):
+    """请求级别的重复页面检测配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    max_distance: Optional[int] = None
+    max_diff_pixels: Optional[int] = None
+    cross_task: Optional[bool] = None
+    lookback_days: Optional[int] = None
+    lookback_limit: Optional[int] = None
+
+
+class ProfileRoutingOptions(BaseModel):
+    """请求级别的画像自动选择配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    min_similarity: Optional[float] = None
+
+
+class HedgeOptions(BaseModel):
+    """请求级别的对冲请求配置，未指定的字段使用服务端默认值"""
+    enabled: Optional[bool] = None
+    percentile: Optional[float] = None
+    min_samples: Optional[int] = None
+    default_delay: Optional[float] = None
+    min_delay: Optional[float] = None
+    max_delay: Optional[float] = None
 
 
 class ProcessRequest(BaseModel):
@@ -53,6 +162,20 @@ class ProcessRequest(BaseModel):
     column_config: ColumnConfig
     prompt_profile_id: Optional[str] = None
     llm_config: Optional[RuntimeLLMConfig] = None
+    concurrency: Optional[int] = None  # 同时进行的识别请求数，默认 DEFAULT_TASK_CONCURRENCY
+    preprocess: Optional[PreprocessOptions] = None
+    tiling: Optional[TilingOptions] = None
+    batching: Optional[BatchingOptions] = None
+    cascade: Optional[List[RuntimeLLMConfig]] = None  # 模型级联（按顺序升级），指定时忽略 llm_config
+    hedge_llm_config: Optional[RuntimeLLMConfig] = None  # 备用模型：慢请求对冲、主接口熔断时接管
+    hedge: Optional[HedgeOptions] = None
+    wire_format: Optional[str] = None  # 画像识别的输出格式：csv / compact（省略列标题行、制表符分隔）
+    detail: Optional[DetailOptions] = None
+    local_ocr: Optional[LocalOCROptions] = None
+    layout: Optional[LayoutOptions] = None
+    quality_gate: Optional[QualityGateOptions] = None
+    dedup: Optional[DedupOptions] = None
+    profile_routing: Optional[ProfileRoutingOptions] = None
 
 
 class TaskStatus(BaseModel):
@@ -65,6 +188,31 @@ class TaskStatus(BaseModel):
     processed_files: int = 0
     success_count: int = 0
     fail_count: int = 0
+    cache_hit_count: int = 0  # 命中识别结果缓存（未调用API）的图片数
+    retry_count: int = 0  # 按重试策略执行的重试次数
+    tiled_page_count: int = 0  # 分条识别的页面数
+    batch_request_count: int = 0  # 多图合并请求次数
+    low_detail_page_count: int = 0  # 以低精度识别成功的页面数
+    detail_upgrade_count: int = 0  # 低精度校验失败后升级为高精度的页面数
+    local_ocr_page_count: int = 0  # 由本地OCR识别（未调用大模型）的页面数
+    layout_crop_count: int = 0  # 版面分析裁掉页边距/标题的页面数
+    layout_column_count: int = 0  # 版面分析检测到列边界的页面数
+    blank_page_count: int = 0  # 质量检查判定为空白页（已跳过，不计入失败）的页面数
+    unreadable_page_count: int = 0  # 质量检查判定为无法辨认的页面数
+    flagged_pages: Optional[List[dict]] = None  # 质量检查未通过的页面：[{file, status, reason, skipped}]
+    duplicate_page_count: int = 0  # 与本任务中前面页面重复而跳过的页面数
+    reused_page_count: int = 0  # 与历史任务页面重复、复用已有识别结果的页面数
+    duplicate_pages: Optional[List[dict]] = None  # 重复页面：[{file, duplicate_of, distance, reused}]
+    routed_page_count: int = 0  # 按版面指纹分配给其他画像（非指定/启用画像）的页面数
+    profile_routes: Optional[dict] = None  # 各画像处理的页面数：{画像ID: 页数}，默认画像为 "default"
+    prompt_tokens: int = 0  # 输入token总数
+    cached_prompt_tokens: int = 0  # 命中提供商提示词缓存的输入token数
+    completion_tokens: int = 0  # 输出token总数
+    truncation_count: int = 0  # 输出因 max_tokens 被截断（已续写补全）的次数
+    tier_stats: Optional[List[dict]] = None  # 模型级联各档的成功率与耗时
+    hedged_request_count: int = 0  # 发出的对冲请求数
+    hedge_win_count: int = 0  # 对冲请求先返回有效结果的次数
+    preprocess_settings: Optional[dict] = None  # 本任务使用的图片预处理配置
     message: Optional[str] = None
     output_file: Optional[str] = None
 
@@ -95,6 +243,10 @@ OUTPUT_DIR = Path("outputs")
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# 任务并发配置
+DEFAULT_TASK_CONCURRENCY = int(os.environ.get("TASK_CONCURRENCY", "4"))
+MAX_TASK_CONCURRENCY = int(os.environ.get("MAX_TASK_CONCURRENCY", "32"))
+
 
 # ==================== 辅助函数 ====================
 
@@ -130,17 +282,456 @@ def _get_active_profile(session) -> Optional[models.PromptProfile]:
     return None
 
 
+def _runtime_llm_config(runtime: RuntimeLLMConfig) -> LLMConfig:
+    """把请求中的模型配置转换为 LLMConfig，配置无效时返回400"""
+    config = LLMConfig(
+        provider=runtime.provider,
+        model=runtime.model,
+        api_key=runtime.api_key,
+        base_url=runtime.base_url,
+        temperature=runtime.temperature,
+        max_tokens=runtime.max_tokens,
+        timeout=runtime.timeout,
+        stream=runtime.stream,
+        api_keys=list(runtime.api_keys),
+        rpm_limit=runtime.rpm_limit,
+        tpm_limit=runtime.tpm_limit
+    )
+    is_valid, error_msg = config.validate()
+    if not is_valid:
+        raise HTTPException(status_code=400, detail=error_msg)
+    return config
+
+
+def _resolve_concurrency(concurrency: Optional[int]) -> int:
+    """解析任务并发数，未指定时使用默认值，并限制在 [1, MAX_TASK_CONCURRENCY]"""
+    if not concurrency:
+        concurrency = DEFAULT_TASK_CONCURRENCY
+    return max(1, min(int(concurrency), MAX_TASK_CONCURRENCY))
+
+
+def _save_extracted_table(task_id: str, image_path: Path, headers: List[str], rows: List[List[str]]):
+    """将识别结果写入数据库"""
+    with get_db_session() as session:
+        upload = session.query(models.UploadRecord).filter(
+            models.UploadRecord.task_id == uuid.UUID(task_id),
+            models.UploadRecord.file_path == str(image_path)
+        ).first()
+        if upload:
+            table = models.ExtractedTable(
+                task_id=uuid.UUID(task_id),
+                upload_id=upload.id,
+                headers=headers,
+                row_count=len(rows)
+            )
+            session.add(table)
+            session.flush()
+            row_records = [
+                models.ExtractedRow(
+                    table_id=table.id,
+                    row_index=row_index,
+                    row_data=row
+                )
+                for row_index, row in enumerate(rows, start=1)
+            ]
+            session.add_all(row_records)
+            session.commit()
+
+
+def _save_model_responses(task_id: str, image_path: Path, headers: List[str],
+                          output: Optional[str], responses: List[dict]):
+    """压缩保存单张图片的原始模型输出，供不调用大模型的重新解析使用"""
+    model, prompt_hash, prompt_tokens, completion_tokens = summarize_responses(responses)
+    with get_db_session() as session:
+        upload = session.query(models.UploadRecord).filter(
+            models.UploadRecord.task_id == uuid.UUID(task_id),
+            models.UploadRecord.file_path == str(image_path)
+        ).first()
+        if upload:
+            session.add(models.ModelResponse(
+                task_id=uuid.UUID(task_id),
+                upload_id=upload.id,
+                model=model,
+                prompt_hash=prompt_hash,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                payload=pack_responses(headers, output, responses)
+            ))
+            session.commit()
+
+
+def _handle_recognition_result(
+    task: TaskStatus,
+    task_id: str,
+    column_headers: List[str],
+    image_path: Path,
+    csv_text: Optional[str],
+    error: Optional[str]
+) -> Optional[List[List[str]]]:
+    """处理单张图片的识别结果：更新计数并写入数据库，成功时返回待写入Excel的数据行"""
+    if error:
+        task.fail_count += 1
+        print(f"[DEBUG] Failed (exception): {image_path.name} - {error} (total fail: {task.fail_count})")
+        return None
+
+    if not csv_text:
+        task.fail_count += 1
+        print(f"[DEBUG] Failed (no csv_text): {image_path.name} (total fail: {task.fail_count})")
+        return None
+
+    try:
+        headers, rows, parse_error = CSVParser.parse(csv_text)
+
+        if not parse_error and len(headers) == len(column_headers):
+            task.success_count += 1
+            _save_extracted_table(task_id, image_path, headers, rows)
+            print(f"[DEBUG] Success: {image_path.name} (total success: {task.success_count})")
+            return rows
+
+        task.fail_count += 1
+        print(f"[DEBUG] Failed (parse error or column mismatch): {image_path.name} (total fail: {task.fail_count})")
+    except Exception as e:
+        task.fail_count += 1
+        print(f"[DEBUG] Failed (exception): {image_path.name} - {str(e)} (total fail: {task.fail_count})")
+    return None
+
+
+def _load_page_hashes(task_id: str, image_files: List[Path]) -> List[Optional[str]]:
+    """读取上传时计算的感知哈希；旧记录或缺失时现场计算"""
+    with get_db_session() as session:
+        stored = dict(session.query(models.UploadRecord.file_path, models.UploadRecord.phash).filter(
+            models.UploadRecord.task_id == uuid.UUID(task_id)
+        ).all())
+    hashes = []
+    for image_path in image_files:
+        phash = stored.get(str(image_path))
+        if not phash:
+            with open(image_path, "rb") as f:
+                phash = perceptual_hash(f.read())
+        hashes.append(phash)
+    return hashes
+
+
+def _prior_extraction_index(task_id: str, column_headers: List[str], dedup: DedupSettings) -> HashIndex:
+    """
+    历史任务中列标题相同的识别结果索引（感知哈希 -> (ExtractedTable.id, 图片路径)），较新的结果优先
+
+    只加载最近 lookback_days 天内、最多 lookback_limit 条结果，避免任务启动时间随历史数据增长
+    """
+    index = HashIndex(dedup.max_distance)
+    with get_db_session() as session:
+        query = session.query(
+            models.UploadRecord.phash, models.UploadRecord.file_path, models.ExtractedTable.id
+        ).join(
+            models.ExtractedTable, models.ExtractedTable.upload_id == models.UploadRecord.id
+        ).filter(
+            models.UploadRecord.task_id != uuid.UUID(task_id),
+            models.UploadRecord.phash.isnot(None),
+            models.ExtractedTable.headers == list(column_headers)
+        )
+        if dedup.lookback_days > 0:
+            query = query.filter(
+                models.ExtractedTable.created_at >= datetime.now() - timedelta(days=dedup.lookback_days)
+            )
+        query = query.order_by(models.ExtractedTable.created_at.desc())
+        if dedup.lookback_limit > 0:
+            query = query.limit(dedup.lookback_limit)
+        records = query.all()
+    for phash, file_path, table_id in records:
+        index.add(phash, (table_id, file_path))
+    return index
+
+
+def _load_ink_mask(image_path: Path):
+    """读取图片的墨迹掩码用于逐像素确认重复页面；文件已删除或无法读取时返回None"""
+    try:
+        with open(image_path, "rb") as f:
+            return ink_mask(f.read())
+    except OSError:
+        return None
+
+
+def _load_extracted_rows(table_id: uuid.UUID) -> List[List[str]]:
+    with get_db_session() as session:
+        records = session.query(models.ExtractedRow.row_data).filter(
+            models.ExtractedRow.table_id == table_id
+        ).order_by(models.ExtractedRow.row_index).all()
+    return [list(row_data) for (row_data,) in records]
+
+
+async def _resolve_duplicates(
+    task: TaskStatus,
+    task_id: str,
+    column_headers: List[str],
+    image_files: List[Path],
+    resolved: dict,
+    dedup: DedupSettings
+):
+    """
+    找出重复页面并写入 resolved（下标 -> 数据行）
+
+    感知哈希只用来找出候选页面，逐像素比较墨迹差异不超过 max_diff_pixels 才视为重复
+    （同一印刷表格的不同填写件感知哈希几乎相同）。
+    与本任务前面页面重复的页面跳过（不重复写入Excel）；启用 cross_task 时与历史任务页面重复的页面
+    复用其识别结果，按成功计数并写入本任务。已被质量检查跳过的页面不参与比对。
+    """
+    hashes = await asyncio.to_thread(_load_page_hashes, task_id, image_files)
+    prior_index = None
+    if dedup.cross_task:
+        prior_index = await asyncio.to_thread(_prior_extraction_index, task_id, column_headers, dedup)
+
+    masks = {}
+
+    async def mask_of(image_path: Path):
+        key = str(image_path)
+        if key not in masks:
+            mask = await asyncio.to_thread(_load_ink_mask, image_path)
+            masks[key] = (mask, ink_pixels(mask)) if mask is not None else None
+        return masks[key]
+
+    async def confirm(image_path: Path, candidates: list) -> Optional[tuple]:
+        """
+        逐像素确认候选页面 [(项, 感知哈希距离, 图片路径)]
+
+        取哈希距离最近的 MAX_CANDIDATES 个，按哈希距离、墨迹像素数之差排序后最多比较 MAX_CONFIRMATIONS 个，
+        返回第一个差异像素数不超过 max_diff_pixels 的 (项, 距离, 差异像素数)，没有时返回None。
+        """
+        if not candidates:
+            return None
+        current = await mask_of(image_path)
+        if current is None:
+            return None
+        ranked = []
+        for item, distance, candidate_path in candidates[:MAX_CANDIDATES]:
+            candidate = await mask_of(candidate_path)
+            if candidate is not None:
+                ranked.append((distance, abs(candidate[1] - current[1]), item, candidate[0]))
+        ranked.sort(key=lambda entry: entry[:2])
+        for distance, _, item, candidate_mask in ranked[:MAX_CONFIRMATIONS]:
+            diff = await asyncio.to_thread(pixel_difference, current[0], candidate_mask)
+            if diff <= dedup.max_diff_pixels:
+                return item, distance, diff
+        return None
+
+    task_index = HashIndex(dedup.max_distance)
+    duplicate_pages = []
+    for idx, (image_path, phash) in enumerate(zip(image_files, hashes)):
+        if idx in resolved or not phash:
+            continue
+
+        match = await confirm(image_path, [
+            (original, distance, image_files[original]) for original, distance in task_index.candidates(phash)
+        ])
+        if match:
+            original, distance, diff = match
+            resolved[idx] = None
+            task.duplicate_page_count += 1
+            duplicate_pages.append({
+                "file": image_path.name,
+                "duplicate_of": image_files[original].name,
+                "distance": distance,
+                "diff_pixels": diff,
+                "reused": False
+            })
+            print(f"[DEDUP] {image_path.name}: 与 {image_files[original].name} 重复（距离{distance}，差异{diff}像素），跳过")
+            continue
+        task_index.add(phash, idx)
+
+        if prior_index is None:
+            continue
+        match = await confirm(image_path, [
+            (table_id, distance, Path(file_path)) for (table_id, file_path), distance in prior_index.candidates(phash)
+        ])
+        if not match:
+            continue
+        table_id, distance, diff = match
+        rows = await asyncio.to_thread(_load_extracted_rows, table_id)
+        if not rows:
+            continue
+        await asyncio.to_thread(_save_extracted_table, task_id, image_path, column_headers, rows)
+        resolved[idx] = rows
+        task.success_count += 1
+        task.reused_page_count += 1
+        duplicate_pages.append({
+            "file": image_path.name,
+            "duplicate_of": str(table_id),
+            "distance": distance,
+            "diff_pixels": diff,
+            "reused": True
+        })
+        print(f"[DEDUP] {image_path.name}: 与历史识别结果 {table_id} 重复（距离{distance}，差异{diff}像素），复用")
+    task.duplicate_pages = duplicate_pages or None
+
+
+def _backfill_profile_fingerprints() -> int:
+    """
+    为缺少版面指纹的画像按 source_image_hash 找回试运行图片并计算指纹（早于该功能创建的画像）
+
+    只在服务启动时执行一次；新建的画像在创建时计算指纹。返回补全的画像数
+    """
+    trial_dir = UPLOAD_DIR / "trial"
+    if not trial_dir.exists():
+        return 0
+
+    filled = 0
+    with get_db_session() as session:
+        missing = {}
+        for db_profile in session.query(models.PromptProfile).filter(
+            models.PromptProfile.layout_fingerprint.is_(None),
+            models.PromptProfile.source_image_hash.isnot(None)
+        ):
+            missing.setdefault(db_profile.source_image_hash, []).append(db_profile)
+        if not missing:
+            return 0
+
+        for image_path in get_image_files(trial_dir):
+            with open(image_path, "rb") as f:
+                content = f.read()
+            matched = missing.pop(_hash_bytes(content), None)
+            if not matched:
+                continue
+            fingerprint = layout_fingerprint(content)
+            for db_profile in matched:
+                db_profile.layout_fingerprint = fingerprint
+            filled += len(matched)
+            if not missing:
+                break
+        session.commit()
+    return filled
+
+
+def _load_profile_index(min_similarity: float) -> Tuple[ProfileIndex, Dict[str, PromptProfile]]:
+    """读取所有有版面指纹的画像，最近使用的画像先加入索引（同一版式的多个版本中优先）"""
+    index = ProfileIndex(min_similarity)
+    profiles = {}
+    with get_db_session() as session:
+        db_profiles = session.query(models.PromptProfile).order_by(
+            models.PromptProfile.last_used_at.desc().nullslast(),
+            models.PromptProfile.created_at.desc()
+        ).all()
+        for db_profile in db_profiles:
+            if db_profile.layout_fingerprint:
+                profile_id = str(db_profile.id)
+                index.add(profile_id, db_profile.layout_fingerprint)
+                profiles[profile_id] = _profile_from_model(db_profile)
+    return index, profiles
+
+
+def _page_fingerprint(image_path: Path) -> Optional[List[float]]:
+    with open(image_path, "rb") as f:
+        return layout_fingerprint(f.read())
+
+
+async def _route_pages(
+    task: TaskStatus,
+    image_files: List[Path],
+    indexes: List[int],
+    default_profile_id: Optional[str],
+    routing: ProfileRoutingSettings
+) -> Tuple[Dict[int, str], Dict[str, PromptProfile]]:
+    """
+    按版面指纹为页面选择画像
+
+    默认画像（指定或启用的画像）相似度达标时保持不变；否则使用相似度最高且达标的其他画像，都不达标时仍用默认画像。
+
+    返回: (下标 -> 画像ID，仅含分配给其他画像的页面；画像ID -> PromptProfile)
+    """
+    index, profiles = await asyncio.to_thread(_load_profile_index, routing.min_similarity)
+    if not len(index):
+        print("[WARN] 没有带版面指纹的画像，跳过画像自动选择")
+        return {}, {}
+
+    fingerprints = await asyncio.gather(*[
+        asyncio.to_thread(_page_fingerprint, image_files[idx]) for idx in indexes
+    ])
+    page_profiles = {}
+    routes = {}
+    for idx, fingerprint in zip(indexes, fingerprints):
+        match = index.route(fingerprint, default_profile_id) if fingerprint else None
+        profile_id = match[0] if match else None
+        if profile_id == default_profile_id:
+            profile_id = None
+        if profile_id:
+            page_profiles[idx] = profile_id
+            print(f"[ROUTE] {image_files[idx].name}: 画像 {profile_id}（相似度{match[1]:.2f}）")
+        key = profile_id or "default"
+        routes[key] = routes.get(key, 0) + 1
+
+    used = set(page_profiles.values())
+    if used:
+        with get_db_session() as session:
+            for profile_id in used:
+                db_profile = session.get(models.PromptProfile, uuid.UUID(profile_id))
+                if db_profile:
+                    db_profile.last_used_at = datetime.now()
+            session.commit()
+
+    task.routed_page_count = len(page_profiles)
+    task.profile_routes = routes
+    return page_profiles, {profile_id: profiles[profile_id] for profile_id in used}
+
+
+@dataclass
+class TaskSettings:
+    """处理任务的模型与各项功能配置，未指定的功能使用服务端默认值（环境变量）"""
+    llm_config: Optional[LLMConfig] = None  # 为None时使用当前保存的配置
+    concurrency: Optional[int] = None
+    cascade: Optional[List[LLMConfig]] = None  # 模型级联，指定时忽略 llm_config
+    hedge_config: Optional[LLMConfig] = None  # 备用模型
+    hedge_policy: Optional[HedgePolicy] = None
+    wire_format: Optional[str] = None
+    preprocess: PreprocessSettings = field(default_factory=PreprocessSettings)
+    tiling: TileSettings = field(default_factory=TileSettings)
+    batching: BatchSettings = field(default_factory=BatchSettings)
+    detail: DetailSettings = field(default_factory=DetailSettings)
+    local_ocr: LocalOCRSettings = field(default_factory=LocalOCRSettings)
+    layout: LayoutSettings = field(default_factory=LayoutSettings)
+    quality_gate: QualityGateSettings = field(default_factory=QualityGateSettings)
+    dedup: DedupSettings = field(default_factory=DedupSettings)
+    routing: ProfileRoutingSettings = field(default_factory=ProfileRoutingSettings)
+
+    @classmethod
+    def from_request(cls, request: ProcessRequest) -> "TaskSettings":
+        """按处理请求生成配置，请求中未指定的字段使用服务端默认值"""
+        def options(value: Optional[BaseModel]) -> dict:
+            return value.model_dump(exclude_none=True) if value else {}
+
+        settings = cls(
+            llm_config=_runtime_llm_config(request.llm_config) if request.llm_config else None,
+            concurrency=request.concurrency,
+            cascade=[_runtime_llm_config(tier) for tier in request.cascade] if request.cascade else None,
+            wire_format=request.wire_format,
+            preprocess=PreprocessSettings.from_dict(options(request.preprocess)),
+            tiling=TileSettings.from_dict(options(request.tiling)),
+            batching=BatchSettings.from_dict(options(request.batching)),
+            detail=DetailSettings.from_dict(options(request.detail)),
+            local_ocr=LocalOCRSettings.from_dict(options(request.local_ocr)),
+            layout=LayoutSettings.from_dict(options(request.layout)),
+            quality_gate=QualityGateSettings.from_dict(options(request.quality_gate)),
+            dedup=DedupSettings.from_dict(options(request.dedup)),
+            routing=ProfileRoutingSettings.from_dict(options(request.profile_routing)),
+        )
+        # 指定了备用模型即启用对冲，可用 hedge.enabled=false 只做熔断接管
+        if request.hedge_llm_config:
+            settings.hedge_config = _runtime_llm_config(request.hedge_llm_config)
+            settings.hedge_policy = HedgePolicy.from_dict({"enabled": True, **options(request.hedge)})
+        return settings
+
+
 async def process_task(
     task_id: str,
     column_headers: List[str],
     prompt_profile_id: Optional[str] = None,
-    llm_config: Optional[LLMConfig] = None
+    settings: Optional[TaskSettings] = None
 ):
-    """后台处理任务"""
+    """后台处理任务（按并发数同时识别多张图片）"""
     try:
         task = tasks[task_id]
         task.status = "processing"
 
+        settings = settings or TaskSettings()
+        task.preprocess_settings = settings.preprocess.to_dict()
+
         db_profile = None
         prompt_profile = None
         with get_db_session() as session:
@@ -157,12 +748,37 @@ async def process_task(
             if db_task:
                 db_task.status = "processing"
                 db_task.profile_id = db_profile.id if db_profile else None
+                db_task.preprocess_settings = task.preprocess_settings
 
             session.commit()
 
         # 初始化计数器（确保从0开始）
         task.success_count = 0
         task.fail_count = 0
+        task.cache_hit_count = 0
+        task.retry_count = 0
+        task.tiled_page_count = 0
+        task.batch_request_count = 0
+        task.low_detail_page_count = 0
+        task.detail_upgrade_count = 0
+        task.local_ocr_page_count = 0
+        task.layout_crop_count = 0
+        task.layout_column_count = 0
+        task.blank_page_count = 0
+        task.unreadable_page_count = 0
+        task.flagged_pages = None
+        task.duplicate_page_count = 0
+        task.reused_page_count = 0
+        task.duplicate_pages = None
+        task.routed_page_count = 0
+        task.profile_routes = None
+        task.prompt_tokens = 0
+        task.cached_prompt_tokens = 0
+        task.completion_tokens = 0
+        task.truncation_count = 0
+        task.tier_stats = None
+        task.hedged_request_count = 0
+        task.hedge_win_count = 0
         task.processed_files = 0
         print(f"[DEBUG] Initialized counters: success={task.success_count}, fail={task.fail_count}")
 
@@ -192,80 +808,205 @@ async def process_task(
         excel_writer = ExcelWriter(str(output_path), column_headers)
 
         # 创建OCR处理器（使用配置管理器）
-        ocr_processor = OCRProcessor(llm_config or get_config())
-
-        # 处理每张图片
-        for idx, image_path in enumerate(image_files):
-            task.current_file = image_path.name
-            task.progress = int((idx / len(image_files)) * 100)
-            print(f"[DEBUG] Processing {idx+1}/{len(image_files)}: {image_path.name}")
-
-            try:
-                if prompt_profile:
-                    csv_text = ocr_processor.process_image_with_profile(
-                        str(image_path),
-                        prompt_profile,
-                        max_retries=3
-                    )
-                else:
-                    csv_text = ocr_processor.process_image_with_headers(
-                        str(image_path),
-                        column_headers,
-                        max_retries=3
-                    )
-
-                if csv_text:
-                    headers, rows, parse_error = CSVParser.parse(csv_text)
-
-                    if not parse_error and len(headers) == len(column_headers):
-                        excel_writer.add_data(rows, image_path.name)
-                        task.success_count += 1
-                        with get_db_session() as session:
-                            upload = session.query(models.UploadRecord).filter(
-                                models.UploadRecord.task_id == uuid.UUID(task_id),
-                                models.UploadRecord.file_path == str(image_path)
-                            ).first()
-                            if upload:
-                                table = models.ExtractedTable(
-                                    task_id=uuid.UUID(task_id),
-                                    upload_id=upload.id,
-                                    headers=headers,
-                                    row_count=len(rows)
-                                )
-                                session.add(table)
-                                session.flush()
-                                row_records = [
-                                    models.ExtractedRow(
-                                        table_id=table.id,
-                                        row_index=row_index,
-                                        row_data=row
-                                    )
-                                    for row_index, row in enumerate(rows, start=1)
-                                ]
-                                session.add_all(row_records)
-                                session.commit()
-                        print(f"[DEBUG] Success: {image_path.name} (total success: {task.success_count})")
-                    else:
-                        task.fail_count += 1
-                        print(f"[DEBUG] Failed (parse error or column mismatch): {image_path.name} (total fail: {task.fail_count})")
-                else:
-                    task.fail_count += 1
-                    print(f"[DEBUG] Failed (no csv_text): {image_path.name} (total fail: {task.fail_count})")
+        def create_processor(config: LLMConfig, hedge_to: Optional[OCRProcessor] = None,
+                             local: Optional[LocalOCRSettings] = None) -> OCRProcessor:
+            return OCRProcessor(
+                config,
+                result_cache=get_result_cache(),
+                preprocess=settings.preprocess,
+                tiling=settings.tiling,
+                batching=settings.batching,
+                hedge_to=hedge_to,
+                hedge_policy=settings.hedge_policy,
+                wire_format=settings.wire_format,
+                detail=settings.detail,
+                layout=settings.layout,
+                local_ocr=local or LocalOCRSettings(enabled=False)
+            )
 
-            except Exception as e:
-                task.fail_count += 1
-                print(f"[DEBUG] Failed (exception): {image_path.name} - {str(e)} (total fail: {task.fail_count})")
+        hedge_config = settings.hedge_config
+        backup_processor = create_processor(hedge_config) if hedge_config else None
+
+        cascade = settings.cascade
+        if cascade:
+            # 本地OCR只在第一档尝试，升级到后续档位时不再重复
+            ocr_processor = ModelCascade([
+                create_processor(config, backup_processor, settings.local_ocr if tier == 0 else None)
+                for tier, config in enumerate(cascade)
+            ])
+            print(f"[DEBUG] Cascade: {' -> '.join(config.model for config in cascade)}")
+        else:
+            ocr_processor = create_processor(settings.llm_config or get_config(), backup_processor,
+                                             settings.local_ocr)
+
+        def processing_stats() -> ProcessingStats:
+            """任务的合计统计：熔断转发与对冲发往备用模型的调用记在备用处理器上，一并计入"""
+            if backup_processor is None:
+                return ocr_processor.stats
+            return ProcessingStats.combine([ocr_processor.stats, backup_processor.stats])
+
+        concurrency = _resolve_concurrency(settings.concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        print(f"[DEBUG] Concurrency: {concurrency}")
+
+        # 调用大模型前先在本地检查页面质量：空白页直接跳过，无法辨认的页面按配置跳过或仅标记
+        quality_gate = settings.quality_gate
+        qualities = await asyncio.gather(*[
+            asyncio.to_thread(assess_page, str(image_path), quality_gate) for image_path in image_files
+        ])
+        # 不调用大模型即可确定结果的页面：下标 -> 数据行（None表示不写入Excel）
+        resolved = {}
+        flagged_pages = []
+        for idx, (image_path, quality) in enumerate(zip(image_files, qualities)):
+            if quality.status == PAGE_OK:
+                continue
+            skip = quality.status == PAGE_BLANK or quality_gate.skip_unreadable
+            if quality.status == PAGE_BLANK:
+                task.blank_page_count += 1
+            else:
+                task.unreadable_page_count += 1
+            if skip:
+                resolved[idx] = None
+            flagged_pages.append({
+                "file": image_path.name,
+                "status": quality.status,
+                "reason": quality.reason,
+                "skipped": skip
+            })
+            print(f"[QUALITY] {image_path.name}: {quality.status} - {quality.reason}{'，跳过' if skip else ''}")
+        task.flagged_pages = flagged_pages or None
+
+        # 重复页面：与本任务前面页面重复的直接跳过，与历史任务页面重复的复用已有识别结果
+        dedup = settings.dedup
+        if dedup.enabled:
+            await _resolve_duplicates(task, task_id, column_headers, image_files, resolved, dedup)
+
+        remaining = [idx for idx in range(len(image_files)) if idx not in resolved]
+
+        # 画像自动选择：按版面指纹把页面分配给最相近的画像，未匹配的页面使用指定/启用的画像
+        routing = settings.routing
+        page_profiles = {}  # 下标 -> 画像ID（仅分配给其他画像的页面）
+        routed_profiles = {}  # 画像ID -> PromptProfile
+        if routing.enabled:
+            page_profiles, routed_profiles = await _route_pages(
+                task, image_files, remaining, str(db_profile.id) if db_profile else None, routing
+            )
 
-            task.processed_files = idx + 1
-            print(f"[DEBUG] After processing {image_path.name}: success={task.success_count}, fail={task.fail_count}, processed={task.processed_files}")
-            await asyncio.sleep(0.5)  # 限流
+        # 列标题与默认一致的画像写入同一工作表，不一致的各自写入单独的工作表
+        page_headers = {}  # 画像ID -> 列标题
+        page_sheets = {}  # 画像ID -> 工作表标识（None 为默认工作表）
+        for profile_id, routed in routed_profiles.items():
+            page_headers[profile_id] = routed.headers
+            if routed.headers == column_headers:
+                page_sheets[profile_id] = None
+            else:
+                page_sheets[profile_id] = profile_id
+                excel_writer.add_sheet(profile_id, f"画像{profile_id[:8]}", routed.headers)
+
+        # 启用小图合并时，相邻的小图分为一组在同一个请求中识别；否则每张图片单独成组
+        # 分组按画像分别在剩余页面上进行，组内下标再换算回 image_files 中的下标
+        groups = []
+        for profile_id in [None] + list(routed_profiles):
+            members = [idx for idx in remaining if page_profiles.get(idx) == profile_id]
+            if not members:
+                continue
+            planned = await ocr_processor.async_plan_batches([str(image_files[idx]) for idx in members])
+            groups.extend((profile_id, [members[pos] for pos in group]) for group in planned)
+        if len(groups) < len(remaining):
+            print(f"[DEBUG] Batching: {len(remaining)} images in {len(groups)} groups")
+
+        async def recognize(profile_id: Optional[str], group: List[int]):
+            """在并发槽位内识别一组图片，返回 [(idx, image_path, csv_text, error, responses), ...]"""
+            async with semaphore:
+                paths = [image_files[idx] for idx in group]
+                responses = [[] for _ in paths]
+                task.current_file = paths[0].name
+                print(f"[DEBUG] Processing {group[0]+1}/{len(image_files)}: {', '.join(p.name for p in paths)}")
+                profile = routed_profiles[profile_id] if profile_id else prompt_profile
+                try:
+                    if profile:
+                        csv_texts = await ocr_processor.async_process_batch_with_profile(
+                            [str(p) for p in paths],
+                            profile,
+                            max_retries=3,
+                            responses=responses
+                        )
+                    else:
+                        csv_texts = await ocr_processor.async_process_batch_with_headers(
+                            [str(p) for p in paths],
+                            column_headers,
+                            max_retries=3,
+                            responses=responses
+                        )
+                    return [(idx, p, csv_text, None, log)
+                            for idx, p, csv_text, log in zip(group, paths, csv_texts, responses)]
+                except Exception as e:
+                    return [(idx, p, None, str(e), log) for idx, p, log in zip(group, paths, responses)]
+
+        # 识别结果可能乱序返回：计数与入库即时进行，Excel按原始顺序缓冲写入，保证输出顺序不变
+        pending_rows = {idx: (image_files[idx], rows, None) for idx, rows in resolved.items()}
+        next_index = 0
+
+        def flush_rows():
+            nonlocal next_index
+            while next_index in pending_rows:
+                ordered_path, ordered_rows, sheet = pending_rows.pop(next_index)
+                if ordered_rows is not None:
+                    excel_writer.add_data(ordered_rows, ordered_path.name, sheet=sheet)
+                next_index += 1
+
+        flush_rows()
+        task.processed_files = len(resolved)
+        for future in asyncio.as_completed([recognize(profile_id, group) for profile_id, group in groups]):
+            for idx, image_path, csv_text, error, responses in await future:
+                profile_id = page_profiles.get(idx)
+                headers = page_headers.get(profile_id, column_headers)
+                # 入库为同步提交，放到线程中执行，避免阻塞其他进行中的请求（流式校验、对冲计时）
+                rows = await asyncio.to_thread(
+                    _handle_recognition_result, task, task_id, headers, image_path, csv_text, error
+                )
+                if RESPONSE_STORE_ENABLED and (csv_text or responses):
+                    await asyncio.to_thread(_save_model_responses, task_id, image_path, headers, csv_text, responses)
+                pending_rows[idx] = (image_path, rows, page_sheets.get(profile_id))
+                flush_rows()
+
+                task.processed_files += 1
+                print(f"[DEBUG] After processing {image_path.name}: success={task.success_count}, fail={task.fail_count}, processed={task.processed_files}")
+
+            stats = processing_stats()
+            task.cache_hit_count = stats.cache_hits
+            task.retry_count = stats.retries
+            task.tiled_page_count = stats.tiled_pages
+            task.batch_request_count = stats.batch_requests
+            task.low_detail_page_count = stats.low_detail_pages
+            task.detail_upgrade_count = stats.detail_upgrades
+            task.local_ocr_page_count = stats.local_pages
+            task.layout_crop_count = stats.layout_crops
+            task.layout_column_count = stats.layout_columns
+            task.prompt_tokens = stats.prompt_tokens
+            task.cached_prompt_tokens = stats.cached_prompt_tokens
+            task.completion_tokens = stats.completion_tokens
+            task.truncation_count = stats.truncations
+            task.hedged_request_count = stats.hedged_requests
+            task.hedge_win_count = stats.hedge_wins
+            if cascade:
+                task.tier_stats = ocr_processor.tier_stats()
+            task.progress = int((task.processed_files / len(image_files)) * 100)
 
         # Save Excel
         excel_writer.save()
         task.output_file = output_filename
         task.status = "completed"
         task.progress = 100
-        task.message = f"处理完成：成功{task.success_count}，失败{task.fail_count}"
+        task.message = f"处理完成：成功{task.success_count}，失败{task.fail_count}，缓存命中{task.cache_hit_count}"
+        if task.blank_page_count or task.unreadable_page_count:
+            task.message += f"，空白页{task.blank_page_count}，无法辨认{task.unreadable_page_count}"
+        if task.duplicate_page_count or task.reused_page_count:
+            task.message += f"，重复页{task.duplicate_page_count}，复用历史结果{task.reused_page_count}"
+        if task.routed_page_count:
+            task.message += f"，自动选择其他画像{task.routed_page_count}页"
+        if task.prompt_tokens:
+            task.message += f"，提示词缓存命中{task.cached_prompt_tokens}/{task.prompt_tokens} tokens"
         print(f"[DEBUG] Final: success={task.success_count}, fail={task.fail_count}, total={task.total_files}")
 
         with get_db_session() as session:
@@ -275,6 +1016,7 @@ async def process_task(
                 db_task.processed_files = task.processed_files
                 db_task.success_count = task.success_count
                 db_task.fail_count = task.fail_count
+                db_task.cache_hit_count = task.cache_hit_count
                 db_task.output_file = task.output_file
                 db_task.message = task.message
                 session.commit()
@@ -286,6 +1028,34 @@ async def process_task(
         print(f"[DEBUG] Outer exception: {str(e)}")
 
 
+# ==================== 生命周期 ====================
+
+@app.on_event("startup")
+async def prewarm_llm_connections():
+    """启动时预热到当前配置的大模型API的连接"""
+    try:
+        await http_client.prewarm([get_config().get_api_url()])
+    except Exception as e:
+        print(f"[WARN] 连接预热失败: {e}")
+
+
+@app.on_event("startup")
+async def backfill_profile_fingerprints():
+    """启动时为早于版面指纹功能创建的画像补全指纹"""
+    try:
+        filled = await asyncio.to_thread(_backfill_profile_fingerprints)
+        if filled:
+            print(f"[ROUTE] 已为{filled}个画像补全版面指纹")
+    except Exception as e:
+        print(f"[WARN] 画像版面指纹补全失败: {e}")
+
+
+@app.on_event("shutdown")
+async def close_llm_connections():
+    """关闭共享连接池"""
+    await http_client.close_async_client()
+
+
 # ==================== API 路由 ====================
 
 @app.get("/")
@@ -332,7 +1102,11 @@ async def upload_files(files: List[UploadFile] = File(...)):
             content = await file.read()
             f.write(content)
         uploaded_files.append(filename)
-        saved_files.append({"name": filename, "path": str(file_path)})
+        saved_files.append({
+            "name": filename,
+            "path": str(file_path),
+            "phash": await asyncio.to_thread(perceptual_hash, content)  # 用于检测重复页面
+        })
 
     with get_db_session() as session:
         db_task = models.TaskRecord(
@@ -348,7 +1122,8 @@ async def upload_files(files: List[UploadFile] = File(...)):
             models.UploadRecord(
                 task_id=db_task.id,
                 file_name=item["name"],
-                file_path=item["path"]
+                file_path=item["path"],
+                phash=item["phash"]
             )
             for item in saved_files
         ]
@@ -385,6 +1160,7 @@ async def run_trial(
     temperature: float = Form(0.01),
     max_tokens: int = Form(4096),
     timeout: int = Form(180),
+    stream: bool = Form(False),
     feedback_text: Optional[str] = Form(None),
     base_profile_id: Optional[str] = Form(None)
 ):
@@ -416,13 +1192,16 @@ async def run_trial(
             base_url=base_url,
             temperature=temperature,
             max_tokens=max_tokens,
-            timeout=timeout
+            timeout=timeout,
+            stream=stream
         )
         is_valid, error_msg = user_config.validate()
         if not is_valid:
             raise HTTPException(status_code=400, detail=error_msg)
 
     ocr_processor = OCRProcessor(user_config or get_config())
+    # 画像生成、优化和识别共用同一份预处理/编码结果
+    prepared_image = await ocr_processor.async_prepare_image(str(file_path))
 
     base_profile = None
     if base_profile_id:
@@ -438,23 +1217,23 @@ async def run_trial(
 
     if feedback_text and feedback_text.strip():
         if not base_profile:
-            base_profile = ocr_processor.generate_prompt_profile(str(file_path))
+            base_profile = await ocr_processor.async_generate_prompt_profile(prepared_image)
             if not base_profile:
                 raise HTTPException(status_code=500, detail="Trial profile generation failed")
-        prompt_profile = ocr_processor.refine_prompt_profile(
-            str(file_path),
+        prompt_profile = await ocr_processor.async_refine_prompt_profile(
+            prepared_image,
             base_profile,
             feedback_text
         )
         if not prompt_profile:
             raise HTTPException(status_code=500, detail="试运行画像优化失败")
     else:
-        prompt_profile = ocr_processor.generate_prompt_profile(str(file_path))
+        prompt_profile = await ocr_processor.async_generate_prompt_profile(prepared_image)
         if not prompt_profile:
             raise HTTPException(status_code=500, detail="Trial profile generation failed")
 
-    csv_text = ocr_processor.process_image_with_profile(
-        str(file_path),
+    csv_text = await ocr_processor.async_process_image_with_profile(
+        prepared_image,
         prompt_profile,
         max_retries=3
     )
@@ -475,6 +1254,7 @@ async def run_trial(
     with get_db_session() as session:
         db_profile = models.PromptProfile(
             source_image_hash=source_hash,
+            layout_fingerprint=layout_fingerprint(content),
             headers=prompt_profile.headers,
             column_count=prompt_profile.column_count,
             column_notes=prompt_profile.column_notes,
@@ -590,28 +1370,16 @@ async def start_process(request: ProcessRequest, background_tasks: BackgroundTas
     if task.status == "processing":
         raise HTTPException(status_code=400, detail="任务正在处理中")
 
-    # 添加后台任务
-    user_config = None
-    if request.llm_config:
-        user_config = LLMConfig(
-            provider=request.llm_config.provider,
-            model=request.llm_config.model,
-            api_key=request.llm_config.api_key,
-            base_url=request.llm_config.base_url,
-            temperature=request.llm_config.temperature,
-            max_tokens=request.llm_config.max_tokens,
-            timeout=request.llm_config.timeout
-        )
-        is_valid, error_msg = user_config.validate()
-        if not is_valid:
-            raise HTTPException(status_code=400, detail=error_msg)
+    if request.wire_format and request.wire_format not in WIRE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的输出格式: {request.wire_format}")
 
+    # 添加后台任务
     background_tasks.add_task(
         process_task,
         task_id,
         request.column_config.headers,
         request.prompt_profile_id,
-        user_config
+        TaskSettings.from_request(request)
     )
 
     return {"task_id": task_id, "status": "started"}
@@ -633,6 +1401,31 @@ async def get_status(task_id: str):
         "processed_files": task.processed_files,
         "success_count": task.success_count,
         "fail_count": task.fail_count,
+        "cache_hit_count": task.cache_hit_count,
+        "retry_count": task.retry_count,
+        "tiled_page_count": task.tiled_page_count,
+        "batch_request_count": task.batch_request_count,
+        "low_detail_page_count": task.low_detail_page_count,
+        "detail_upgrade_count": task.detail_upgrade_count,
+        "local_ocr_page_count": task.local_ocr_page_count,
+        "layout_crop_count": task.layout_crop_count,
+        "layout_column_count": task.layout_column_count,
+        "blank_page_count": task.blank_page_count,
+        "unreadable_page_count": task.unreadable_page_count,
+        "flagged_pages": task.flagged_pages,
+        "duplicate_page_count": task.duplicate_page_count,
+        "reused_page_count": task.reused_page_count,
+        "duplicate_pages": task.duplicate_pages,
+        "routed_page_count": task.routed_page_count,
+        "profile_routes": task.profile_routes,
+        "prompt_tokens": task.prompt_tokens,
+        "cached_prompt_tokens": task.cached_prompt_tokens,
+        "completion_tokens": task.completion_tokens,
+        "truncation_count": task.truncation_count,
+        "tier_stats": task.tier_stats,
+        "hedged_request_count": task.hedged_request_count,
+        "hedge_win_count": task.hedge_win_count,
+        "preprocess_settings": task.preprocess_settings,
         "message": task.message,
         "output_file": task.output_file
     }
@@ -673,7 +1466,8 @@ async def list_tasks():
                 "progress": t.progress,
                 "total_files": t.total_files,
                 "success_count": t.success_count,
-                "fail_count": t.fail_count
+                "fail_count": t.fail_count,
+                "cache_hit_count": t.cache_hit_count
             }
             for t in tasks.values()
         ]
@@ -698,6 +1492,151 @@ async def delete_task(task_id: str):
     return {"message": "任务已删除"}
 
 
+def _reparse_task(task_id: str) -> dict:
+    """
+    用保存的原始模型输出重新解析、校验整个任务（不调用大模型）
+
+    每张图片取最近一次保存的记录按当前解析与校验规则重新解析：解析成功时替换该图片的识别结果，
+    解析失败时删除该图片原有的识别结果并计为失败（规则收紧后不再保留不合格的数据）。
+    没有记录的图片（复用历史结果、本地识别、命中缓存等）的识别结果原样保留，Excel按保留的识别结果重新生成。
+    """
+    task_uuid = uuid.UUID(task_id)
+    with get_db_session() as session:
+        db_task = session.get(models.TaskRecord, task_uuid)
+        if not db_task:
+            raise HTTPException(status_code=404, detail="任务不存在")
+
+        uploads = session.query(models.UploadRecord).filter(models.UploadRecord.task_id == task_uuid).all()
+        uploads.sort(key=lambda upload: Path(upload.file_path))
+        latest = {}
+        for record in session.query(models.ModelResponse).filter(
+            models.ModelResponse.task_id == task_uuid
+        ).order_by(models.ModelResponse.created_at):
+            latest[record.upload_id] = record
+        if not latest:
+            raise HTTPException(status_code=400, detail="该任务没有保存的模型输出")
+
+        extracted = {}  # 上传记录ID -> [ExtractedTable]
+        for table in session.query(models.ExtractedTable).filter(
+            models.ExtractedTable.task_id == task_uuid
+        ).order_by(models.ExtractedTable.created_at):
+            extracted.setdefault(table.upload_id, []).append(table)
+
+        reparsed_count = 0
+        recovered_count = 0  # 原先识别失败、重新解析成功的图片
+        rejected_count = 0  # 原先识别成功、按当前规则解析失败的图片
+        failures = []
+        for upload in uploads:
+            record = latest.get(upload.id)
+            if record is None:
+                continue
+            headers, rows, error = reparse_record(unpack_responses(record.payload))
+
+            # 删除本图片已有的识别结果：解析成功时替换，失败时不再保留
+            old_tables = extracted.pop(upload.id, [])
+            if old_tables:
+                old_ids = [table.id for table in old_tables]
+                session.query(models.ExtractedRow).filter(
+                    models.ExtractedRow.table_id.in_(old_ids)
+                ).delete(synchronize_session=False)
+                session.query(models.ExtractedTable).filter(
+                    models.ExtractedTable.id.in_(old_ids)
+                ).delete(synchronize_session=False)
+
+            if error:
+                failures.append({"file": upload.file_name, "error": error})
+                if old_tables:
+                    rejected_count += 1
+                continue
+            if not old_tables:
+                recovered_count += 1
+            reparsed_count += 1
+
+            table = models.ExtractedTable(task_id=task_uuid, upload_id=upload.id, headers=headers, row_count=len(rows))
+            session.add(table)
+            session.flush()
+            session.add_all([
+                models.ExtractedRow(table_id=table.id, row_index=row_index, row_data=row)
+                for row_index, row in enumerate(rows, start=1)
+            ])
+            extracted[upload.id] = [table]
+
+        # 按图片顺序用全部识别结果重新生成Excel（每张图片取最近一次的结果）
+        output_filename = f"{task_id}_output.xlsx"
+        excel_writer = None
+        sheets = {}  # 列标题 -> 工作表标识（None 为第一个工作表）
+        for upload in uploads:
+            tables = extracted.get(upload.id)
+            if not tables:
+                continue
+            table = tables[-1]
+            rows = [list(row_data) for (row_data,) in session.query(models.ExtractedRow.row_data).filter(
+                models.ExtractedRow.table_id == table.id
+            ).order_by(models.ExtractedRow.row_index)]
+            headers = list(table.headers)
+            key = tuple(headers)
+            if excel_writer is None:
+                excel_writer = ExcelWriter(str(OUTPUT_DIR / output_filename), headers)
+                sheets[key] = None
+            elif key not in sheets:
+                sheets[key] = f"sheet{len(sheets) + 1}"
+                excel_writer.add_sheet(sheets[key], f"数据{len(sheets)}", headers)
+            excel_writer.add_data(rows, Path(upload.file_path).name, sheet=sheets[key])
+
+        if excel_writer is not None:
+            excel_writer.save()
+        else:
+            # 没有保留任何识别结果，原有的Excel已不再有效
+            output_filename = None
+
+        # 原先失败、现在解析成功的图片计为成功；原先成功、现在解析失败的图片计为失败
+        success_count = max(0, db_task.success_count + recovered_count - rejected_count)
+        fail_count = max(0, db_task.fail_count - recovered_count + rejected_count)
+        message = (f"重新解析完成：重新解析{reparsed_count}，其中原先失败{recovered_count}，"
+                   f"解析失败{len(failures)}（其中原先成功{rejected_count}），"
+                   f"无保存输出{len(uploads) - len(latest)}")
+        db_task.success_count = success_count
+        db_task.fail_count = fail_count
+        db_task.message = message
+        db_task.output_file = output_filename
+        session.commit()
+
+    task = tasks.get(task_id)
+    if task:
+        task.success_count = success_count
+        task.fail_count = fail_count
+        task.message = message
+        task.output_file = output_filename
+
+    print(f"[DEBUG] Reparse {task_id}: reparsed={reparsed_count}, recovered={recovered_count}, "
+          f"rejected={rejected_count}, failed={len(failures)}")
+    return {
+        "task_id": task_id,
+        "success_count": success_count,
+        "fail_count": fail_count,
+        "reparsed_count": reparsed_count,
+        "recovered_count": recovered_count,
+        "rejected_count": rejected_count,
+        "missing_count": len(uploads) - len(latest),
+        "failures": failures,
+        "output_file": output_filename,
+        "message": message
+    }
+
+
+@app.post("/api/tasks/{task_id}/reparse")
+async def reparse_task(task_id: str):
+    """用保存的原始模型输出重新解析任务（解析器或校验规则修改后使用，不调用大模型）"""
+    try:
+        uuid.UUID(task_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="任务ID格式无效")
+    task = tasks.get(task_id)
+    if task and task.status == "processing":
+        raise HTTPException(status_code=400, detail="任务正在处理中")
+    return await asyncio.to_thread(_reparse_task, task_id)
+
+
 # ==================== 配置管理 API ====================
 
 @app.get("/api/config/providers")
@@ -706,6 +1645,12 @@ async def get_providers():
     return {"providers": LLMConfigManager.list_providers()}
 
 
+@app.get("/api/config/key-pools")
+async def get_key_pools():
+    """获取各密钥池的使用情况（请求数、限流次数、停用剩余时间，密钥已脱敏）"""
+    return {"pools": list_key_pools()}
+
+
 @app.get("/api/config")
 async def get_current_config():
     """获取当前的大模型配置（不包含敏感信息）"""
@@ -715,10 +1660,14 @@ async def get_current_config():
         "model": config.model,
         "api_key": "",  # 前端不显示真实的API密钥，始终返回空字符串
         "has_api_key": bool(config.api_key),  # 标记是否已配置API密钥
+        "key_count": len(config.get_api_keys()),  # 密钥池中的密钥数
         "base_url": config.base_url,
         "temperature": config.temperature,
         "max_tokens": config.max_tokens,
-        "timeout": config.timeout
+        "timeout": config.timeout,
+        "stream": config.stream,
+        "rpm_limit": config.rpm_limit,
+        "tpm_limit": config.tpm_limit
     }
 
 
@@ -734,9 +1683,18 @@ async def update_llm_config(config_data: dict):
         api_key = config_data.get("api_key", "")
         keep_api_key = config_data.get("keep_api_key", False)
 
+        api_keys = config_data.get("api_keys")
+
         if keep_api_key and not api_key:
             # 保持原API密钥
             api_key = current_config.api_key
+        if api_keys is None:
+            # 未传入密钥池时保持原有的其他密钥（仅在主密钥未更换时）
+            api_keys = current_config.api_keys if api_key == current_config.api_key else []
+
+        # 未传入限流配置时保持原有的覆盖值，传入 null 或 0 表示恢复默认
+        rpm_limit = config_data.get("rpm_limit", current_config.rpm_limit)
+        tpm_limit = config_data.get("tpm_limit", current_config.tpm_limit)
 
         # 创建新的配置对象
         new_config = LLMConfig(
@@ -746,7 +1704,11 @@ async def update_llm_config(config_data: dict):
             base_url=config_data.get("base_url"),
             temperature=config_data.get("temperature", 0.01),
             max_tokens=config_data.get("max_tokens", 4096),
-            timeout=config_data.get("timeout", 180)
+            timeout=config_data.get("timeout", 180),
+            stream=bool(config_data.get("stream", False)),
+            api_keys=[str(key) for key in api_keys],
+            rpm_limit=int(rpm_limit) if rpm_limit else None,
+            tpm_limit=int(tpm_limit) if tpm_limit else None
         )
 
         # 验证配置
@@ -764,7 +1726,8 @@ async def update_llm_config(config_data: dict):
             "message": "配置已保存",
             "provider": new_config.provider,
             "model": new_config.model,
-            "has_api_key": bool(new_config.api_key)
+            "has_api_key": bool(new_config.api_key),
+            "key_count": len(new_config.get_api_keys())
         }
 
     except HTTPException:
@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, LargeBinary, String
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.sql import func
 
@@ -13,6 +13,7 @@ class PromptProfile(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
     source_image_hash = Column(String(64), nullable=True)
+    layout_fingerprint = Column(JSONB, nullable=True)
     headers = Column(JSONB, nullable=False)
     column_count = Column(Integer, nullable=False)
     column_notes = Column(JSONB, nullable=False, default=list)
@@ -42,6 +43,8 @@ class TaskRecord(Base):
     processed_files = Column(Integer, default=0, nullable=False)
     success_count = Column(Integer, default=0, nullable=False)
     fail_count = Column(Integer, default=0, nullable=False)
+    cache_hit_count = Column(Integer, default=0, nullable=False)
+    preprocess_settings = Column(JSONB, nullable=True)
     output_file = Column(String(255), nullable=True)
     message = Column(String(500), nullable=True)
 
@@ -53,10 +56,12 @@ class UploadRecord(Base):
     task_id = Column(UUID(as_uuid=True), ForeignKey("tasks.id"), nullable=False)
     file_name = Column(String(255), nullable=False)
     file_path = Column(String(500), nullable=False)
+    phash = Column(String(16), nullable=True)
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
 
     __table_args__ = (
         Index("ix_uploads_task_file", "task_id", "file_path"),
+        Index("ix_uploads_phash", "phash"),
     )
 
 
@@ -82,3 +87,21 @@ class ExtractedRow(Base):
     __table_args__ = (
         Index("ix_extracted_rows_table_index", "table_id", "row_index"),
     )
+
+
+class ModelResponse(Base):
+    __tablename__ = "model_responses"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    task_id = Column(UUID(as_uuid=True), ForeignKey("tasks.id"), nullable=False)
+    upload_id = Column(UUID(as_uuid=True), ForeignKey("uploads.id"), nullable=False)
+    model = Column(String(255), nullable=True)
+    prompt_hash = Column(String(64), nullable=True)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_model_responses_task_upload", "task_id", "upload_id"),
+    )
@@ -0,0 +1,171 @@
+"""
+接口健康模块
+按 提供商 + API地址 记录调用延迟分布与连续失败次数：
+- 延迟统计用于对冲请求（调用超过观测到的P95延迟时向备用模型发送重复请求）
+- 熔断器在连续失败后暂停向该接口发送请求，冷却后放行一次探测请求（只在配置了备用模型时启用）
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+
+
+# ==================== 熔断配置 ====================
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))  # 连续失败多少次后熔断
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "30"))  # 熔断持续时间（秒）
+
+# 延迟统计窗口（最近多少次成功调用）
+LATENCY_WINDOW = 200
+
+
+@dataclass
+class HedgePolicy:
+    """对冲请求配置"""
+    enabled: bool = os.environ.get("HEDGE_ENABLED", "0") == "1"
+    percentile: float = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))  # 超过该分位延迟时发送对冲请求
+    min_samples: int = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))  # 样本不足时使用 default_delay
+    default_delay: float = float(os.environ.get("HEDGE_DEFAULT_DELAY", "60"))
+    min_delay: float = float(os.environ.get("HEDGE_MIN_DELAY", "5"))
+    max_delay: float = float(os.environ.get("HEDGE_MAX_DELAY", "120"))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HedgePolicy":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            percentile=float(data.get("percentile", defaults.percentile)),
+            min_samples=int(data.get("min_samples", defaults.min_samples)),
+            default_delay=float(data.get("default_delay", defaults.default_delay)),
+            min_delay=float(data.get("min_delay", defaults.min_delay)),
+            max_delay=float(data.get("max_delay", defaults.max_delay)),
+        )
+
+    def delay(self, tracker: "LatencyTracker") -> float:
+        """计算发送对冲请求前的等待时间"""
+        observed = tracker.percentile(self.percentile) if tracker.count >= self.min_samples else None
+        delay = observed if observed is not None else self.default_delay
+        return max(self.min_delay, min(delay, self.max_delay))
+
+
+class LatencyTracker:
+    """滑动窗口延迟统计（线程安全）"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """返回窗口内的q分位延迟（秒），没有样本时返回None"""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """
+    熔断器（线程安全）
+
+    - 关闭：正常放行，连续失败达到阈值后打开
+    - 打开：拒绝请求，冷却时间过后进入半开
+    - 半开：只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 cooldown: float = CIRCUIT_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def remaining(self) -> float:
+        """距离允许探测还需等待的秒数"""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def retry_after(self) -> float:
+        """被拒绝的调用方应等待的秒数：冷却中时等到冷却结束，探测进行中时等待一个冷却周期（不立即重试）"""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            return remaining if remaining > 0 else self.cooldown
+
+    def allow(self) -> bool:
+        """是否允许发送请求"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release_probe(self):
+        """探测请求被取消或结果不能说明接口状态时，释放探测名额"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._probing or self.consecutive_failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    print(f"[WARN] 接口连续失败{self.consecutive_failures}次，熔断{self.cooldown:.0f}秒")
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class EndpointHealth:
+    """单个接口的延迟统计与熔断器"""
+
+    def __init__(self):
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+
+
+# ==================== 全局注册表 ====================
+
+_endpoints: Dict[str, EndpointHealth] = {}
+_registry_lock = threading.Lock()
+
+
+def get_endpoint_health(provider: str, api_url: str) -> EndpointHealth:
+    """获取进程内共享的接口健康状态（同一 提供商+地址 的所有任务共用）"""
+    key = f"{provider}:{api_url}"
+    with _registry_lock:
+        health = _endpoints.get(key)
+        if health is None:
+            health = EndpointHealth()
+            _endpoints[key] = health
+        return health
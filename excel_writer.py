@@ -42,55 +42,88 @@ class ExcelWriter:
         )
 
         # 写入表头
-        self._write_headers()
+        self._write_headers(self.worksheet, self.headers)
 
         self.current_row = 2  # 数据从第2行开始
 
-    def _write_headers(self):
+        # 其他版式的工作表：key -> [工作表, 列标题, 下一行]
+        self.extra_sheets = {}
+
+    def _write_headers(self, worksheet, headers: List[str]):
         """写入表头"""
-        for col_idx, header in enumerate(self.headers, start=1):
-            cell = self.worksheet.cell(row=1, column=col_idx, value=header)
+        for col_idx, header in enumerate(headers, start=1):
+            cell = worksheet.cell(row=1, column=col_idx, value=header)
             cell.font = self.header_font
             cell.fill = self.header_fill
             cell.alignment = self.header_alignment
             cell.border = self.thin_border
 
-    def add_data(self, rows: List[List[str]], image_name: str):
-        """添加数据行"""
+    def add_sheet(self, key: str, title: str, headers: List[str]):
+        """
+        添加一个工作表（同一批图片包含多种表格版式、列标题不同时使用）
+
+        Args:
+            key: 工作表标识，add_data 时通过 sheet 参数指定
+            title: 工作表名称
+            headers: 列标题列表（会自动添加"图片名称"列）
+        """
+        if key in self.extra_sheets:
+            return
+        worksheet = self.workbook.create_sheet(title=title)
+        headers = headers + ["图片名称"]
+        self._write_headers(worksheet, headers)
+        self.extra_sheets[key] = [worksheet, headers, 2]
+
+    def add_data(self, rows: List[List[str]], image_name: str, sheet: Optional[str] = None):
+        """添加数据行（sheet 为 add_sheet 时的标识，默认写入第一个工作表）"""
+        if sheet is None:
+            worksheet, headers, current_row = self.worksheet, self.headers, self.current_row
+        else:
+            worksheet, headers, current_row = self.extra_sheets[sheet]
+
         for row_data in rows:
             # 写入数据列
             for col_idx, value in enumerate(row_data, start=1):
-                cell = self.worksheet.cell(row=self.current_row, column=col_idx, value=value)
+                cell = worksheet.cell(row=current_row, column=col_idx, value=value)
                 cell.alignment = self.cell_alignment
                 cell.border = self.thin_border
 
             # 写入图片名称（最后一列）
-            last_col = len(self.headers)
-            cell = self.worksheet.cell(row=self.current_row, column=last_col, value=image_name)
+            last_col = len(headers)
+            cell = worksheet.cell(row=current_row, column=last_col, value=image_name)
             cell.alignment = self.cell_alignment
             cell.border = self.thin_border
 
-            self.current_row += 1
+            current_row += 1
+
+        if sheet is None:
+            self.current_row = current_row
+        else:
+            self.extra_sheets[sheet][2] = current_row
 
     def auto_adjust_width(self):
         """自动调整列宽"""
-        for col in range(1, len(self.headers) + 1):
-            max_length = 0
-            column = get_column_letter(col)
-
-            for row in range(1, min(51, self.worksheet.max_row + 1)):
-                cell = self.worksheet[f"{column}{row}"]
-                if cell.value:
-                    cell_value = str(cell.value)
-                    chinese_count = sum(1 for c in cell_value if '\u4e00' <= c <= '\u9fff')
-                    width = (len(cell_value) + chinese_count) * 1.2
-                    max_length = max(max_length, min(width, 50))
-
-            adjusted_width = min(max(10, max_length + 2), 60)
-            self.worksheet.column_dimensions[column].width = adjusted_width
+        sheets = [(self.worksheet, self.headers)] + [(ws, headers) for ws, headers, _ in self.extra_sheets.values()]
+        for worksheet, headers in sheets:
+            for col in range(1, len(headers) + 1):
+                max_length = 0
+                column = get_column_letter(col)
+
+                for row in range(1, min(51, worksheet.max_row + 1)):
+                    cell = worksheet[f"{column}{row}"]
+                    if cell.value:
+                        cell_value = str(cell.value)
+                        chinese_count = sum(1 for c in cell_value if '\u4e00' <= c <= '\u9fff')
+                        width = (len(cell_value) + chinese_count) * 1.2
+                        max_length = max(max_length, min(width, 50))
+
+                adjusted_width = min(max(10, max_length + 2), 60)
+                worksheet.column_dimensions[column].width = adjusted_width
 
     def save(self):
         """保存Excel文件"""
         self.auto_adjust_width()
         self.worksheet.freeze_panes = 'A2'
+        for worksheet, _, _ in self.extra_sheets.values():
+            worksheet.freeze_panes = 'A2'
         self.workbook.save(self.output_file)
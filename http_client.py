@@ -0,0 +1,103 @@
+"""
+HTTP客户端模块
+为大模型API调用提供长连接复用的共享异步客户端（连接池、keep-alive、可选HTTP/2、启动预热）
+"""
+
+import os
+import asyncio
+from typing import Iterable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+
+# ==================== 连接池配置 ====================
+
+# 是否启用HTTP/2（需要安装 h2：pip install "httpx[http2]"）
+HTTP2_ENABLED = os.environ.get("LLM_HTTP2", "0") == "1"
+# 连接池上限
+MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+# 空闲连接保持时间（秒）
+KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "120"))
+# 预热请求超时（秒）
+PREWARM_TIMEOUT = 10
+
+
+# ==================== 全局客户端实例 ====================
+
+_async_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _http2_available() -> bool:
+    """检查是否可以启用HTTP/2"""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("[WARN] LLM_HTTP2=1 但未安装 h2，回退到 HTTP/1.1")
+        return False
+
+
+def _create_async_client() -> httpx.AsyncClient:
+    """创建带连接池的异步客户端"""
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    return httpx.AsyncClient(limits=limits, http2=_http2_available())
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    获取当前事件循环上的共享异步客户端（单例模式）
+
+    httpx.AsyncClient 绑定创建它的事件循环；若在新的事件循环中调用（例如同步包装方法内的 asyncio.run），
+    会为该循环重新创建客户端。
+    """
+    global _async_client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _client_loop is not loop:
+        _async_client = _create_async_client()
+        _client_loop = loop
+    return _async_client
+
+
+async def close_async_client():
+    """关闭当前事件循环上的共享客户端"""
+    global _async_client, _client_loop
+    if _async_client is not None and _client_loop is asyncio.get_running_loop():
+        await _async_client.aclose()
+        _async_client = None
+        _client_loop = None
+
+
+async def prewarm(urls: Iterable[str]):
+    """
+    预热连接：提前与各API主机完成DNS解析和TLS握手，使首个识别请求直接复用连接
+
+    Args:
+        urls: API地址列表（同一主机只预热一次）
+    """
+    client = get_async_client()
+    origins = set()
+    for url in urls:
+        if not url:
+            continue
+        parts = urlsplit(url)
+        if parts.scheme and parts.netloc:
+            origins.add(f"{parts.scheme}://{parts.netloc}/")
+
+    async def _warm(origin: str):
+        try:
+            # 响应状态无关紧要，目的只是建立连接并放回连接池
+            await client.head(origin, timeout=PREWARM_TIMEOUT)
+            print(f"[DEBUG] Prewarmed connection: {origin}")
+        except Exception as e:
+            print(f"[WARN] 连接预热失败 {origin}: {e}")
+
+    await asyncio.gather(*(_warm(origin) for origin in origins))
@@ -0,0 +1,544 @@
+"""
+图片预处理模块
+在调用大模型API之前对图片做本地预处理（EXIF方向校正、缩放、灰度化、重新编码），减小上传体积；
+预处理和Base64编码的结果以 PreparedImage 形式缓存，同一张图片在重试和多个阶段间只读取、编码一次
+"""
+
+import io
+import os
+import json
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, replace
+from typing import List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装Pillow时退化为直接发送原图
+    Image = None
+    ImageOps = None
+
+
+# 已准备图片缓存的内存上限
+PREPARED_CACHE_MAX_BYTES = int(os.environ.get("PREPARED_IMAGE_CACHE_MB", "256")) * 1024 * 1024
+
+# 文件扩展名与MIME类型映射
+MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.bmp': 'image/bmp'
+}
+
+# 输出格式与MIME类型映射
+OUTPUT_FORMATS = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png"
+}
+
+
+def get_mime_type(image_path: str) -> str:
+    """根据文件扩展名获取MIME类型"""
+    ext = os.path.splitext(image_path)[1].lower()
+    return MIME_TYPES.get(ext, 'image/jpeg')
+
+
+@dataclass
+class PreprocessSettings:
+    """图片预处理配置"""
+    enabled: bool = os.environ.get("IMAGE_PREPROCESS", "0") == "1"  # 默认关闭，发送原图
+    max_long_edge: int = int(os.environ.get("IMAGE_MAX_LONG_EDGE", "2048"))  # 长边最大像素，0表示不缩放
+    grayscale: bool = os.environ.get("IMAGE_GRAYSCALE", "0") == "1"  # 彩色标注或浅色字迹的表格不宜灰度化
+    output_format: str = os.environ.get("IMAGE_OUTPUT_FORMAT", "JPEG")  # JPEG / WEBP / PNG
+    quality: int = int(os.environ.get("IMAGE_QUALITY", "85"))
+    fix_orientation: bool = True  # 按EXIF方向信息旋转
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PreprocessSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            max_long_edge=int(data.get("max_long_edge", defaults.max_long_edge)),
+            grayscale=bool(data.get("grayscale", defaults.grayscale)),
+            output_format=str(data.get("output_format", defaults.output_format)).upper(),
+            quality=int(data.get("quality", defaults.quality)),
+            fix_orientation=bool(data.get("fix_orientation", defaults.fix_orientation)),
+        )
+
+    def fingerprint(self) -> str:
+        """配置指纹（用于缓存键），未启用时为空字符串"""
+        if not self.enabled or Image is None:
+            return ""
+        raw = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _open_oriented(content: bytes, settings: PreprocessSettings) -> Tuple["Image.Image", bool]:
+    """打开图片并按EXIF方向校正，返回 (图片, 是否旋转)"""
+    img = Image.open(io.BytesIO(content))
+    # 0x0112: EXIF Orientation，1表示无需旋转
+    if settings.fix_orientation and img.getexif().get(0x0112, 1) != 1:
+        return ImageOps.exif_transpose(img), True
+    return img, False
+
+
+def _encode_pil_image(img: "Image.Image", settings: PreprocessSettings) -> Tuple[bytes, str, bool]:
+    """
+    按配置缩放、灰度化并编码PIL图片
+
+    Returns:
+        (图片字节, MIME类型, 是否缩放)；未启用预处理时按PNG无损编码
+    """
+    if not settings.enabled:
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue(), OUTPUT_FORMATS["PNG"], False
+
+    output_format = settings.output_format.upper()
+    if output_format not in OUTPUT_FORMATS:
+        output_format = "JPEG"
+
+    resized = False
+    if settings.max_long_edge and max(img.size) > settings.max_long_edge:
+        img = img.copy()
+        img.thumbnail((settings.max_long_edge, settings.max_long_edge), Image.LANCZOS)
+        resized = True
+
+    if settings.grayscale:
+        img = img.convert("L")
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    buffer = io.BytesIO()
+    save_kwargs = {}
+    if output_format in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = settings.quality
+    if output_format == "JPEG":
+        save_kwargs["optimize"] = True
+    img.save(buffer, format=output_format, **save_kwargs)
+    return buffer.getvalue(), OUTPUT_FORMATS[output_format], resized
+
+
+def preprocess_image_bytes(content: bytes, image_path: str,
+                           settings: PreprocessSettings) -> Tuple[bytes, str]:
+    """
+    对图片字节做预处理
+
+    Args:
+        content: 原始图片字节
+        image_path: 图片路径（用于推断原始MIME类型）
+        settings: 预处理配置
+
+    Returns:
+        (处理后的图片字节, MIME类型)；未启用、未安装Pillow或处理失败时返回原图
+    """
+    original_mime = get_mime_type(image_path)
+    if not settings.enabled or Image is None:
+        return content, original_mime
+
+    try:
+        img, rotated = _open_oriented(content, settings)
+        with img:
+            processed, mime_type, resized = _encode_pil_image(img, settings)
+    except Exception as e:
+        print(f"  [WARN] 图片预处理失败，使用原图: {e}")
+        return content, original_mime
+
+    # 未缩放/旋转且重新编码后反而更大时，直接发送原图
+    if not (rotated or resized) and len(processed) >= len(content):
+        return content, original_mime
+
+    return processed, mime_type
+
+
+@dataclass
+class PreparedImage:
+    """已预处理并编码的图片，可在重试与多个调用阶段间复用"""
+    path: str
+    content: bytes  # 预处理后的图片字节
+    mime_type: str
+    base64_data: str
+    sha256: str  # 原始文件内容的SHA-256
+    width: int = 0  # 预处理后的像素尺寸，无法读取时为0
+    height: int = 0
+    detail: Optional[str] = None  # 请求中的图片精度（low / high），None表示使用提供商默认值
+
+    @property
+    def pixel_area(self) -> int:
+        return self.width * self.height
+
+    @property
+    def memory_size(self) -> int:
+        """占用的内存字节数（近似）"""
+        return len(self.content) + len(self.base64_data)
+
+
+def _image_size(content: bytes) -> Tuple[int, int]:
+    """读取图片像素尺寸（只解析文件头），失败时返回 (0, 0)"""
+    if Image is None:
+        return 0, 0
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            return img.size
+    except Exception:
+        return 0, 0
+
+
+def prepare_image(image_path: str, settings: PreprocessSettings) -> PreparedImage:
+    """读取、预处理并编码图片"""
+    with open(image_path, "rb") as f:
+        original = f.read()
+    content, mime_type = preprocess_image_bytes(original, image_path, settings)
+    width, height = _image_size(content)
+    return PreparedImage(
+        path=image_path,
+        content=content,
+        mime_type=mime_type,
+        base64_data=base64.b64encode(content).decode('utf-8'),
+        sha256=hashlib.sha256(original).hexdigest(),
+        width=width,
+        height=height
+    )
+
+
+class PreparedImageCache:
+    """按内存上限淘汰的 PreparedImage LRU 缓存（线程安全）"""
+
+    def __init__(self, max_bytes: int = PREPARED_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[tuple, PreparedImage]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(image_path: str, settings: PreprocessSettings) -> tuple:
+        # 文件被覆盖后修改时间/大小会变化，旧条目自然失效
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, settings.fingerprint())
+
+    def get_or_prepare(self, image_path: str, settings: PreprocessSettings) -> PreparedImage:
+        """命中缓存直接返回，否则准备图片并放入缓存"""
+        key = self._make_key(image_path, settings)
+        with self._lock:
+            prepared = self._items.get(key)
+            if prepared is not None:
+                self._items.move_to_end(key)
+                return prepared
+
+        prepared = prepare_image(image_path, settings)
+
+        with self._lock:
+            if key not in self._items and prepared.memory_size <= self.max_bytes:
+                self._items[key] = prepared
+                self._total_bytes += prepared.memory_size
+                while self._total_bytes > self.max_bytes:
+                    _, evicted = self._items.popitem(last=False)
+                    self._total_bytes -= evicted.memory_size
+        return prepared
+
+
+# ==================== 全局缓存实例 ====================
+
+_prepared_cache: Optional[PreparedImageCache] = None
+
+
+def get_prepared_image_cache() -> PreparedImageCache:
+    """获取全局已准备图片缓存实例（单例模式）"""
+    global _prepared_cache
+    if _prepared_cache is None:
+        _prepared_cache = PreparedImageCache()
+    return _prepared_cache
+
+
+# ==================== 长图分条 ====================
+
+@dataclass
+class TileSettings:
+    """长图分条配置：把过高的页面切成上下重叠的水平条带分别识别"""
+    enabled: bool = os.environ.get("IMAGE_TILING", "0") == "1"
+    max_band_aspect: float = float(os.environ.get("IMAGE_TILE_MAX_ASPECT", "0.9"))  # 单个条带的最大 高/宽 比
+    overlap: float = float(os.environ.get("IMAGE_TILE_OVERLAP", "0.06"))  # 相邻条带重叠部分占整页高度的比例
+    max_bands: int = int(os.environ.get("IMAGE_TILE_MAX_BANDS", "6"))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TileSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            max_band_aspect=float(data.get("max_band_aspect", defaults.max_band_aspect)),
+            overlap=float(data.get("overlap", defaults.overlap)),
+            max_bands=int(data.get("max_bands", defaults.max_bands)),
+        )
+
+    def fingerprint(self) -> str:
+        """配置指纹（用于缓存键），未启用时为空字符串"""
+        if not self.enabled or Image is None:
+            return ""
+        raw = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def band_count(self, width: int, height: int) -> int:
+        """计算条带数，返回1表示无需分条"""
+        if not self.enabled or width <= 0 or self.max_band_aspect <= 0:
+            return 1
+        count = int(-(-(height / width) // self.max_band_aspect))  # 向上取整
+        return max(1, min(count, self.max_bands))
+
+    def band_spans(self, count: int) -> List[Tuple[float, float]]:
+        """各条带的上下边界（占切分区域高度的比例），与 prepare_image_bands 的切分方式一致"""
+        step = 1 / count
+        return [(max(0.0, idx * step - self.overlap), min(1.0, (idx + 1) * step + self.overlap))
+                for idx in range(count)]
+
+
+def _encode_region(img: "Image.Image", path: str, sha256: str, preprocess: PreprocessSettings,
+                   detail: Optional[str] = None) -> PreparedImage:
+    """把原图的一部分（已裁剪的PIL图片）预处理编码为 PreparedImage"""
+    content, mime_type, _ = _encode_pil_image(img, preprocess)
+    width, height = _image_size(content)
+    return PreparedImage(
+        path=path,
+        content=content,
+        mime_type=mime_type,
+        base64_data=base64.b64encode(content).decode('utf-8'),
+        sha256=sha256,
+        width=width,
+        height=height,
+        detail=detail
+    )
+
+
+def prepare_image_crop(image: PreparedImage, box: Tuple[int, int, int, int],
+                       preprocess: PreprocessSettings) -> PreparedImage:
+    """在原图分辨率上裁剪出 box 区域（EXIF校正后的坐标）并预处理编码"""
+    with open(image.path, "rb") as f:
+        original = f.read()
+    img, _ = _open_oriented(original, preprocess)
+    with img:
+        key = f"{image.sha256}:crop{box}"
+        return _encode_region(img.crop(box), image.path, hashlib.sha256(key.encode("utf-8")).hexdigest(),
+                              preprocess, image.detail)
+
+
+def prepare_image_bands(image: PreparedImage, preprocess: PreprocessSettings,
+                        tiling: TileSettings,
+                        box: Optional[Tuple[int, int, int, int]] = None) -> List[PreparedImage]:
+    """
+    把页面切成上下重叠的水平条带（在原图分辨率上切分，再逐条预处理编码）
+
+    Args:
+        box: 只切分原图中的该区域（版面分析裁剪出的表格区域），None表示整页
+
+    Returns:
+        条带列表；页面不够高、未启用分条或未安装Pillow时返回空列表
+    """
+    if not tiling.enabled or Image is None:
+        return []
+
+    with open(image.path, "rb") as f:
+        original = f.read()
+
+    img, _ = _open_oriented(original, preprocess)
+    if box is not None:
+        img = img.crop(box)
+    with img:
+        width, height = img.size
+        count = tiling.band_count(width, height)
+        if count < 2:
+            return []
+
+        overlap = int(height * tiling.overlap)
+        step = height / count
+        bands = []
+        for idx in range(count):
+            top = max(0, int(idx * step) - overlap)
+            bottom = min(height, int((idx + 1) * step) + overlap)
+            key = f"{image.sha256}:band{idx + 1}/{count}"
+            bands.append(_encode_region(
+                img.crop((0, top, width, bottom)),
+                f"{image.path}#band{idx + 1}",
+                hashlib.sha256(key.encode("utf-8")).hexdigest(),
+                preprocess,
+                image.detail
+            ))
+        return bands
+
+
+# ==================== 小图合并请求 ====================
+
+@dataclass
+class BatchSettings:
+    """小图合并配置：把多张小尺寸页面放进同一个请求识别，分摊提示词和往返开销"""
+    enabled: bool = os.environ.get("IMAGE_BATCHING", "0") == "1"
+    max_images: int = int(os.environ.get("IMAGE_BATCH_MAX_IMAGES", "4"))  # 每个请求最多的图片数
+    small_pixels: int = int(os.environ.get("IMAGE_BATCH_SMALL_PIXELS", str(1024 * 1024)))  # 视为小图的像素面积上限
+    max_total_pixels: int = int(os.environ.get("IMAGE_BATCH_MAX_PIXELS", str(3 * 1024 * 1024)))  # 每个请求的像素面积上限
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BatchSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            max_images=int(data.get("max_images", defaults.max_images)),
+            small_pixels=int(data.get("small_pixels", defaults.small_pixels)),
+            max_total_pixels=int(data.get("max_total_pixels", defaults.max_total_pixels)),
+        )
+
+
+def plan_batches(images: List[PreparedImage], settings: BatchSettings) -> List[List[int]]:
+    """
+    按原始顺序把相邻的小图分组（大图、尺寸未知的图片单独成组）
+
+    Returns:
+        每组图片在 images 中的下标列表
+    """
+    if not settings.enabled or settings.max_images < 2:
+        return [[idx] for idx in range(len(images))]
+
+    groups: List[List[int]] = []
+    current: List[int] = []
+    current_pixels = 0
+    for idx, image in enumerate(images):
+        area = image.pixel_area
+        if area <= 0 or area > settings.small_pixels:
+            if current:
+                groups.append(current)
+                current, current_pixels = [], 0
+            groups.append([idx])
+            continue
+        if current and (len(current) >= settings.max_images
+                        or current_pixels + area > settings.max_total_pixels):
+            groups.append(current)
+            current, current_pixels = [], 0
+        current.append(idx)
+        current_pixels += area
+    if current:
+        groups.append(current)
+    return groups
+
+
+# ==================== 自适应图片精度 ====================
+
+DETAIL_LOW = "low"
+DETAIL_HIGH = "high"
+
+# 估算墨迹比例时使用的缩略图长边
+INK_SAMPLE_EDGE = 256
+# 灰度低于该值的像素视为墨迹
+INK_THRESHOLD = 128
+
+
+@dataclass
+class DetailSettings:
+    """
+    自适应图片精度配置：尺寸小、列数少、文字稀疏的页面先以低精度（低分辨率 + detail=low）识别，
+    校验失败后自动升级为高精度
+    """
+    enabled: bool = os.environ.get("IMAGE_ADAPTIVE_DETAIL", "0") == "1"
+    low_long_edge: int = int(os.environ.get("IMAGE_LOW_DETAIL_LONG_EDGE", "1024"))  # 低精度时缩放到的长边
+    low_max_pixels: int = int(os.environ.get("IMAGE_LOW_DETAIL_MAX_PIXELS", str(1600 * 1200)))  # 可用低精度的像素面积上限
+    low_max_columns: int = int(os.environ.get("IMAGE_LOW_DETAIL_MAX_COLUMNS", "6"))  # 可用低精度的列数上限
+    low_max_ink: float = float(os.environ.get("IMAGE_LOW_DETAIL_MAX_INK", "0.06"))  # 可用低精度的墨迹比例上限
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DetailSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            low_long_edge=int(data.get("low_long_edge", defaults.low_long_edge)),
+            low_max_pixels=int(data.get("low_max_pixels", defaults.low_max_pixels)),
+            low_max_columns=int(data.get("low_max_columns", defaults.low_max_columns)),
+            low_max_ink=float(data.get("low_max_ink", defaults.low_max_ink)),
+        )
+
+    def fingerprint(self) -> str:
+        """配置指纹（用于缓存键），未启用时为空字符串"""
+        if not self.enabled or Image is None:
+            return ""
+        raw = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def choose(self, image: PreparedImage, column_count: Optional[int] = None) -> Optional[str]:
+        """
+        为页面选择初始精度
+
+        Returns:
+            DETAIL_LOW / DETAIL_HIGH；未启用或未安装Pillow时返回None（保持原有请求方式）
+        """
+        if not self.enabled or Image is None:
+            return None
+        area = image.pixel_area
+        if area <= 0 or area > self.low_max_pixels:
+            return DETAIL_HIGH
+        if column_count and column_count > self.low_max_columns:
+            return DETAIL_HIGH
+        ink = estimate_ink_ratio(image.content)
+        if ink is None or ink > self.low_max_ink:
+            return DETAIL_HIGH
+        return DETAIL_LOW
+
+
+def estimate_ink_ratio(content: bytes) -> Optional[float]:
+    """在灰度缩略图上估算深色像素（文字、线条）占比，用作文字密度的近似；失败时返回None"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            img.draft("L", (INK_SAMPLE_EDGE, INK_SAMPLE_EDGE))  # JPEG可直接按缩小尺寸解码
+            sample = img.convert("L")
+            sample.thumbnail((INK_SAMPLE_EDGE, INK_SAMPLE_EDGE))
+            histogram = sample.histogram()
+    except Exception:
+        return None
+    total = sum(histogram)
+    return sum(histogram[:INK_THRESHOLD]) / total if total else None
+
+
+def with_detail(image: PreparedImage, detail: str, settings: DetailSettings,
+                preprocess: PreprocessSettings) -> PreparedImage:
+    """
+    返回按指定精度发送的图片：低精度时缩放到 low_long_edge 并重新编码，高精度时只标记 detail
+
+    不修改传入的 PreparedImage（它可能在缓存中被共享）。
+    """
+    if detail != DETAIL_LOW or Image is None or max(image.width, image.height) <= settings.low_long_edge:
+        return replace(image, detail=detail)
+
+    try:
+        with Image.open(io.BytesIO(image.content)) as img:
+            img = img.copy()
+        img.thumbnail((settings.low_long_edge, settings.low_long_edge), Image.LANCZOS)
+        content, mime_type, _ = _encode_pil_image(img, preprocess)
+    except Exception as e:
+        print(f"  [WARN] 低精度图片编码失败，使用原图: {e}")
+        return replace(image, detail=detail)
+
+    width, height = _image_size(content)
+    return PreparedImage(
+        path=image.path,
+        content=content,
+        mime_type=mime_type,
+        base64_data=base64.b64encode(content).decode('utf-8'),
+        sha256=hashlib.sha256(f"{image.sha256}:{DETAIL_LOW}{settings.low_long_edge}".encode("utf-8")).hexdigest(),
+        width=width,
+        height=height,
+        detail=detail
+    )
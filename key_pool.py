@@ -0,0 +1,160 @@
+"""
+API密钥池模块
+同一提供商配置多个API密钥时按轮询分配请求，每个密钥使用独立的限流器；
+记录每个密钥的限流（429）与额度错误，暂时停用被限流或额度耗尽的密钥
+"""
+
+import os
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from rate_limiter import RateLimiter, get_rate_limiter
+
+
+# ==================== 停用策略配置 ====================
+
+KEY_BENCH_SECONDS = float(os.environ.get("KEY_BENCH_SECONDS", "20"))  # 429且未给出Retry-After时的首次停用时间
+KEY_BENCH_MAX_SECONDS = float(os.environ.get("KEY_BENCH_MAX_SECONDS", "600"))  # 连续429时停用时间的上限
+KEY_QUOTA_BENCH_SECONDS = float(os.environ.get("KEY_QUOTA_BENCH_SECONDS", "3600"))  # 额度耗尽/密钥无效时的停用时间
+
+# 响应中表示额度耗尽（而非短时限流）的关键词
+QUOTA_MARKERS = ("insufficient_quota", "exceeded your current quota", "billing", "quota exceeded",
+                 "余额不足", "欠费", "额度")
+
+
+def mask_key(api_key: str) -> str:
+    """日志与接口中展示的密钥标识（不暴露明文）"""
+    if len(api_key) <= 8:
+        return "****"
+    return f"{api_key[:3]}...{api_key[-4:]}"
+
+
+class ApiKeyState:
+    """单个密钥的使用状态"""
+
+    def __init__(self, provider: str, api_key: str, rate_limiter: RateLimiter):
+        self.provider = provider
+        self.api_key = api_key
+        self.label = mask_key(api_key)
+        self.rate_limiter = rate_limiter
+        self.requests = 0
+        self.rate_limited = 0  # 累计429次数
+        self.quota_errors = 0  # 累计额度耗尽/鉴权失败次数
+        self.consecutive_429 = 0
+        self.benched_until = 0.0
+        self.last_error: Optional[str] = None
+
+    def bench_remaining(self, now: float) -> float:
+        return max(0.0, self.benched_until - now)
+
+    def to_dict(self) -> dict:
+        now = time.monotonic()
+        return {
+            "key": self.label,
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "quota_errors": self.quota_errors,
+            "benched_seconds": round(self.bench_remaining(now), 1),
+            "last_error": self.last_error
+        }
+
+
+class KeyPool:
+    """同一提供商的密钥池（线程安全）"""
+
+    def __init__(self, provider: str, api_keys: List[str],
+                 rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.provider = provider
+        self.keys = [
+            ApiKeyState(provider, api_key, get_rate_limiter(provider, api_key, rpm, tpm))
+            for api_key in api_keys
+        ]
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def update_limits(self, rpm: Optional[int], tpm: Optional[int]):
+        """以其他限额再次注册时同步到每个密钥的限流器（取较严格的限额）"""
+        for state in self.keys:
+            state.rate_limiter.update_limits(rpm, tpm)
+
+    def available_count(self) -> int:
+        """当前未被停用的密钥数"""
+        now = time.monotonic()
+        return sum(1 for state in self.keys if state.bench_remaining(now) == 0)
+
+    def acquire(self) -> Tuple[Optional[ApiKeyState], float]:
+        """
+        轮询选取下一个可用密钥
+
+        返回: (密钥状态, 0)；全部被停用时返回 (None, 最早恢复还需等待的秒数)
+        """
+        now = time.monotonic()
+        with self._lock:
+            for offset in range(len(self.keys)):
+                index = (self._cursor + offset) % len(self.keys)
+                state = self.keys[index]
+                if state.bench_remaining(now) == 0:
+                    self._cursor = index + 1
+                    state.requests += 1
+                    return state, 0.0
+            return None, min(state.bench_remaining(now) for state in self.keys)
+
+    def report(self, state: ApiKeyState, status_code: Optional[int], message: str = "",
+               retry_after: Optional[float] = None):
+        """按响应结果更新密钥状态：429短时停用（连续429指数延长），额度耗尽或鉴权失败长时间停用"""
+        now = time.monotonic()
+        lowered = (message or "").lower()
+        with self._lock:
+            if status_code in (401, 403) or (status_code == 429 and any(m in lowered for m in QUOTA_MARKERS)):
+                state.quota_errors += 1
+                state.last_error = message[:200]
+                state.benched_until = now + KEY_QUOTA_BENCH_SECONDS
+                print(f"[WARN] API密钥 {state.label} 额度耗尽或无效，停用{KEY_QUOTA_BENCH_SECONDS:.0f}秒")
+            elif status_code == 429:
+                state.rate_limited += 1
+                state.consecutive_429 += 1
+                state.last_error = message[:200]
+                bench = retry_after if retry_after is not None else min(
+                    KEY_BENCH_MAX_SECONDS, KEY_BENCH_SECONDS * (2 ** (state.consecutive_429 - 1))
+                )
+                state.benched_until = now + bench
+                print(f"[WARN] API密钥 {state.label} 被限流，停用{bench:.0f}秒")
+            elif status_code == 200:
+                state.consecutive_429 = 0
+
+    def stats(self) -> List[dict]:
+        return [state.to_dict() for state in self.keys]
+
+
+# ==================== 全局密钥池注册表 ====================
+
+_pools: Dict[str, KeyPool] = {}
+_registry_lock = threading.Lock()
+
+
+def _pool_key(provider: str, api_keys: List[str]) -> str:
+    digest = hashlib.sha256("\0".join(api_keys).encode("utf-8")).hexdigest()[:16]
+    return f"{provider}:{digest}"
+
+
+def get_key_pool(provider: str, api_keys: List[str],
+                 rpm: Optional[int] = None, tpm: Optional[int] = None) -> KeyPool:
+    """获取进程内共享的密钥池（同一提供商、同一组密钥的所有任务共用停用状态与限流额度）"""
+    key = _pool_key(provider, api_keys)
+    with _registry_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = KeyPool(provider, api_keys, rpm, tpm)
+            _pools[key] = pool
+        else:
+            pool.update_limits(rpm, tpm)
+        return pool
+
+
+def list_key_pools() -> List[dict]:
+    """所有密钥池的使用情况"""
+    with _registry_lock:
+        pools = list(_pools.values())
+    return [{"provider": pool.provider, "keys": pool.stats()} for pool in pools]
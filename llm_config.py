@@ -7,33 +7,44 @@ import os
 import json
 from typing import Optional, Dict, List, Any
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 
 
 # ==================== 主流大模型配置 ====================
 
 # 预定义的模型提供商配置
+# rate_limits: 每分钟请求数(rpm)，按各平台入门档位保守设置；未配置的提供商不限流，可通过 LLMConfig.rpm_limit 覆盖。
+# 每分钟token数随账户档位相差很大，默认不限制，只在配置 LLMConfig.tpm_limit 时限流
+# structured_output: 原生结构化输出方式（json_schema / json_object / tool_use），未配置的提供商按文本解析JSON
+# image_detail: 是否支持图片的 detail（low / high）参数，不支持的提供商只按分辨率区分精度
 LLM_PROVIDERS = {
     "openai": {
         "name": "OpenAI",
         "base_url": "https://api.openai.com/v1/chat/completions",
         "models": ["gpt-4o", "gpt-4o-mini", "gpt-4-turbo", "gpt-3.5-turbo"],
         "api_key_env": "OPENAI_API_KEY",
-        "supports_vision": True
+        "supports_vision": True,
+        "rate_limits": {"rpm": 500},
+        "structured_output": "json_schema",
+        "image_detail": True
     },
     "anthropic": {
         "name": "Anthropic",
         "base_url": "https://api.anthropic.com/v1/messages",
         "models": ["claude-3-5-sonnet-20241022", "claude-3-5-haiku-20241022", "claude-3-opus-20240229"],
         "api_key_env": "ANTHROPIC_API_KEY",
-        "supports_vision": True
+        "supports_vision": True,
+        "rate_limits": {"rpm": 50},
+        "structured_output": "tool_use"
     },
     "gemini": {
         "name": "Google Gemini",
         "base_url": "https://generativelanguage.googleapis.com/v1beta/openai/chat/completions",
         "models": ["gemini-2.0-flash-exp", "gemini-2.0-flash-thinking-exp-01-21", "gemini-1.5-pro", "gemini-1.5-flash", "gemini-pro", "gemini-flash"],
         "api_key_env": "GEMINI_API_KEY",
-        "supports_vision": True
+        "supports_vision": True,
+        "rate_limits": {"rpm": 15},
+        "structured_output": "json_schema"
     },
     "doubao": {
         "name": "豆包(字节跳动)",
@@ -41,6 +52,7 @@ LLM_PROVIDERS = {
         "models": [],  # 使用自定义endpoint_id
         "api_key_env": "ARK_API_KEY",
         "supports_vision": True,
+        "rate_limits": {"rpm": 1000},
         "use_endpoint_id": True
     },
     "qwen": {
@@ -48,14 +60,17 @@ LLM_PROVIDERS = {
         "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions",
         "models": ["qwen-vl-max", "qwen-vl-plus", "qwen-vl-v1"],
         "api_key_env": "DASHSCOPE_API_KEY",
-        "supports_vision": True
+        "supports_vision": True,
+        "rate_limits": {"rpm": 60},
+        "structured_output": "json_object"
     },
     "zhipu": {
         "name": "智谱AI",
         "base_url": "https://open.bigmodel.cn/api/paas/v4/chat/completions",
         "models": ["glm-4v", "glm-4v-plus", "glm-4"],
         "api_key_env": "ZHIPU_API_KEY",
-        "supports_vision": True
+        "supports_vision": True,
+        "rate_limits": {"rpm": 60}
     },
     "baidu": {
         "name": "百度文心",
@@ -69,7 +84,8 @@ LLM_PROVIDERS = {
         "base_url": "https://hunyuan.tencentcloudapi.com/v1/chat/completions",
         "models": ["hunyuan-vision", "hunyuan-pro", "hunyuan-standard"],
         "api_key_env": "TENCENT_API_KEY",
-        "supports_vision": True
+        "supports_vision": True,
+        "rate_limits": {"rpm": 60}
     },
     "deepseek": {
         "name": "DeepSeek",
@@ -105,6 +121,10 @@ class LLMConfig:
     temperature: float = 0.01  # 温度参数
     max_tokens: int = 4096  # 最大token数
     timeout: int = 180  # 请求超时时间（秒）
+    rpm_limit: Optional[int] = None  # 每分钟请求数上限（覆盖提供商默认值）
+    tpm_limit: Optional[int] = None  # 每分钟token数上限（默认不限制）
+    stream: bool = False  # 流式接收输出，识别时边接收边校验CSV，列数不符立即中止
+    api_keys: List[str] = field(default_factory=list)  # 同一提供商的其他API密钥，与 api_key 组成密钥池轮询使用
 
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典"""
@@ -122,6 +142,31 @@ class LLMConfig:
         provider_info = LLM_PROVIDERS.get(self.provider, {})
         return provider_info.get("base_url", "")
 
+    def get_api_keys(self) -> List[str]:
+        """获取密钥池中的全部密钥（api_key 在前，去重并忽略空值）"""
+        keys = []
+        for key in [self.api_key, *self.api_keys]:
+            key = (key or "").strip()
+            if key and key not in keys:
+                keys.append(key)
+        return keys
+
+    def get_structured_output(self) -> Optional[str]:
+        """获取提供商支持的原生结构化输出方式，不支持时返回None"""
+        return LLM_PROVIDERS.get(self.provider, {}).get("structured_output")
+
+    def supports_image_detail(self) -> bool:
+        """提供商是否支持图片的 detail 参数"""
+        return bool(LLM_PROVIDERS.get(self.provider, {}).get("image_detail", False))
+
+    def get_rate_limits(self) -> Dict[str, Optional[int]]:
+        """获取实际生效的限流配置（rpm/tpm），None 表示不限制"""
+        provider_limits = LLM_PROVIDERS.get(self.provider, {}).get("rate_limits", {})
+        return {
+            "rpm": self.rpm_limit or provider_limits.get("rpm"),
+            "tpm": self.tpm_limit
+        }
+
     def validate(self) -> tuple[bool, str]:
         """验证配置是否有效"""
         if not self.provider:
@@ -251,13 +296,17 @@ class LLMConfigManager:
             api_key = os.environ.get("CUSTOM_API_KEY", "")
             model = os.environ.get("CUSTOM_MODEL", "")
 
+        # 同一提供商的其他密钥（逗号分隔），与 api_key 组成密钥池
+        api_keys = [key.strip() for key in os.environ.get("LLM_API_KEYS", "").split(",") if key.strip()]
+
         return LLMConfig(
             provider=provider,
             model=model,
             api_key=api_key,
             temperature=0.01,
             max_tokens=4096,
-            timeout=180
+            timeout=180,
+            api_keys=api_keys
         )
 
     @staticmethod
@@ -285,7 +334,10 @@ class LLMConfigManager:
                 "name": info.get("name", provider_id),
                 "models": info.get("models", []),
                 "supports_vision": info.get("supports_vision", False),
-                "use_endpoint_id": info.get("use_endpoint_id", False)
+                "use_endpoint_id": info.get("use_endpoint_id", False),
+                "rate_limits": info.get("rate_limits"),
+                "structured_output": info.get("structured_output"),
+                "image_detail": info.get("image_detail", False)
             })
         return result
 
@@ -0,0 +1,179 @@
+"""
+本地OCR模块
+对印刷清晰、带网格线的表格（网格检测见 table_layout），在本地用 Tesseract 识别（不调用大模型），结果通过列数与置信度校验后直接使用；
+未安装 pytesseract / Tesseract、检测不到网格或校验不通过时返回失败，由调用方回退到大模型识别
+"""
+
+import os
+import difflib
+from dataclasses import dataclass, asdict
+from typing import List, Optional, Tuple
+
+from table_processor import TableData, TableStructureAnalyzer
+from table_layout import detect_grid
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装Pillow时本地OCR不可用
+    Image = None
+    ImageOps = None
+
+try:
+    import pytesseract
+except ImportError:  # 未安装pytesseract时本地OCR不可用
+    pytesseract = None
+
+
+# 表头行与预期列标题的最低相似度，达到时视为表头行并从数据行中去掉
+HEADER_SIMILARITY = 0.6
+
+_available: Optional[bool] = None
+
+
+@dataclass
+class LocalOCRSettings:
+    """本地OCR配置"""
+    enabled: bool = os.environ.get("LOCAL_OCR", "0") == "1"
+    lang: str = os.environ.get("LOCAL_OCR_LANG", "chi_sim+eng")  # Tesseract 语言包
+    min_confidence: float = float(os.environ.get("LOCAL_OCR_MIN_CONFIDENCE", "80"))  # 词平均置信度下限（0-100）
+    max_low_confidence_ratio: float = float(os.environ.get("LOCAL_OCR_MAX_LOW_RATIO", "0.1"))  # 低置信度词的比例上限
+    line_coverage: float = 0.6  # 深色像素占整行/整列的比例达到该值视为网格线
+    max_empty_ratio: float = 0.5  # 空单元格比例上限，超过时视为识别不完整
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LocalOCRSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            lang=str(data.get("lang", defaults.lang)),
+            min_confidence=float(data.get("min_confidence", defaults.min_confidence)),
+            max_low_confidence_ratio=float(data.get("max_low_confidence_ratio", defaults.max_low_confidence_ratio)),
+            line_coverage=float(data.get("line_coverage", defaults.line_coverage)),
+            max_empty_ratio=float(data.get("max_empty_ratio", defaults.max_empty_ratio)),
+        )
+
+
+def local_ocr_available() -> bool:
+    """检查 Pillow、pytesseract 与 Tesseract 可执行文件是否都可用（结果在进程内缓存）"""
+    global _available
+    if _available is None:
+        _available = False
+        if Image is None or pytesseract is None:
+            print("[WARN] 未安装 Pillow 或 pytesseract，本地OCR不可用")
+        else:
+            try:
+                pytesseract.get_tesseract_version()
+                _available = True
+            except Exception:
+                print("[WARN] 未找到 Tesseract 可执行文件，本地OCR不可用")
+    return _available
+
+
+def _cell_index(bounds: List[int], center: float) -> Optional[int]:
+    """坐标落在第几个网格单元内，不在网格内时返回None"""
+    for idx in range(len(bounds) - 1):
+        if bounds[idx] <= center < bounds[idx + 1]:
+            return idx
+    return None
+
+
+# ==================== 本地识别 ====================
+
+class LocalTableRecognizer:
+    """基于网格检测 + Tesseract 的本地表格识别器"""
+
+    def __init__(self, settings: Optional[LocalOCRSettings] = None):
+        self.settings = settings or LocalOCRSettings()
+
+    def recognize(self, image_path: str, headers: List[str]) -> Tuple[Optional[TableData], Optional[str]]:
+        """
+        识别图片中的网格表格
+
+        Args:
+            image_path: 图片路径（使用原图，不经过上传前的缩放压缩）
+            headers: 预期的列标题；网格列数必须与之一致
+
+        返回: (TableData, 错误信息)；TableData 的列标题为 headers，表头行已去掉
+        """
+        try:
+            with Image.open(image_path) as opened:
+                img = ImageOps.exif_transpose(opened).convert("L")
+        except Exception as e:
+            return None, f"图片读取失败: {e}"
+
+        grid = detect_grid(img, self.settings.line_coverage)
+        if grid is None:
+            return None, "未检测到表格网格线"
+        row_bounds, col_bounds = grid
+        column_count = len(col_bounds) - 1
+        if column_count != len(headers):
+            return None, f"网格列数({column_count})与期望({len(headers)})不一致"
+
+        try:
+            data = pytesseract.image_to_data(img, lang=self.settings.lang, output_type=pytesseract.Output.DICT)
+        except Exception as e:
+            return None, f"Tesseract识别失败: {e}"
+
+        cells = [[[] for _ in range(column_count)] for _ in range(len(row_bounds) - 1)]
+        confidences = []
+        for text, conf, left, top, width, height in zip(
+            data["text"], data["conf"], data["left"], data["top"], data["width"], data["height"]
+        ):
+            text = text.strip()
+            conf = float(conf)
+            if not text or conf < 0:
+                continue
+            row = _cell_index(row_bounds, top + height / 2)
+            col = _cell_index(col_bounds, left + width / 2)
+            if row is None or col is None:
+                continue
+            cells[row][col].append(text)
+            confidences.append(conf)
+
+        if not confidences:
+            return None, "网格内未识别到文字"
+        mean_confidence = sum(confidences) / len(confidences)
+        low_ratio = sum(1 for conf in confidences if conf < self.settings.min_confidence) / len(confidences)
+        if mean_confidence < self.settings.min_confidence or low_ratio > self.settings.max_low_confidence_ratio:
+            return None, f"置信度不足（平均{mean_confidence:.0f}，低置信度词占{low_ratio:.0%}）"
+
+        rows = [[self._join_words(words) for words in row] for row in cells]
+        rows = [row for row in rows if any(row)]
+        if rows and self._is_header_row(rows[0], headers):
+            rows = rows[1:]
+        if not rows:
+            return None, "没有数据行"
+
+        empty_ratio = sum(1 for row in rows for cell in row if not cell) / (len(rows) * column_count)
+        if empty_ratio > self.settings.max_empty_ratio:
+            return None, f"空单元格过多（{empty_ratio:.0%}）"
+
+        table_data = TableData(
+            file_name=os.path.basename(image_path),
+            headers=list(headers),
+            rows=rows,
+            column_count=column_count
+        )
+        is_valid, error = TableStructureAnalyzer.validate_structure(table_data)
+        if not is_valid:
+            return None, error
+        return table_data, None
+
+    @staticmethod
+    def _join_words(words: List[str]) -> str:
+        """合并同一单元格内的词：Tesseract 会把中文拆成多个词，只在两个ASCII词之间保留空格"""
+        joined = ""
+        for word in words:
+            if joined and joined[-1].isascii() and word[0].isascii():
+                joined += " "
+            joined += word
+        return joined
+
+    @staticmethod
+    def _is_header_row(row: List[str], headers: List[str]) -> bool:
+        left = "".join(cell.replace(" ", "") for cell in row)
+        right = "".join(header.replace(" ", "") for header in headers)
+        return difflib.SequenceMatcher(None, left, right).ratio() >= HEADER_SIMILARITY
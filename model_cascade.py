@@ -0,0 +1,136 @@
+"""
+模型级联模块
+按顺序组织多个模型（先快速低价、后高精度），页面识别失败（CSV解析或列数校验不通过）时才升级到下一档模型
+（超时、5xx、限流等接口故障在本档按重试策略重试，仍失败则直接计为失败，不升级），
+并统计每档模型的成功率与耗时，便于调整级联顺序
+"""
+
+import time
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+from ocr_processor import OCRProcessor, PromptProfile, ProcessingStats, ImageInput, ERROR_CONTENT
+
+
+@dataclass
+class TierStats:
+    """单档模型的识别统计"""
+    tier: int
+    provider: str
+    model: str
+    calls: int = 0  # 该档执行的识别调用次数（一次调用可能包含多张合并识别的图片）
+    pages: int = 0  # 交给该档识别的页面数
+    successes: int = 0
+    failures: int = 0  # 在该档识别失败的页面数
+    escalations: int = 0  # 内容不合格、升级到下一档的页面数
+    total_latency: float = 0.0  # 累计耗时（秒）
+
+    @property
+    def success_rate(self) -> float:
+        return self.successes / self.pages if self.pages else 0.0
+
+    @property
+    def avg_latency(self) -> float:
+        return self.total_latency / self.calls if self.calls else 0.0
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["total_latency"] = round(self.total_latency, 3)
+        data["success_rate"] = round(self.success_rate, 4)
+        data["avg_latency"] = round(self.avg_latency, 3)
+        return data
+
+
+class ModelCascade:
+    """
+    模型级联识别器，接口与 OCRProcessor 的批量识别方法一致
+
+    每档使用独立的 OCRProcessor（独立的限流器与结果缓存键）。除最后一档外只做一次内容尝试（仍包含本地修复），
+    内容不合格的页面立即交给下一档，把多次重试的成本留给更可靠的模型。
+    接口故障（超时、5xx、限流重试用尽等）与不可重试的错误不升级：换更贵的模型解决不了接口问题，
+    传输错误已在本档按重试策略退避重试。
+    """
+
+    def __init__(self, processors: List[OCRProcessor]):
+        if not processors:
+            raise ValueError("级联至少需要一个模型")
+        self.processors = processors
+        self.tiers = [
+            TierStats(tier=idx, provider=processor.provider, model=processor.model)
+            for idx, processor in enumerate(processors)
+        ]
+
+    @property
+    def stats(self) -> ProcessingStats:
+        """所有档位合计的处理统计"""
+        return ProcessingStats.combine([processor.stats for processor in self.processors])
+
+    def tier_stats(self) -> List[dict]:
+        """各档位的成功率与耗时"""
+        return [tier.to_dict() for tier in self.tiers]
+
+    async def async_plan_batches(self, image_paths: List[ImageInput]) -> List[List[int]]:
+        """按第一档的小图合并配置分组"""
+        return await self.processors[0].async_plan_batches(image_paths)
+
+    async def _cascade(self, image_paths: List[ImageInput], recognize, max_retries: int,
+                       responses: Optional[List[list]] = None) -> List[Optional[str]]:
+        """逐档识别，只把内容不合格的页面交给下一档（responses 见 OCRProcessor._process_images，各档的响应依次记入）"""
+        results: List[Optional[str]] = [None] * len(image_paths)
+        pending = list(range(len(image_paths)))
+        last_tier = len(self.processors) - 1
+
+        for idx, processor in enumerate(self.processors):
+            if not pending:
+                break
+            tier = self.tiers[idx]
+            tier_retries = max_retries if idx == last_tier else 1
+
+            started = time.monotonic()
+            logs = [responses[i] for i in pending] if responses is not None else None
+            failures: List[Optional[str]] = [None] * len(pending)
+            csv_texts = await recognize(processor, [image_paths[i] for i in pending], tier_retries, logs, failures)
+            tier.total_latency += time.monotonic() - started
+            tier.calls += 1
+            tier.pages += len(pending)
+
+            escalated = []
+            given_up = 0
+            for page, csv_text, failure in zip(pending, csv_texts, failures):
+                if csv_text:
+                    results[page] = csv_text
+                    tier.successes += 1
+                    continue
+                tier.failures += 1
+                if failure == ERROR_CONTENT and idx < last_tier:
+                    tier.escalations += 1
+                    escalated.append(page)
+                else:
+                    given_up += 1
+
+            if escalated:
+                print(f"  [CASCADE] {len(escalated)}张图片在第{idx + 1}档（{processor.model}）内容不合格，升级到下一档")
+            if given_up and idx < last_tier:
+                print(f"  [CASCADE] {given_up}张图片在第{idx + 1}档（{processor.model}）因接口错误失败，不升级")
+            pending = escalated
+
+        return results
+
+    async def async_process_batch_with_profile(self, image_paths: List[ImageInput], profile: PromptProfile,
+                                               max_retries: int = 3,
+                                               responses: Optional[List[list]] = None) -> List[Optional[str]]:
+        """使用结构化提示词逐档识别一组图片"""
+        async def recognize(processor: OCRProcessor, paths: List[ImageInput], retries: int, logs, failures):
+            return await processor.async_process_batch_with_profile(paths, profile, max_retries=retries,
+                                                                    responses=logs, failures=failures)
+        return await self._cascade(image_paths, recognize, max_retries, responses)
+
+    async def async_process_batch_with_headers(self, image_paths: List[ImageInput],
+                                               expected_headers: List[str],
+                                               max_retries: int = 3,
+                                               responses: Optional[List[list]] = None) -> List[Optional[str]]:
+        """使用预定义的列标题逐档识别一组图片"""
+        async def recognize(processor: OCRProcessor, paths: List[ImageInput], retries: int, logs, failures):
+            return await processor.async_process_batch_with_headers(paths, expected_headers, max_retries=retries,
+                                                                    responses=logs, failures=failures)
+        return await self._cascade(image_paths, recognize, max_retries, responses)
@@ -5,12 +5,34 @@ OCR处理器 - 负责与大模型API交互
 """
 
 import os
+import re
 import json
-import base64
-import requests
+import time
+import math
+import hashlib
+import asyncio
+import contextvars
+import httpx
 from dataclasses import dataclass, asdict
-from typing import Optional, Tuple, List
-from table_processor import TableData, CSVParser, TableStructureAnalyzer
+from typing import Optional, Tuple, List, Dict, Union, Callable, Awaitable, Any
+from table_processor import (
+    TableData, CSVParser, CSVRepair, TableStructureAnalyzer, StreamingCSVValidator, TableStitcher,
+    CompactTableParser, WIRE_CSV, WIRE_COMPACT, WIRE_FORMATS
+)
+import http_client
+from key_pool import get_key_pool
+from endpoint_health import HedgePolicy, get_endpoint_health
+from result_cache import OCRResultCache
+from retry_policy import (
+    RetryPolicy, RetryBudget, ERROR_TRANSPORT, ERROR_CONTENT, ERROR_FATAL,
+    classify_status, parse_retry_after
+)
+from local_ocr import LocalOCRSettings, LocalTableRecognizer, local_ocr_available
+from table_layout import LayoutSettings, TableLayout, analyze_layout
+from image_preprocessor import (
+    PreprocessSettings, PreparedImage, TileSettings, BatchSettings, DetailSettings, get_prepared_image_cache,
+    get_mime_type, prepare_image_bands, prepare_image_crop, plan_batches, with_detail, DETAIL_LOW, DETAIL_HIGH
+)
 
 
 @dataclass
@@ -36,6 +58,140 @@ class PromptProfile:
         )
 
 
+@dataclass
+class ProcessingStats:
+    """单个处理器（通常对应一个任务）的调用统计"""
+    api_calls: int = 0
+    cache_hits: int = 0
+    retries: int = 0  # 实际执行的重试次数
+    transport_errors: int = 0  # 限流/5xx/超时等传输错误次数
+    content_errors: int = 0  # CSV解析或列数校验失败次数
+    local_repairs: int = 0  # 本地启发式修复成功次数
+    text_repairs: int = 0  # 纯文本修复请求成功次数
+    tiled_pages: int = 0  # 分条识别的页面数
+    stitched_overlap_rows: int = 0  # 拼接时去除的重叠行数
+    batch_requests: int = 0  # 多图合并请求次数
+    batched_images: int = 0  # 通过合并请求识别成功的图片数
+    layout_crops: int = 0  # 版面分析裁掉页边距/标题的页面数
+    layout_columns: int = 0  # 版面分析检测到列边界并写入提示词的页面数
+    low_detail_pages: int = 0  # 以低精度识别成功的页面数
+    local_pages: int = 0  # 由本地OCR识别成功（未调用大模型）的页面数
+    local_fallbacks: int = 0  # 本地OCR未通过校验、回退到大模型的页面数
+    detail_upgrades: int = 0  # 低精度校验失败后升级为高精度的页面数
+    prompt_tokens: int = 0  # 输入token总数（含缓存命中部分）
+    completion_tokens: int = 0  # 输出token总数
+    cached_prompt_tokens: int = 0  # 命中提供商提示词缓存的输入token数
+    truncations: int = 0  # 输出因 max_tokens 被截断的次数
+    continuations: int = 0  # 截断后发出的续写/提高上限重发请求数
+    hedged_requests: int = 0  # 发出的对冲请求数
+    hedge_wins: int = 0  # 对冲请求先于主请求返回有效结果的次数
+    circuit_rejections: int = 0  # 因熔断被拒绝或转发到备用模型的调用数
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def combine(cls, items: List["ProcessingStats"]) -> "ProcessingStats":
+        """合计多个处理器的统计"""
+        total = cls()
+        for item in items:
+            for name, value in asdict(item).items():
+                setattr(total, name, getattr(total, name) + value)
+        return total
+
+
+@dataclass
+class ApiResult:
+    """单次API调用的结果"""
+    success: bool
+    content: str  # 成功时为模型输出文本，失败时为错误信息
+    error_kind: Optional[str] = None  # 失败类型：transport / content / fatal
+    status_code: Optional[int] = None
+    retry_after: Optional[float] = None  # 服务端要求的等待秒数
+    finish_reason: Optional[str] = None  # 生成结束原因（OpenAI: finish_reason / Anthropic: stop_reason）
+
+    @property
+    def truncated(self) -> bool:
+        """输出是否因达到 max_tokens 被截断"""
+        return self.success and self.finish_reason in TRUNCATED_FINISH_REASONS
+
+
+# 表示输出被 max_tokens 截断的结束原因
+TRUNCATED_FINISH_REASONS = {"length", "max_tokens"}
+
+# 输出被截断时：CSV识别请求从最后一个完整行续写，其余请求提高 max_tokens 重发（不超过上限）
+TRUNCATION_MAX_CONTINUATIONS = int(os.environ.get("TRUNCATION_MAX_CONTINUATIONS", "3"))
+MAX_TOKENS_CEILING = int(os.environ.get("MAX_TOKENS_CEILING", "8192"))
+
+# 图片参数：文件路径或已准备好的图片
+ImageInput = Union[str, PreparedImage]
+
+# 合并请求中每张图片输出段的分隔行，例如 "=== 图片2 ==="
+BATCH_SECTION_PATTERN = re.compile(r"^\s*=+\s*图片\s*(\d+)\s*=+\s*$", re.MULTILINE)
+
+
+# 限流预约时无法读取尺寸的图片的估算token数
+IMAGE_TOKEN_ESTIMATE = 1000
+# OpenAI 图片计费：detail=low 固定token数；high 时缩放后按 512x512 分块，每块token数
+OPENAI_IMAGE_BASE_TOKENS = 85
+OPENAI_IMAGE_TILE_TOKENS = 170
+# 其他提供商（Anthropic 等）按像素面积估算：每token对应的像素数与单张图片的上限
+IMAGE_PIXELS_PER_TOKEN = 750
+IMAGE_TOKEN_CAP = 1600
+# 中日韩字符（约1个token/字），其余字符约4个字符1个token
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+# 列数错误时先尝试本地修复和纯文本修复请求，问题行超过上限时直接整图重试
+TEXT_REPAIR_ENABLED = os.environ.get("TEXT_REPAIR_ENABLED", "1") == "1"
+TEXT_REPAIR_MAX_ROWS = int(os.environ.get("TEXT_REPAIR_MAX_ROWS", "10"))
+
+# 提供商侧提示词缓存：静态的系统提示词和画像提示词放在请求最前面，Anthropic 显式标记缓存断点，
+# OpenAI 按前缀自动缓存（附带 prompt_cache_key 提高同一任务请求的命中率）
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE_ENABLED", "1") == "1"
+
+# 画像识别的输出格式（csv / compact），compact 省略列标题行和引号以减少输出token
+OUTPUT_WIRE_FORMAT = os.environ.get("OCR_WIRE_FORMAT", WIRE_CSV)
+
+# 画像生成/优化的输出结构，支持原生结构化输出的提供商按此约束输出（与 PromptProfile 字段一致）
+PROFILE_RESPONSE_SCHEMA = {
+    "name": "prompt_profile",
+    "description": "表格结构画像：列标题、列数、列说明、行规则与输出规则",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "headers": {"type": "array", "items": {"type": "string"}},
+            "column_count": {"type": "integer"},
+            "column_notes": {"type": "array", "items": {"type": "string"}},
+            "row_rules": {"type": "array", "items": {"type": "string"}},
+            "output_rules": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["headers", "column_count", "column_notes", "row_rules", "output_rules"],
+        "additionalProperties": False
+    }
+}
+
+# 原始响应记录：调用方为每张图片传入一个列表（见 _process_images 的 responses 参数），
+# 识别该图片期间成功的API响应按顺序追加到列表中，用于持久化后离线重新解析
+_response_log: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("response_log", default=None)
+# 当前调用在识别流程中的用途：page（整页）/ band（条带）/ batch（多图合并）/ repair（纯文本修复）/ continuation（续写）
+_response_scope: contextvars.ContextVar[str] = contextvars.ContextVar("response_scope", default="page")
+# 当前这次调用的token用量（_record_usage 写入）
+_call_usage: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("call_usage", default=None)
+# 失败原因记录：识别每张图片时传入一个列表，_call_with_retries 最终失败时追加错误类型（content/transport/fatal），
+# 最后一项即该图片的失败原因（见 _process_images 的 failures 参数）
+_failure_log: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("failure_log", default=None)
+
+# 请求结构化输出被拒绝（HTTP 400）的 提供商+模型，之后改用文本解析
+_structured_output_unsupported = set()
+
+
+def _record_failure(kind: str):
+    """把最终失败的错误类型记入当前图片的失败原因列表（见 _failure_log）"""
+    failure_log = _failure_log.get()
+    if failure_log is not None:
+        failure_log.append(kind)
+
+
 PROFILE_SYSTEM_PROMPT = """ä½ æ˜¯ä¸“ä¸šçš„çº¸è´¨è¡¨æ ¼ç»“æž„åˆ†æžä¸“å®¶ã€?
 ä»»åŠ¡ï¼šåˆ†æžå›¾ç‰‡ä¸­çš„ä¸»è¡¨æ ¼ç»“æž„ï¼Œè¿”å›žä¸¥æ ¼JSONã€‚
 è¦æ±‚ï¼š
@@ -67,6 +223,13 @@ PROFILE_FEEDBACK_SYSTEM_PROMPT = """你是表格识别提示词的优化专家
 4) 如反馈明确指定列数或列名，优先遵循。
 5) 规则要简洁、可执行，便于输出 CSV。"""
 
+REPAIR_SYSTEM_PROMPT = """你是CSV数据修复助手。
+你会收到一张表格的表头和若干列数不正确的行，请只修正这些行的列划分。
+规则：
+1) 不修改、不翻译、不补全单元格内容本身。
+2) 单元格内容含英文逗号时用双引号包裹。
+3) 只输出修正后的CSV行，不要表头、行号、解释或Markdown。"""
+
 class OCRProcessor:
     """OCR处理器 - 统一的大模型调用接口"""
 
@@ -105,12 +268,34 @@ class OCRProcessor:
 - 所有行必须有相同的列数
 - 纯CSV文本，无其他内容"""
 
-    def __init__(self, config):
+    def __init__(self, config, result_cache: Optional[OCRResultCache] = None,
+                 preprocess: Optional[PreprocessSettings] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 tiling: Optional[TileSettings] = None,
+                 batching: Optional[BatchSettings] = None,
+                 hedge_to: Optional["OCRProcessor"] = None,
+                 hedge_policy: Optional[HedgePolicy] = None,
+                 wire_format: Optional[str] = None,
+                 detail: Optional[DetailSettings] = None,
+                 local_ocr: Optional[LocalOCRSettings] = None,
+                 layout: Optional[LayoutSettings] = None):
         """
         初始化OCR处理器
 
         Args:
             config: LLMConfig配置对象（来自llm_config模块）
+            result_cache: 识别结果缓存（可选，命中时跳过API调用）
+            preprocess: 图片预处理配置（可选，默认使用环境变量配置）
+            retry_policy: 重试策略（可选，默认使用环境变量配置）；重试预算在该处理器的所有调用间共享
+            tiling: 长图分条配置（可选，默认使用环境变量配置）
+            batching: 小图合并请求配置（可选，默认使用环境变量配置）
+            hedge_to: 备用模型的处理器（可选）；主接口慢于观测P95延迟或已熔断时向其发送请求。
+                      只有配置了备用模型时主、备接口才启用熔断（没有可转移的接口时熔断只会让请求更快失败）
+            hedge_policy: 对冲请求配置（可选，默认使用环境变量配置）
+            wire_format: 画像识别的输出格式 csv / compact（可选，默认使用环境变量配置）
+            detail: 自适应图片精度配置（可选，默认使用环境变量配置）
+            local_ocr: 本地OCR配置（可选，默认使用环境变量配置）；启用且可用时先在本地识别，失败再调用大模型
+            layout: 版面分析配置（可选，默认使用环境变量配置）
         """
         self.config = config
         self.api_key = config.api_key
@@ -120,23 +305,100 @@ class OCRProcessor:
         self.temperature = config.temperature
         self.max_tokens = config.max_tokens
         self.timeout = config.timeout
+        self.stream = getattr(config, "stream", False)
+        self.image_detail = config.supports_image_detail() if hasattr(config, "supports_image_detail") else False
+
+        # 密钥池：多个密钥轮询使用，每个密钥一个限流器（同一 提供商+密钥 的所有处理器共享额度）
+        rate_limits = config.get_rate_limits()
+        api_keys = config.get_api_keys() if hasattr(config, "get_api_keys") else [self.api_key]
+        self.key_pool = get_key_pool(
+            self.provider,
+            api_keys or [self.api_key],
+            rpm=rate_limits.get("rpm"),
+            tpm=rate_limits.get("tpm")
+        )
+
+        self.result_cache = result_cache
+        self.preprocess = preprocess or PreprocessSettings()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.tiling = tiling or TileSettings()
+        self.batching = batching or BatchSettings()
+        self.detail = detail or DetailSettings()
+        self.layout = layout or LayoutSettings()
+        local_ocr = local_ocr or LocalOCRSettings()
+        self.local_recognizer = (
+            LocalTableRecognizer(local_ocr) if local_ocr.enabled and local_ocr_available() else None
+        )
+        self.hedge_to = hedge_to
+        self.hedge_policy = hedge_policy or HedgePolicy()
+        self.wire_format = wire_format or OUTPUT_WIRE_FORMAT
+        if self.wire_format not in WIRE_FORMATS:
+            print(f"[WARN] 未知的输出格式 {self.wire_format}，使用 {WIRE_CSV}")
+            self.wire_format = WIRE_CSV
+        # 同一 提供商+地址 的所有处理器共享延迟统计与熔断器
+        self.endpoint = get_endpoint_health(self.provider, self.api_url)
+        self.circuit_breaking = hedge_to is not None
+        if hedge_to is not None:
+            hedge_to.circuit_breaking = True  # 备用接口的熔断状态决定能否接管
+        self.retry_budget = RetryBudget(self.retry_policy.task_retry_budget)
+        self.stats = ProcessingStats()
 
     def _get_mime_type(self, image_path: str) -> str:
         """根据文件扩展名获取MIME类型"""
-        ext = os.path.splitext(image_path)[1].lower()
-        mime_types = {
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.webp': 'image/webp',
-            '.bmp': 'image/bmp'
-        }
-        return mime_types.get(ext, 'image/jpeg')
+        return get_mime_type(image_path)
 
-    def _encode_image(self, image_path: str) -> str:
-        """将图片编码为Base64"""
-        with open(image_path, "rb") as f:
-            return base64.b64encode(f.read()).decode('utf-8')
+    def prepare_image(self, image: ImageInput) -> PreparedImage:
+        """
+        读取、预处理并编码图片（经全局LRU缓存，同一张图片只编码一次）
+
+        Args:
+            image: 图片路径或已准备好的图片
+        """
+        if isinstance(image, PreparedImage):
+            return image
+        return get_prepared_image_cache().get_or_prepare(image, self.preprocess)
+
+    async def async_prepare_image(self, image: ImageInput) -> PreparedImage:
+        """异步准备图片（预处理为CPU密集操作，放到线程中执行避免阻塞事件循环）"""
+        if isinstance(image, PreparedImage):
+            return image
+        return await asyncio.to_thread(self.prepare_image, image)
+
+    def _result_cache_key(self, image: PreparedImage, user_prompt: str) -> Optional[str]:
+        """生成识别结果缓存键，未启用缓存时返回None"""
+        if not self.result_cache:
+            return None
+        return OCRResultCache.make_key(
+            image.sha256,
+            user_prompt,
+            self.SYSTEM_PROMPT,
+            self.provider,
+            self.model,
+            extra=(self.preprocess.fingerprint() + self.tiling.fingerprint() + self.detail.fingerprint()
+                   + self.layout.fingerprint())
+        )
+
+    def _cache_lookup(self, cache_key: Optional[str]) -> Optional[str]:
+        """查询识别结果缓存"""
+        if not cache_key:
+            return None
+        try:
+            csv_text = self.result_cache.get(cache_key)
+        except Exception as e:
+            print(f"  [WARN] 读取结果缓存失败: {e}")
+            return None
+        if csv_text:
+            self.stats.cache_hits += 1
+        return csv_text
+
+    def _cache_store(self, cache_key: Optional[str], csv_text: str):
+        """写入识别结果缓存"""
+        if not cache_key:
+            return
+        try:
+            self.result_cache.put(cache_key, csv_text)
+        except Exception as e:
+            print(f"  [WARN] 写入结果缓存失败: {e}")
 
     def _build_user_prompt(self, image_path: str, retry_count: int = 0,
                           previous_error: str = "", expected_columns: int = None) -> str:
@@ -160,11 +422,26 @@ class OCRProcessor:
 
         return base_prompt
 
-    def _build_payload_openai(self, user_prompt: str, base64_image: str, mime_type: str,
-                              system_prompt: Optional[str] = None) -> dict:
-        """构建OpenAI兼容格式的payload"""
+    @staticmethod
+    def _image_label(index: int, count: int) -> List[dict]:
+        """多图请求时在每张图片前插入编号文本，与输出段的编号对应"""
+        if count < 2:
+            return []
+        return [{"type": "text", "text": f"图片{index}"}]
+
+    def _build_payload_openai(self, user_prompt: str, images: List[PreparedImage],
+                              system_prompt: Optional[str] = None, max_tokens: Optional[int] = None,
+                              response_schema: Optional[dict] = None) -> dict:
+        """构建OpenAI兼容格式的payload（images为空时为纯文本请求）"""
         active_system_prompt = system_prompt or self.SYSTEM_PROMPT
-        return {
+        content = [{"type": "text", "text": user_prompt}]
+        for index, image in enumerate(images, start=1):
+            content.extend(self._image_label(index, len(images)))
+            image_url = {"url": f"data:{image.mime_type};base64,{image.base64_data}"}
+            if image.detail and self.image_detail:
+                image_url["detail"] = image.detail
+            content.append({"type": "image_url", "image_url": image_url})
+        payload = {
             "model": self.model,
             "temperature": self.temperature,
             "messages": [
@@ -174,125 +451,476 @@ class OCRProcessor:
                 },
                 {
                     "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}
-                        }
-                    ]
+                    "content": content
                 }
             ],
-            "max_tokens": self.max_tokens
+            "max_tokens": max_tokens or self.max_tokens
         }
-
-    def _build_payload_anthropic(self, user_prompt: str, base64_image: str, mime_type: str,
-                                 system_prompt: Optional[str] = None) -> dict:
-        """构建Anthropic格式的payload"""
+        if PROMPT_CACHE_ENABLED and self.provider == "openai":
+            # 相同前缀的请求使用同一个键，路由到同一缓存分片
+            prefix = f"{self.model}\0{active_system_prompt}\0{user_prompt}"
+            payload["prompt_cache_key"] = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]
+
+        mode = self._structured_output_mode() if response_schema else None
+        if mode == "json_schema":
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": response_schema["name"],
+                    "strict": True,
+                    "schema": response_schema["schema"]
+                }
+            }
+        elif mode == "json_object":
+            payload["response_format"] = {"type": "json_object"}
+        return payload
+
+    def _build_payload_anthropic(self, user_prompt: str, images: List[PreparedImage],
+                                 system_prompt: Optional[str] = None, max_tokens: Optional[int] = None,
+                                 response_schema: Optional[dict] = None) -> dict:
+        """构建Anthropic格式的payload（images为空时为纯文本请求）"""
         active_system_prompt = system_prompt or self.SYSTEM_PROMPT
-        return {
+        system_block = {"type": "text", "text": active_system_prompt}
+        prompt_block = {"type": "text", "text": user_prompt}
+        if PROMPT_CACHE_ENABLED:
+            # 缓存断点：系统提示词、系统提示词+用户提示词两级前缀，图片放在断点之后
+            system_block["cache_control"] = {"type": "ephemeral"}
+            prompt_block["cache_control"] = {"type": "ephemeral"}
+        content = [prompt_block]
+        for index, image in enumerate(images, start=1):
+            content.extend(self._image_label(index, len(images)))
+            content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": image.mime_type,
+                    "data": image.base64_data
+                }
+            })
+        payload = {
             "model": self.model,
             "temperature": self.temperature,
-            "max_tokens": self.max_tokens,
-            "system": active_system_prompt,
+            "max_tokens": max_tokens or self.max_tokens,
+            "system": [system_block],
             "messages": [
                 {
                     "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_prompt},
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": mime_type,
-                                "data": base64_image
-                            }
-                        }
-                    ]
+                    "content": content
                 }
             ]
         }
+        if response_schema and self._structured_output_mode() == "tool_use":
+            # 强制调用唯一的工具，工具参数即为结构化结果
+            payload["tools"] = [{
+                "name": response_schema["name"],
+                "description": response_schema["description"],
+                "input_schema": response_schema["schema"]
+            }]
+            payload["tool_choice"] = {"type": "tool", "name": response_schema["name"]}
+        return payload
+
+    def _structured_output_mode(self) -> Optional[str]:
+        """当前提供商/模型可用的原生结构化输出方式，不支持时返回None"""
+        if (self.provider, self.model) in _structured_output_unsupported:
+            return None
+        get_mode = getattr(self.config, "get_structured_output", None)
+        return get_mode() if get_mode else None
 
-    def _get_headers(self) -> dict:
-        """根据不同提供商获取请求头"""
+    def _get_headers(self, api_key: Optional[str] = None) -> dict:
+        """根据不同提供商获取请求头（api_key为None时使用配置的主密钥）"""
         headers = {"Content-Type": "application/json"}
+        api_key = api_key or self.api_key
 
         if self.provider == "anthropic":
-            headers["x-api-key"] = self.api_key
+            headers["x-api-key"] = api_key
             headers["anthropic-version"] = "2023-06-01"
         else:
             # OpenAI兼容格式（豆包、通义千问、智谱等）
-            headers["Authorization"] = f"Bearer {self.api_key}"
+            headers["Authorization"] = f"Bearer {api_key}"
 
         return headers
 
-    def _parse_response(self, response_data: dict) -> Tuple[bool, str]:
-        """根据不同提供商解析响应"""
+    def _estimate_image_tokens(self, image: PreparedImage) -> int:
+        """按提供商的计费方式和图片的实际尺寸、精度估算单张图片的token数"""
+        width, height = image.width, image.height
+        if width <= 0 or height <= 0:
+            return IMAGE_TOKEN_ESTIMATE
+        if self.image_detail:
+            if image.detail == DETAIL_LOW:
+                return OPENAI_IMAGE_BASE_TOKENS
+            # 先缩放到 2048x2048 以内，再把短边缩到 768
+            scale = min(1.0, 2048 / max(width, height))
+            scale *= min(1.0, 768 / (min(width, height) * scale))
+            tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+            return OPENAI_IMAGE_BASE_TOKENS + OPENAI_IMAGE_TILE_TOKENS * tiles
+        return min(IMAGE_TOKEN_CAP, math.ceil(width * height / IMAGE_PIXELS_PER_TOKEN))
+
+    def _estimate_request_tokens(self, user_prompt: str, system_prompt: Optional[str] = None,
+                                 images: Optional[List[PreparedImage]] = None,
+                                 max_tokens: Optional[int] = None) -> int:
+        """
+        按实际请求估算一次调用消耗的token数，用于TPM限流预约（调用完成后按实际用量修正）
+
+        文本按中日韩字符每字1个token、其余字符每4个字符1个token估算，图片按实际尺寸和精度估算，
+        输出按 max_tokens 的四分之一预留。
+        """
+        text = (system_prompt or self.SYSTEM_PROMPT) + user_prompt
+        cjk = len(_CJK_PATTERN.findall(text))
+        text_tokens = cjk + math.ceil((len(text) - cjk) / 4)
+        image_tokens = sum(self._estimate_image_tokens(image) for image in images or [])
+        return text_tokens + image_tokens + (max_tokens or self.max_tokens) // 4
+
+    def _extract_usage(self, response_data: dict) -> Optional[int]:
+        """从响应中提取实际消耗的总token数，并记录提示词缓存命中情况"""
+        usage = response_data.get("usage") if isinstance(response_data, dict) else None
+        if not isinstance(usage, dict):
+            return None
+        self._record_usage(usage)
+        if self.provider == "anthropic":
+            return (usage.get("input_tokens") or 0) + (usage.get("output_tokens") or 0)
+        return usage.get("total_tokens")
+
+    def _record_usage(self, usage: dict):
+        """
+        累计输入/输出token数与提示词缓存命中的token数
+
+        Anthropic: input_tokens 不含缓存部分，命中/写入分别为 cache_read_input_tokens / cache_creation_input_tokens；
+        OpenAI兼容格式: prompt_tokens 含缓存部分，命中数在 prompt_tokens_details.cached_tokens。
+        """
+        if self.provider == "anthropic":
+            cached = usage.get("cache_read_input_tokens") or 0
+            prompt = (usage.get("input_tokens") or 0) + cached + (usage.get("cache_creation_input_tokens") or 0)
+            completion = usage.get("output_tokens") or 0
+        else:
+            details = usage.get("prompt_tokens_details") or {}
+            cached = (details.get("cached_tokens") if isinstance(details, dict) else 0) or 0
+            prompt = usage.get("prompt_tokens") or 0
+            completion = usage.get("completion_tokens") or 0
+        self.stats.prompt_tokens += prompt
+        self.stats.cached_prompt_tokens += cached
+        self.stats.completion_tokens += completion
+        call_usage = _call_usage.get()
+        if call_usage is not None:
+            call_usage["prompt_tokens"] = call_usage.get("prompt_tokens", 0) + prompt
+            call_usage["completion_tokens"] = call_usage.get("completion_tokens", 0) + completion
+
+    def _parse_response(self, response_data: dict) -> Tuple[bool, str, Optional[str]]:
+        """
+        根据不同提供商解析响应
+
+        返回: (success, content, finish_reason)
+        """
         try:
             if self.provider == "anthropic":
                 # Anthropic格式
                 if 'content' in response_data and len(response_data['content']) > 0:
-                    content = response_data['content'][0].get('text', '')
-                    return True, content
+                    blocks = response_data['content']
+                    # 结构化输出（tool_use）时工具参数即为结果JSON
+                    tool_block = next((b for b in blocks if b.get('type') == 'tool_use'), None)
+                    if tool_block is not None:
+                        content = json.dumps(tool_block.get('input', {}), ensure_ascii=False)
+                    else:
+                        content = blocks[0].get('text', '')
+                    return True, content, response_data.get('stop_reason')
                 else:
-                    return False, f"API返回结构异常: {response_data}"
+                    return False, f"API返回结构异常: {response_data}", None
             else:
                 # OpenAI兼容格式
                 if 'choices' in response_data and len(response_data['choices']) > 0:
-                    content = response_data['choices'][0]['message']['content']
-                    return True, content
+                    choice = response_data['choices'][0]
+                    content = choice['message']['content']
+                    return True, content, choice.get('finish_reason')
                 else:
-                    return False, f"API返回结构异常: {response_data}"
+                    return False, f"API返回结构异常: {response_data}", None
         except Exception as e:
-            return False, f"解析响应失败: {str(e)}"
+            return False, f"解析响应失败: {str(e)}", None
 
-    def _call_api(self, image_path: str, user_prompt: str,
-                  system_prompt: Optional[str] = None) -> Tuple[bool, str]:
+    def _build_payload(self, images: List[PreparedImage], user_prompt: str,
+                       system_prompt: Optional[str] = None, max_tokens: Optional[int] = None,
+                       response_schema: Optional[dict] = None) -> dict:
         """
-        调用大模型API（支持多种提供商）
+        根据提供商构建请求payload
 
-        返回: (success, response_content)
+        images为空时为纯文本请求，max_tokens为None时使用配置值；
+        指定response_schema且提供商支持时使用原生结构化输出
         """
-        try:
-            base64_image = self._encode_image(image_path)
-            mime_type = self._get_mime_type(image_path)
+        if self.provider == "anthropic":
+            return self._build_payload_anthropic(
+                user_prompt,
+                images,
+                system_prompt=system_prompt,
+                max_tokens=max_tokens,
+                response_schema=response_schema
+            )
+        # OpenAI兼容格式
+        return self._build_payload_openai(
+            user_prompt,
+            images,
+            system_prompt=system_prompt,
+            max_tokens=max_tokens,
+            response_schema=response_schema
+        )
 
-            headers = self._get_headers()
+    async def async_call_api(self, image: Union[None, ImageInput, List[ImageInput]], user_prompt: str,
+                             system_prompt: Optional[str] = None,
+                             expected_columns: Optional[int] = None,
+                             max_tokens: Optional[int] = None,
+                             response_schema: Optional[dict] = None,
+                             compact_headers: Optional[List[str]] = None,
+                             has_header: bool = True) -> ApiResult:
+        """
+        异步调用大模型API（支持多种提供商），复用共享连接池，不阻塞事件循环
 
-            # 根据提供商构建不同的payload
-            if self.provider == "anthropic":
-                payload = self._build_payload_anthropic(
-                    user_prompt,
-                    base64_image,
-                    mime_type,
-                    system_prompt=system_prompt
-                )
+        Args:
+            image: 图片路径或已准备好的图片（重试时应传入同一个PreparedImage，避免重复编码）；
+                   传入列表时在一个请求中发送多张图片，为None时发送纯文本请求
+            expected_columns: 期望的CSV列数；启用流式输出时用于增量校验，发现列数不符立即中止请求
+            max_tokens: 本次调用的输出上限（默认使用配置值）
+            response_schema: 期望的输出结构；提供商支持时使用原生结构化输出，被拒绝时自动退回文本输出
+            compact_headers: 提示词要求紧凑格式输出时的列标题；成功的输出会转换为带这些列标题的标准CSV
+            has_header: 输出的第一行是否为表头；续写请求只输出数据行，流式校验时按数据行校验
+
+        返回: ApiResult
+        """
+        breaker = self.endpoint.breaker if self.circuit_breaking else None
+        if breaker is not None and not breaker.allow():
+            self.stats.circuit_rejections += 1
+            return ApiResult(False, f"接口已熔断（{self.provider}）", error_kind=ERROR_TRANSPORT,
+                             retry_after=breaker.retry_after())
+
+        started = time.monotonic()
+        usage_token = _call_usage.set({})
+        try:
+            wire_format = WIRE_COMPACT if compact_headers else WIRE_CSV
+            result = await self._call_endpoint(image, user_prompt, system_prompt, expected_columns,
+                                               max_tokens, response_schema, wire_format, has_header)
+            if result.status_code == 400 and response_schema and self._structured_output_mode():
+                print(f"  [WARN] {self.provider}/{self.model} 不支持结构化输出，改用文本解析: {result.content[:200]}")
+                _structured_output_unsupported.add((self.provider, self.model))
+                result = await self._call_endpoint(image, user_prompt, system_prompt, expected_columns,
+                                                   max_tokens, None, wire_format, has_header)
+        except asyncio.CancelledError:
+            # 对冲请求中落败的一方会被取消，不计入接口状态
+            if breaker is not None:
+                breaker.release_probe()
+            raise
+        finally:
+            usage = _call_usage.get()
+            _call_usage.reset(usage_token)
+
+        if breaker is not None:
+            if result.error_kind == ERROR_TRANSPORT and result.status_code != 429:
+                breaker.record_failure()
+            elif result.error_kind in (ERROR_TRANSPORT, ERROR_FATAL):
+                # 限流（由密钥池处理）与鉴权/参数错误不代表接口故障
+                breaker.release_probe()
             else:
-                # OpenAI兼容格式
-                payload = self._build_payload_openai(
-                    user_prompt,
-                    base64_image,
-                    mime_type,
-                    system_prompt=system_prompt
-                )
+                breaker.record_success()
+        if result.success:
+            self.endpoint.latency.record(time.monotonic() - started)
+        response_log = _response_log.get()
+        if response_log is not None and result.success:
+            response_log.append({
+                "scope": _response_scope.get(),
+                "model": f"{self.provider}/{self.model}",
+                "prompt_hash": hashlib.sha256(f"{system_prompt or ''}\n{user_prompt}".encode("utf-8")).hexdigest(),
+                "wire_format": wire_format,
+                "finish_reason": result.finish_reason,
+                "usage": usage or {},
+                "content": result.content
+            })
+        if compact_headers and result.success:
+            # 下游的校验、修复、续写、拼接与缓存都基于标准CSV
+            result.content = CompactTableParser.to_csv(result.content, compact_headers)
+        return result
+
+    async def _call_endpoint(self, image: Union[None, ImageInput, List[ImageInput]], user_prompt: str,
+                             system_prompt: Optional[str], expected_columns: Optional[int],
+                             max_tokens: Optional[int], response_schema: Optional[dict] = None,
+                             wire_format: str = WIRE_CSV, has_header: bool = True) -> ApiResult:
+        """选取密钥、准备图片、限流并发送一次请求"""
+        key_state, wait = self.key_pool.acquire()
+        if key_state is None:
+            return ApiResult(False, "所有API密钥均被暂停使用", error_kind=ERROR_TRANSPORT, retry_after=wait)
+        rate_limiter = key_state.rate_limiter
+
+        if image is None:
+            images = []
+        elif isinstance(image, list):
+            images = image
+        else:
+            images = [image]
+        estimated_tokens = 0
+        actual_tokens = None
+        try:
+            headers = self._get_headers(key_state.api_key)
+            prepared = [await self.async_prepare_image(item) for item in images]
+            payload = self._build_payload(prepared, user_prompt, system_prompt=system_prompt,
+                                          max_tokens=max_tokens, response_schema=response_schema)
+            estimated_tokens = self._estimate_request_tokens(user_prompt, system_prompt, prepared, max_tokens)
+
+            await rate_limiter.acquire(estimated_tokens)
+            self.stats.api_calls += 1
+
+            if self.stream:
+                result, actual_tokens = await self._post_stream(headers, payload, expected_columns, wire_format,
+                                                                has_header)
+            else:
+                result, actual_tokens = await self._post(headers, payload)
+            self.key_pool.report(key_state, result.status_code, result.content if not result.success else "",
+                                 result.retry_after)
+            return result
+
+        except httpx.TimeoutException:
+            return ApiResult(False, f"请求超时（{self.timeout}秒）", error_kind=ERROR_TRANSPORT)
+        except httpx.TransportError as e:
+            return ApiResult(False, f"网络异常: {str(e)}", error_kind=ERROR_TRANSPORT)
+        except Exception as e:
+            return ApiResult(False, f"异常: {str(e)}", error_kind=ERROR_FATAL)
+        finally:
+            rate_limiter.reconcile(estimated_tokens, actual_tokens)
+
+    def _http_error(self, response: httpx.Response, body: str) -> ApiResult:
+        """把非200响应转换为ApiResult（区分可重试与不可重试，并读取Retry-After）"""
+        return ApiResult(
+            False,
+            f"HTTP {response.status_code}: {body}",
+            error_kind=classify_status(response.status_code),
+            status_code=response.status_code,
+            retry_after=parse_retry_after(response.headers.get("retry-after"))
+        )
 
-            response = requests.post(
-                self.api_url,
-                headers=headers,
-                json=payload,
-                timeout=self.timeout
-            )
+    async def _post(self, headers: dict, payload: dict) -> Tuple[ApiResult, Optional[int]]:
+        """发送普通请求，返回 (ApiResult, 实际token用量)"""
+        client = http_client.get_async_client()
+        response = await client.post(
+            self.api_url,
+            headers=headers,
+            json=payload,
+            timeout=self.timeout
+        )
 
-            if response.status_code == 200:
-                result = response.json()
-                return self._parse_response(result)
-            else:
-                return False, f"HTTP {response.status_code}: {response.text}"
+        if response.status_code != 200:
+            # 被拒绝的请求不计入token用量
+            return self._http_error(response, response.text), 0
 
-        except requests.exceptions.Timeout:
-            return False, f"请求超时（{self.timeout}秒）"
-        except Exception as e:
-            return False, f"异常: {str(e)}"
+        try:
+            result = response.json()
+        except ValueError:
+            return ApiResult(False, f"响应不是有效的JSON: {response.text[:200]}",
+                             error_kind=ERROR_TRANSPORT, status_code=200), None
+
+        success, content, finish_reason = self._parse_response(result)
+        return ApiResult(
+            success,
+            content,
+            error_kind=None if success else ERROR_CONTENT,
+            status_code=200,
+            finish_reason=finish_reason
+        ), self._extract_usage(result)
+
+    async def _post_stream(self, headers: dict, payload: dict,
+                           expected_columns: Optional[int] = None,
+                           wire_format: str = WIRE_CSV,
+                           has_header: bool = True) -> Tuple[ApiResult, Optional[int]]:
+        """
+        以SSE流式方式发送请求，边接收边校验CSV，列数不符时立即关闭连接中止生成（has_header 见 async_call_api）
+
+        返回: (ApiResult, 实际token用量)
+        """
+        payload = dict(payload, stream=True)
+        if self.provider == "openai":
+            payload["stream_options"] = {"include_usage": True}
+
+        validator = StreamingCSVValidator(expected_columns, wire_format, has_header) if expected_columns else None
+        parts = []
+        state = {}
+
+        client = http_client.get_async_client()
+        async with client.stream(
+            "POST",
+            self.api_url,
+            headers=headers,
+            json=payload,
+            timeout=self.timeout
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                return self._http_error(response, body), 0
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    continue
+
+                text = self._parse_stream_event(event, state)
+                if not text:
+                    continue
+                parts.append(text)
+
+                if validator:
+                    error = validator.feed(text)
+                    if error:
+                        # 退出 async with 时连接被关闭，服务端随之停止生成
+                        return ApiResult(False, f"流式校验失败，已中止: {error}",
+                                         error_kind=ERROR_CONTENT, status_code=200), None
+
+        if "usage" in state:
+            self._record_usage(state["usage"])
+            total_tokens = state["usage"].get("total_tokens") or 0
+        elif "input" in state or "output" in state:
+            total_tokens = state.get("input", 0) + state.get("output", 0)
+        else:
+            total_tokens = None
+        return ApiResult(True, "".join(parts), status_code=200,
+                         finish_reason=state.get("finish_reason")), total_tokens
+
+    def _parse_stream_event(self, event: dict, state: dict) -> str:
+        """解析单个SSE事件，返回增量文本，并把用量信息与结束原因写入state"""
+        if self.provider == "anthropic":
+            event_type = event.get("type")
+            if event_type == "content_block_delta":
+                delta = event.get("delta", {})
+                # tool_use 的参数以 input_json_delta 增量返回
+                return delta.get("text") or delta.get("partial_json") or ""
+            if event_type == "message_start":
+                message_usage = event.get("message", {}).get("usage", {})
+                # 输出token数以 message_delta 中的最终值为准
+                self._record_usage(dict(message_usage, output_tokens=0))
+                state["input"] = message_usage.get("input_tokens") or 0
+            elif event_type == "message_delta":
+                state["output"] = event.get("usage", {}).get("output_tokens") or 0
+                self.stats.completion_tokens += state["output"]
+                if event.get("delta", {}).get("stop_reason"):
+                    state["finish_reason"] = event["delta"]["stop_reason"]
+            return ""
+
+        # OpenAI兼容格式
+        if isinstance(event.get("usage"), dict):
+            # 部分提供商在每个分片中都返回累计用量，只保留最后一次，结束后再记录缓存命中
+            state["usage"] = event["usage"]
+        choices = event.get("choices") or []
+        if choices:
+            if choices[0].get("finish_reason"):
+                state["finish_reason"] = choices[0]["finish_reason"]
+            return (choices[0].get("delta") or {}).get("content") or ""
+        return ""
+
+    def _call_api(self, image: ImageInput, user_prompt: str,
+                  system_prompt: Optional[str] = None) -> Tuple[bool, str]:
+        """
+        调用大模型API（同步版本，供脚本使用）
+
+        返回: (success, response_content)
+        """
+        result = _run_sync(self.async_call_api(image, user_prompt, system_prompt=system_prompt))
+        return result.success, result.content
 
     def _build_profile_user_prompt(self) -> str:
         """构建试运行结构分析的提示词"""
@@ -357,13 +985,48 @@ Please revise the JSON profile to satisfy the feedback while matching the image.
             output_rules=output_rules
         )
 
-    def _build_user_prompt_from_profile(self, profile: PromptProfile, retry_note: str = "") -> str:
-        """根据试运行结构生成动态提示词"""
+    def _validate_profile(self, content: str) -> Tuple[Optional[PromptProfile], Optional[str]]:
+        """校验画像生成结果，返回 (PromptProfile, 错误信息)"""
+        profile = self._parse_profile_response(content)
+        if profile is None:
+            return None, "画像JSON无效或列数与表头不一致"
+        return profile, None
+
+    def _build_user_prompt_from_profile(self, profile: PromptProfile, retry_note: str = "",
+                                        wire_format: str = WIRE_CSV) -> str:
+        """
+        根据试运行结构生成动态提示词
+
+        wire_format 为 compact 时列标题已由画像确定，要求模型省略列标题行、以制表符分隔且不加引号
+        """
         headers_str = " | ".join(profile.headers)
         notes_str = "\n".join(profile.column_notes) if profile.column_notes else "（无）"
         row_rules = "\n".join(profile.row_rules) if profile.row_rules else "（无）"
         output_rules = "\n".join(profile.output_rules) if profile.output_rules else "（无）"
 
+        if wire_format == WIRE_COMPACT:
+            prompt = f"""请严格识别图片中的主表格数据，并按紧凑格式输出。
+列数：{profile.column_count} 列
+列顺序（不要输出列标题行）：{headers_str}
+
+列说明：
+{notes_str}
+
+行/记录规则：
+{row_rules}
+
+输出规则：
+{output_rules}
+
+强制要求：
+1. 只输出数据行，不要列标题，不要Markdown，不要解释。
+2. 每行一条记录，单元格之间用一个制表符（Tab）分隔，不加引号；单元格内的制表符和换行改为空格。
+3. 每行必须恰好 {profile.column_count} 个单元格，空单元格也要保留分隔符，不得增删列。
+4. 保持原始内容，不翻译、不推断。"""
+            if retry_note:
+                prompt += f"\n\n重试要求：{retry_note}"
+            return prompt
+
         prompt = f"""请严格识别图片中的主表格数据，并输出CSV文本。
 列数：{profile.column_count} 列
 列标题（第一行必须严格一致）：{headers_str}
@@ -388,138 +1051,833 @@ Please revise the JSON profile to satisfy the feedback while matching the image.
 
         return prompt
 
-    def generate_prompt_profile(self, image_path: str, max_retries: int = 2) -> Optional[PromptProfile]:
-        """基于试运行图片生成结构化PromptProfile"""
-        user_prompt = self._build_profile_user_prompt()
+    def _validate_csv(self, content: str, column_count: int) -> Tuple[Optional[str], Optional[str]]:
+        """清理并校验模型返回的CSV（见 CSVParser.validate），返回: (csv_text, error_message)"""
+        return CSVParser.validate(content, column_count)
+
+    def _build_user_prompt_with_headers(self, expected_headers: List[str], attempt: int = 0) -> str:
+        """构建使用预定义列标题的用户提示词"""
+        expected_column_count = len(expected_headers)
+        headers_str = " | ".join(expected_headers)
 
-        for attempt in range(max_retries):
-            success, content = self._call_api(
-                image_path,
+        user_prompt = f"""请识别这张图片中的表格数据。
+
+任务目标：将图片中的数据原封不动地提取为CSV格式。
+
+输出要求：
+- 列数：{expected_column_count} 列
+- 列标题（第一行）：{headers_str}
+
+数据提取规则：
+1. 从左到右扫描图片，识别所有数据列
+2. 根据数据之间的视觉间隙划分列（手写数据可能没有网格线）
+3. 将识别出的每一列数据，按顺序填入对应的列标题下
+4. 第一行输出指定的列标题
+5. 从第二行开始，按行输出数据
+
+**提取原则（核心）：**
+- 看到什么提取什么，不做任何理解、判断或解释
+- 不要猜测或推断数据含义
+- 不要修改、翻译或美化原始内容
+- 纯粹的数据搬运：图片中的内容 → CSV格式
+- 确保每一列都被识别到，按从左到右的顺序
+
+**精度要求：**
+- 逐个单元格仔细识别
+- 即使内容模糊、字迹较轻，也要尽可能识别
+- 数字、符号要特别准确（小数点、负号、%等）
+- 只有单元格完全空白时才留空
+- 每一行都必须有 {expected_column_count} 列数据
+
+输出格式：纯CSV文本，不添加任何标记或说明"""
+
+        if attempt > 0:
+            user_prompt += f"\n\n重试：必须是 {expected_column_count} 列，列标题为：{headers_str}。\n提醒：\n1)从左到右识别所有列\n2)每行必须有 {expected_column_count} 列\n3)不要遗漏任何列的数据"
+
+        return user_prompt
+
+    def _build_repair_prompt(self, headers: List[str], bad_rows: List[Tuple[int, List[str]]],
+                             column_count: int) -> str:
+        """构建纯文本修复请求的提示词"""
+        lines = [
+            f"第{line_no}行（当前{len(row)}列）：{CSVParser.format_row(row)}"
+            for line_no, row in bad_rows
+        ]
+        rows_text = "\n".join(lines)
+        return f"""表头（共{column_count}列）：
+{CSVParser.format_row(headers)}
+
+以下行的列数不正确：
+{rows_text}
+
+请按原顺序逐行输出修正后的这{len(bad_rows)}行，每行必须恰好{column_count}列，只输出CSV行。"""
+
+    async def _repair_csv(self, content: str, column_count: int) -> Tuple[Optional[str], Optional[str]]:
+        """
+        修复列数错误的CSV：先做本地启发式修复，仍有问题行时发送纯文本修复请求（不重传图片）
+
+        表头列数错误或问题行过多时放弃修复，由调用方回退到整图重试。
+
+        返回: (csv_text, error_message)
+        """
+        if not TEXT_REPAIR_ENABLED:
+            return None, "修复未启用"
+
+        headers, rows, parse_error = CSVParser.parse(CSVParser.clean_markdown(content))
+        if parse_error or len(headers) != column_count:
+            return None, "表头错误，无法局部修复"
+
+        rows = CSVRepair.fix_rows(rows, column_count)
+        bad_rows = [(idx, row) for idx, row in enumerate(rows, start=2) if len(row) != column_count]
+        if not bad_rows:
+            self.stats.local_repairs += 1
+            print("  [REPAIR] 本地修复成功")
+            return CSVParser.to_csv(headers, rows), None
+
+        if len(bad_rows) > TEXT_REPAIR_MAX_ROWS:
+            return None, f"问题行过多（{len(bad_rows)}行），放弃局部修复"
+
+        scope_token = _response_scope.set("repair")
+        try:
+            result = await self.async_call_api(
+                None,
+                self._build_repair_prompt(headers, bad_rows, column_count),
+                system_prompt=REPAIR_SYSTEM_PROMPT
+            )
+        finally:
+            _response_scope.reset(scope_token)
+        if not result.success:
+            return None, result.content
+
+        fixed_rows, parse_error = CSVParser.parse_rows(CSVParser.clean_markdown(result.content))
+        if parse_error:
+            return None, f"修复结果解析失败: {parse_error}"
+        if len(fixed_rows) != len(bad_rows) or any(len(row) != column_count for row in fixed_rows):
+            return None, "修复结果的行数或列数不符"
+
+        for (line_no, _), fixed in zip(bad_rows, fixed_rows):
+            rows[line_no - 2] = fixed
+        self.stats.text_repairs += 1
+        print(f"  [REPAIR] 纯文本修复成功（{len(bad_rows)}行）")
+        return CSVParser.to_csv(headers, rows), None
+
+    @staticmethod
+    def _build_continuation_note(row_count: int, tail: List[List[str]], compact: bool = False) -> str:
+        """续写请求追加到提示词末尾的说明（compact 时按紧凑格式展示最后几行）"""
+        format_row = CompactTableParser.format_row if compact else CSVParser.format_row
+        tail_text = "\n".join(format_row(row) for row in tail) or "（无）"
+        done = f"{row_count}行数据" if compact else f"列标题和{row_count}行数据"
+        return f"""
+
+续写说明：上一次输出因长度限制被截断，已完整输出{done}，最后几行为：
+{tail_text}
+请从紧接其后的下一行开始，继续输出剩余的数据行。
+1. 不要输出列标题，不要重复已输出的行。
+2. 没有剩余数据时输出空内容。"""
+
+    async def _continue_csv(self, image: Union[PreparedImage, List[PreparedImage]], user_prompt: str,
+                            system_prompt: Optional[str], expected_columns: int,
+                            content: str, compact_headers: Optional[List[str]] = None) -> ApiResult:
+        """保留截断输出中完整的行，请模型从下一行续写并拼接，直到输出完整或达到续写次数上限"""
+        headers, rows, parse_error = CSVParser.parse(
+            CSVParser.drop_partial_line(CSVParser.clean_markdown(content))
+        )
+        if parse_error or not headers:
+            return ApiResult(False, "输出在表头处被截断，无法续写", error_kind=ERROR_CONTENT)
+
+        normalized_headers = [cell.strip() for cell in headers]
+        for _ in range(TRUNCATION_MAX_CONTINUATIONS):
+            self.stats.continuations += 1
+            print(f"  [TRUNCATED] 输出被截断，从第{len(rows) + 1}行数据续写")
+            scope_token = _response_scope.set("continuation")
+            try:
+                result = await self.async_call_api(
+                    image,
+                    user_prompt + self._build_continuation_note(len(rows), rows[-3:], compact=bool(compact_headers)),
+                    system_prompt=system_prompt,
+                    expected_columns=expected_columns,
+                    compact_headers=compact_headers,
+                    has_header=False
+                )
+            finally:
+                _response_scope.reset(scope_token)
+            if not result.success:
+                return result
+
+            chunk = CSVParser.clean_markdown(result.content)
+            if result.truncated:
+                chunk = CSVParser.drop_partial_line(chunk)
+            more, parse_error = CSVParser.parse_rows(chunk)
+            if parse_error:
+                return ApiResult(False, f"续写结果解析失败: {parse_error}", error_kind=ERROR_CONTENT)
+            if more and [cell.strip() for cell in more[0]] == normalized_headers:
+                more = more[1:]
+
+            # 模型可能重新输出截断前的最后一行，只去掉与之完全相同的开头一行
+            if more and rows and [cell.strip() for cell in more[0]] == [cell.strip() for cell in rows[-1]]:
+                more = more[1:]
+            rows = rows + more
+            if not result.truncated:
+                return ApiResult(True, CSVParser.to_csv(headers, rows), status_code=200,
+                                 finish_reason=result.finish_reason)
+
+        return ApiResult(False, f"续写{TRUNCATION_MAX_CONTINUATIONS}次后输出仍被截断", error_kind=ERROR_CONTENT)
+
+    async def _complete_truncated(self, image: Union[PreparedImage, List[PreparedImage]], user_prompt: str,
+                                  system_prompt: Optional[str], expected_columns: Optional[int],
+                                  result: ApiResult, response_schema: Optional[dict] = None,
+                                  compact_headers: Optional[List[str]] = None) -> ApiResult:
+        """
+        处理因 max_tokens 被截断的输出，避免用同样的上限重试再次撞墙
+
+        - 单表CSV识别（已知期望列数）：从最后一个完整行续写
+        - 其他请求（画像JSON、多图合并等）：提高 max_tokens 重发，不超过 MAX_TOKENS_CEILING
+
+        返回: 补全后的 ApiResult；无法补全时返回内容错误，由调用方按重试策略处理
+        """
+        self.stats.truncations += 1
+        if expected_columns:
+            return await self._continue_csv(image, user_prompt, system_prompt, expected_columns, result.content,
+                                            compact_headers)
+
+        max_tokens = self.max_tokens
+        while result.truncated:
+            if max_tokens >= MAX_TOKENS_CEILING:
+                return ApiResult(False, f"输出达到max_tokens上限（{MAX_TOKENS_CEILING}）仍被截断",
+                                 error_kind=ERROR_CONTENT)
+            max_tokens = min(MAX_TOKENS_CEILING, max_tokens * 2)
+            self.stats.continuations += 1
+            print(f"  [TRUNCATED] 输出被截断，提高max_tokens至{max_tokens}后重发")
+            result = await self.async_call_api(
+                image,
                 user_prompt,
-                system_prompt=PROFILE_SYSTEM_PROMPT
+                system_prompt=system_prompt,
+                max_tokens=max_tokens,
+                response_schema=response_schema
             )
-            if not success:
-                if attempt == max_retries - 1:
-                    print(f"[ERROR] Profile generation failed: {content}")
-                continue
+        return result
 
-            profile = self._parse_profile_response(content)
-            if profile:
-                return profile
+    async def _hedged_call(self, image: Union[PreparedImage, List[PreparedImage]], user_prompt: str,
+                           system_prompt: Optional[str], expected_columns: Optional[int],
+                           accept: Callable[[ApiResult], bool],
+                           response_schema: Optional[dict] = None,
+                           compact_headers: Optional[List[str]] = None) -> ApiResult:
+        """
+        发送请求；配置了备用模型时：
+        - 主接口已熔断：直接发给备用模型
+        - 启用对冲且主请求超过观测P95延迟仍未返回：向备用模型发送相同请求，取先返回的合格结果，取消另一个
+        """
+        def call(processor: "OCRProcessor") -> Awaitable[ApiResult]:
+            return processor.async_call_api(
+                image,
+                user_prompt,
+                system_prompt=system_prompt,
+                expected_columns=expected_columns,
+                response_schema=response_schema,
+                compact_headers=compact_headers
+            )
 
-        return None
+        backup_processor = self.hedge_to
+        if backup_processor is None:
+            return await call(self)
 
-    def refine_prompt_profile(
+        if self.endpoint.breaker.is_open and not backup_processor.endpoint.breaker.is_open:
+            self.stats.circuit_rejections += 1
+            print(f"  [HEDGE] {self.provider} 已熔断，改用备用模型 {backup_processor.model}")
+            return await call(backup_processor)
+
+        if not self.hedge_policy.enabled:
+            return await call(self)
+
+        delay = self.hedge_policy.delay(self.endpoint.latency)
+        primary = asyncio.ensure_future(call(self))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done or backup_processor.endpoint.breaker.is_open:
+            return await primary
+
+        self.stats.hedged_requests += 1
+        print(f"  [HEDGE] 请求超过{delay:.1f}秒未返回，向备用模型 {backup_processor.model} 发送对冲请求")
+        backup = asyncio.ensure_future(call(backup_processor))
+        pending = {primary, backup}
+        results = {}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if accept(result):
+                        if future is backup:
+                            self.stats.hedge_wins += 1
+                        return result
+                    results[future] = result
+            # 两个结果都不合格时以主请求的结果为准
+            return results[primary]
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _call_with_retries(
         self,
-        image_path: str,
-        base_profile: PromptProfile,
-        feedback_text: str,
-        max_retries: int = 2
-    ) -> Optional[PromptProfile]:
-        """Refine an existing prompt profile using user feedback."""
-        if not feedback_text or not feedback_text.strip():
-            return base_profile
+        image: Union[PreparedImage, List[PreparedImage]],
+        build_prompt: Callable[[int], str],
+        validate: Callable[[str], Tuple[Any, Optional[str]]],
+        max_retries: int = 3,
+        system_prompt: Optional[str] = None,
+        expected_columns: Optional[int] = None,
+        label: str = "API调用",
+        repair: Optional[Callable[[str], Awaitable[Tuple[Any, Optional[str]]]]] = None,
+        response_schema: Optional[dict] = None,
+        compact_headers: Optional[List[str]] = None
+    ) -> Tuple[Any, Optional[str]]:
+        """
+        按重试策略调用API并校验结果
 
-        user_prompt = self._build_feedback_profile_prompt(base_profile, feedback_text)
-        for attempt in range(max_retries):
-            success, content = self._call_api(
-                image_path,
+        - 内容错误（解析/列数不符）：最多尝试 max_retries 次，立即用新提示词重试
+        - 传输错误（429/5xx/超时）：单独计数，按指数退避+抖动等待，遵守 Retry-After
+        - 致命错误（鉴权失败、参数错误等）：不重试
+        - 输出被 max_tokens 截断：先续写或提高上限补全，而不是原样重试
+        - 配置了备用模型时按对冲策略发送请求（见 _hedged_call）
+        - 每次重试都消耗任务级重试预算
+
+        Args:
+            build_prompt: 根据内容尝试序号（从0开始）构建用户提示词
+            validate: 校验模型输出，返回 (结果, 错误信息)，结果为None表示内容不合格
+            label: 日志中的操作名称
+            repair: 内容不合格时在整图重试前尝试的低成本修复，返回值同 validate
+            response_schema: 期望的输出结构（见 async_call_api），不支持的提供商按文本输出由 validate 解析
+            compact_headers: 紧凑格式输出的列标题（见 async_call_api），validate 与 repair 收到的是转换后的标准CSV
+
+        返回: (结果, 错误信息)
+        """
+        content_attempt = 0
+        transport_retries = 0
+
+        while True:
+            user_prompt = build_prompt(content_attempt)
+            result = await self._hedged_call(
+                image,
                 user_prompt,
-                system_prompt=PROFILE_FEEDBACK_SYSTEM_PROMPT
+                system_prompt,
+                expected_columns,
+                lambda candidate: candidate.success and (
+                    candidate.truncated or validate(candidate.content)[0] is not None
+                ),
+                response_schema=response_schema,
+                compact_headers=compact_headers
             )
-            if not success:
-                if attempt == max_retries - 1:
-                    print(f"[ERROR] Profile refine failed: {content}")
-                continue
+            if result.truncated:
+                result = await self._complete_truncated(
+                    image, user_prompt, system_prompt, expected_columns, result, response_schema,
+                    compact_headers
+                )
 
-            profile = self._parse_profile_response(content)
-            if profile:
-                return profile
+            if result.success:
+                value, error = validate(result.content)
+                if value is not None:
+                    return value, None
+                if repair:
+                    value, _ = await repair(result.content)
+                    if value is not None:
+                        return value, None
+                kind = ERROR_CONTENT
+            else:
+                error = result.content
+                kind = result.error_kind or ERROR_TRANSPORT
+
+            if kind == ERROR_FATAL and result.status_code in (401, 403) and self.key_pool.available_count() > 0:
+                # 单个密钥失效（已被密钥池停用），其他密钥仍可用
+                kind = ERROR_TRANSPORT
+
+            if kind == ERROR_FATAL:
+                print(f"  [ERROR] {label}失败（不可重试）: {error}")
+                _record_failure(kind)
+                return None, error
+
+            if kind == ERROR_CONTENT:
+                self.stats.content_errors += 1
+                content_attempt += 1
+                if content_attempt >= max_retries:
+                    print(f"  [ERROR] {label}失败: {error}")
+                    _record_failure(kind)
+                    return None, error
+                delay = self.retry_policy.content_retry_delay
+            else:
+                self.stats.transport_errors += 1
+                if transport_retries >= self.retry_policy.max_transport_retries:
+                    print(f"  [ERROR] {label}失败: {error}")
+                    _record_failure(kind)
+                    return None, error
+                delay = self.retry_policy.transport_delay(transport_retries, result.retry_after)
+                if result.status_code in (401, 403, 429) and self.key_pool.available_count() > 0:
+                    # 被限流/停用的密钥已移出轮询，立即换用其他密钥重试
+                    delay = 0.0
+                transport_retries += 1
+
+            if not self.retry_budget.try_consume():
+                print(f"  [ERROR] {label}失败（任务重试预算已用尽）: {error}")
+                _record_failure(kind)
+                return None, error
+
+            self.stats.retries += 1
+            if delay > 0:
+                print(f"  [RETRY] {error}，{delay:.1f}秒后重试...")
+                await asyncio.sleep(delay)
+            else:
+                print(f"  [RETRY] {error}，重试中...")
 
-        return None
+    async def _prepare_bands(self, image: PreparedImage,
+                             box: Optional[Tuple[int, int, int, int]] = None) -> List[PreparedImage]:
+        """按分条配置切分页面（box 为版面分析裁剪出的区域），不需要分条或切分失败时返回空列表"""
+        if not self.tiling.enabled:
+            return []
+        try:
+            return await asyncio.to_thread(prepare_image_bands, image, self.preprocess, self.tiling, box)
+        except Exception as e:
+            print(f"  [WARN] 图片分条失败，按整页识别: {e}")
+            return []
+
+    def _analyze_layout(self, image: PreparedImage,
+                        column_count: int) -> Tuple[PreparedImage, Optional[TableLayout]]:
+        """版面分析：返回 (裁剪出表格区域后的图片, 版面)，未启用或未检测到时返回原图和None"""
+        with open(image.path, "rb") as f:
+            original = f.read()
+        layout = analyze_layout(original, self.layout, column_count, self.preprocess.fix_orientation)
+        if layout is None or layout.box is None:
+            return image, layout
+        return prepare_image_crop(image, layout.box, self.preprocess), layout
+
+    @staticmethod
+    def _build_layout_note(layout: TableLayout) -> str:
+        """版面分析结果追加到提示词末尾的说明"""
+        lines = []
+        if layout.box is not None:
+            lines.append("图片已在本地裁掉页边距和标题，只保留表格区域。")
+        if layout.column_bounds:
+            bounds = "、".join(f"{bound:.0%}" for bound in layout.column_bounds)
+            lines.append(f"本地版面分析检测到表格共{layout.column_count}列，"
+                         f"列分隔位置约在图片宽度的 {bounds} 处（从左到右），请据此划分各列。")
+        if not lines:
+            return ""
+        return "\n\n版面说明：" + "\n".join(lines)
+
+    @staticmethod
+    def _build_band_note(index: int, count: int, compact: bool = False) -> str:
+        """分条识别时追加到提示词末尾的说明"""
+        if compact:
+            return f"""
+
+分条说明：这张图片是整页表格自上而下切分出的第{index}/{count}个水平条带，与相邻条带有少量重叠。
+1. 只输出本条带中完整可见的数据行；被上下边缘截断的行不要输出。
+2. 本条带中没有数据行时输出空内容。"""
+        return f"""
+
+分条说明：这张图片是整页表格自上而下切分出的第{index}/{count}个水平条带，与相邻条带有少量重叠。
+1. 第一行仍然输出完整的列标题。
+2. 只输出本条带中完整可见的数据行；被上下边缘截断的行不要输出。
+3. 本条带中没有数据行时只输出列标题。"""
+
+    async def _recognize_table(self, image: PreparedImage, build_prompt: Callable[[int], str],
+                               column_count: int, max_retries: int = 3,
+                               compact_headers: Optional[List[str]] = None) -> Optional[str]:
+        """
+        识别图片中的表格，返回校验通过的CSV文本
 
-    def process_image_with_profile(self, image_path: str, profile: PromptProfile,
-                                   max_retries: int = 3) -> Optional[str]:
+        启用分条且页面足够高时，把页面切成重叠的水平条带并发识别，再按顺序拼接并去除重叠行；
+        每个条带独立重试，某个条带最终失败时回退到整页识别。
+        启用版面分析时先裁出表格区域，并把检测到的列数与列边界追加到提示词。
+        启用自适应精度且页面简单时，先以低精度整页识别一次，校验失败再按高精度走上述流程。
+        build_prompt 要求紧凑格式输出时需传入 compact_headers。
         """
-        使用试运行生成的结构化提示词识别图片
-        Returns:
-            CSV文本或None
+        async def recognize(target: PreparedImage, prompt_builder: Callable[[int], str],
+                            label: str, attempts: int = max_retries) -> Optional[str]:
+            csv_text, _ = await self._call_with_retries(
+                target,
+                prompt_builder,
+                lambda content: self._validate_csv(content, column_count),
+                max_retries=attempts,
+                expected_columns=column_count,
+                label=label,
+                repair=lambda content: self._repair_csv(content, column_count),
+                compact_headers=compact_headers
+            )
+            return csv_text
+
+        layout = None
+        if self.layout.enabled:
+            image, layout = await asyncio.to_thread(self._analyze_layout, image, column_count)
+        if layout is not None:
+            if layout.box is not None:
+                self.stats.layout_crops += 1
+            if layout.column_bounds:
+                self.stats.layout_columns += 1
+            layout_note = self._build_layout_note(layout)
+            page_prompt = build_prompt
+            build_prompt = lambda attempt: page_prompt(attempt) + layout_note
+
+        detail = await asyncio.to_thread(self.detail.choose, image, column_count)
+        if detail == DETAIL_LOW:
+            low_image = await asyncio.to_thread(with_detail, image, DETAIL_LOW, self.detail, self.preprocess)
+            csv_text = await recognize(low_image, build_prompt, "低精度识别", attempts=1)
+            if csv_text:
+                self.stats.low_detail_pages += 1
+                return csv_text
+            self.stats.detail_upgrades += 1
+            print(f"  [DETAIL] 低精度识别未通过校验，升级为高精度: {os.path.basename(image.path)}")
+        if detail:
+            image = with_detail(image, DETAIL_HIGH, self.detail, self.preprocess)
+
+        bands = await self._prepare_bands(image, layout.box if layout else None)
+        if not bands:
+            return await recognize(image, build_prompt, "识别")
+
+        count = len(bands)
+        print(f"  [DEBUG] 分{count}个条带并发识别: {os.path.basename(image.path)}")
+
+        def band_prompt(index: int) -> Callable[[int], str]:
+            note = self._build_band_note(index, count, compact=bool(compact_headers))
+            return lambda attempt: build_prompt(attempt) + note
+
+        async def recognize_band(band: PreparedImage, index: int) -> Optional[str]:
+            _response_scope.set("band")  # 每个条带在独立的任务中运行，不影响调用方
+            return await recognize(band, band_prompt(index), f"条带{index}/{count}识别")
+
+        results = await asyncio.gather(*(
+            recognize_band(band, idx) for idx, band in enumerate(bands, start=1)
+        ))
+        if any(csv_text is None for csv_text in results):
+            print("  [WARN] 部分条带识别失败，回退到整页识别")
+            return await recognize(image, build_prompt, "识别")
+
+        parsed = [CSVParser.parse(csv_text) for csv_text in results]
+        headers = parsed[0][0]
+        parts = [band_rows for _, band_rows, _ in parsed]
+        windows = TableStitcher.overlap_windows(parts, self.tiling.band_spans(count))
+        rows, removed = TableStitcher.stitch(parts, windows)
+        self.stats.tiled_pages += 1
+        self.stats.stitched_overlap_rows += removed
+        print(f"  [DEBUG] 条带拼接完成：{len(rows)}行，去除重叠{removed}行")
+        return CSVParser.to_csv(headers, rows)
+
+    @staticmethod
+    def _build_batch_note(count: int, compact: bool = False) -> str:
+        """多图合并请求时追加到提示词末尾的说明"""
+        if compact:
+            return f"""
+
+多图说明：本次请求包含{count}张图片，每张图片前有“图片N”编号。
+1. 按编号顺序分别识别每张图片，各自按上述紧凑格式输出数据行。
+2. 每张图片的输出之前单独输出一行分隔标记，格式为：=== 图片N ===
+3. 不同图片的数据不得合并或混排；某张图片没有数据行时只输出分隔标记。"""
+        return f"""
+
+多图说明：本次请求包含{count}张图片，每张图片前有“图片N”编号。
+1. 按编号顺序分别识别每张图片，各自输出一份完整的CSV（含列标题）。
+2. 每份CSV之前单独输出一行分隔标记，格式为：=== 图片N ===
+3. 不同图片的数据不得合并或混排；某张图片没有数据行时只输出列标题。"""
+
+    @staticmethod
+    def _split_batch_sections(content: str, count: int) -> Dict[int, str]:
+        """按分隔标记把合并请求的输出切分为 {图片编号: CSV文本}"""
+        sections = {}
+        matches = list(BATCH_SECTION_PATTERN.finditer(content))
+        for pos, match in enumerate(matches):
+            index = int(match.group(1))
+            end = matches[pos + 1].start() if pos + 1 < len(matches) else len(content)
+            if 1 <= index <= count and index not in sections:
+                sections[index] = content[match.end():end]
+        return sections
+
+    async def _recognize_batch(self, images: List[PreparedImage], build_prompt: Callable[[int], str],
+                               column_count: int, max_retries: int = 3,
+                               compact_headers: Optional[List[str]] = None,
+                               responses: Optional[List[list]] = None,
+                               failure_logs: Optional[List[list]] = None) -> List[Optional[str]]:
+        """
+        在一个请求中识别多张小图，按分隔标记拆回每张图片的CSV
+
+        合并请求只尝试一次内容校验（传输错误仍按策略重试）；缺失或不合格的输出段先做局部修复，
+        仍失败的图片回退为单张识别。
+        传入 responses（每张图片一个列表）时，每次合并请求（含未通过校验的尝试）的响应按图片拆分后记入各自的列表
+        （token用量按图片数整除均摊，余数记入第一张；缺少该图片输出段时内容为空），输出段的修复请求记入对应图片的列表。
+        传入 failure_logs（每张图片一个列表）时，回退为单张识别后仍失败的图片的失败原因记入各自的列表。
+        """
+        count = len(images)
+        note = self._build_batch_note(count, compact=bool(compact_headers))
+
+        def validate(content: str) -> Tuple[Optional[Dict[int, str]], Optional[str]]:
+            sections = self._split_batch_sections(content, count)
+            if not sections:
+                return None, "未找到按图片分隔的输出"
+            return sections, None
+
+        batch_log = [] if responses is not None else None
+        log_token = _response_log.set(batch_log)
+        scope_token = _response_scope.set("batch")
+        try:
+            sections, _ = await self._call_with_retries(
+                images,
+                lambda attempt: build_prompt(attempt) + note,
+                validate,
+                max_retries=1,
+                label=f"合并识别（{count}张）"
+            )
+        finally:
+            _response_scope.reset(scope_token)
+            _response_log.reset(log_token)
+        self.stats.batch_requests += 1
+
+        for entry in batch_log or []:
+            attempt_sections = self._split_batch_sections(entry["content"], count)
+            for index in range(1, count + 1):
+                responses[index - 1].append(dict(
+                    entry,
+                    content=attempt_sections.get(index, ""),
+                    usage={
+                        name: value // count + (value % count if index == 1 else 0)
+                        if isinstance(value, int) else value
+                        for name, value in entry["usage"].items()
+                    },
+                    batch_size=count
+                ))
+
+        results: List[Optional[str]] = []
+        for index in range(1, count + 1):
+            section = (sections or {}).get(index)
+            csv_text = None
+            if section is not None:
+                if compact_headers:
+                    section = CompactTableParser.to_csv(section, compact_headers)
+                csv_text, _ = self._validate_csv(section, column_count)
+                if csv_text is None:
+                    log_token = _response_log.set(responses[index - 1] if responses is not None else None)
+                    try:
+                        csv_text, _ = await self._repair_csv(section, column_count)
+                    finally:
+                        _response_log.reset(log_token)
+            results.append(csv_text)
+
+        self.stats.batched_images += sum(1 for csv_text in results if csv_text)
+        fallback = [idx for idx, csv_text in enumerate(results) if csv_text is None]
+        if fallback:
+            print(f"  [WARN] 合并识别中{len(fallback)}张图片输出不合格，改为单张识别")
+            retried = await asyncio.gather(*(
+                self._recognize_logged(responses[idx] if responses is not None else None, images[idx],
+                                       build_prompt, column_count, max_retries, compact_headers,
+                                       failure_logs[idx] if failure_logs is not None else None)
+                for idx in fallback
+            ))
+            for idx, csv_text in zip(fallback, retried):
+                results[idx] = csv_text
+        return results
+
+    async def _recognize_local(self, image: PreparedImage, headers: List[str]) -> Optional[str]:
+        """用本地OCR识别网格表格，未通过列数/置信度校验时返回None"""
+        table_data, error = await asyncio.to_thread(self.local_recognizer.recognize, image.path, headers)
+        if table_data is None:
+            self.stats.local_fallbacks += 1
+            print(f"  [LOCAL] 本地识别未通过（{error}），改用大模型: {os.path.basename(image.path)}")
+            return None
+        self.stats.local_pages += 1
+        print(f"  [LOCAL] 本地识别成功：{len(table_data.rows)}行 {os.path.basename(image.path)}")
+        return CSVParser.to_csv(table_data.headers, table_data.rows)
+
+    async def _recognize_logged(self, response_log: Optional[list], image: PreparedImage,
+                                build_prompt: Callable[[int], str], column_count: int, max_retries: int = 3,
+                                compact_headers: Optional[List[str]] = None,
+                                failure_log: Optional[list] = None) -> Optional[str]:
+        """识别单张图片，期间成功的API响应记入 response_log、失败原因记入 failure_log（为None时不记录）"""
+        log_token = _response_log.set(response_log)
+        failure_token = _failure_log.set(failure_log)
+        try:
+            return await self._recognize_table(image, build_prompt, column_count, max_retries, compact_headers)
+        finally:
+            _failure_log.reset(failure_token)
+            _response_log.reset(log_token)
+
+    async def _process_images(self, image_paths: List[ImageInput], build_prompt: Callable[[int], str],
+                              column_count: int, max_retries: int = 3,
+                              compact_headers: Optional[List[str]] = None,
+                              headers: Optional[List[str]] = None,
+                              responses: Optional[List[list]] = None,
+                              failures: Optional[List[Optional[str]]] = None) -> List[Optional[str]]:
+        """
+        识别一组图片：先查结果缓存，再尝试本地OCR（已启用且给出 headers 时），
+        剩余图片超过一张时合并为一个请求，否则单张识别
+        （build_prompt 要求紧凑格式输出时需传入 compact_headers，结果与缓存仍为标准CSV）
+
+        responses: 可选，与 image_paths 等长的列表的列表；识别每张图片时成功的原始API响应
+                   （内容、模型、提示词哈希、token用量）追加到对应列表中，缓存命中与本地OCR没有记录
+        failures: 可选，与 image_paths 等长的列表；识别失败的图片写入最终的错误类型
+                  （ERROR_CONTENT / ERROR_TRANSPORT / ERROR_FATAL），供调用方区分内容不合格与接口故障
+
+        返回: 与 image_paths 顺序一致的CSV文本列表（失败为None）
         """
-        for attempt in range(max_retries):
+        images = list(await asyncio.gather(*(self.async_prepare_image(path) for path in image_paths)))
+        # 缓存键只取决于单张图片和首次提示词，合并识别与单张识别的结果可以互相复用
+        cache_keys = [self._result_cache_key(image, build_prompt(0)) for image in images]
+        results = [self._cache_lookup(cache_key) for cache_key in cache_keys]
+
+        pending = [idx for idx, csv_text in enumerate(results) if not csv_text]
+        if self.local_recognizer and headers and pending:
+            # 本地结果不写入缓存：重新识别的成本很低，且不应以大模型的缓存键保存
+            local = await asyncio.gather(*(self._recognize_local(images[idx], headers) for idx in pending))
+            for idx, csv_text in zip(pending, local):
+                results[idx] = csv_text
+            pending = [idx for idx in pending if not results[idx]]
+
+        failure_logs = [[] for _ in pending]
+        if len(pending) == 1:
+            recognized = [await self._recognize_logged(
+                responses[pending[0]] if responses is not None else None,
+                images[pending[0]], build_prompt, column_count, max_retries, compact_headers, failure_logs[0]
+            )]
+        elif pending:
+            recognized = await self._recognize_batch(
+                [images[idx] for idx in pending], build_prompt, column_count, max_retries, compact_headers,
+                [responses[idx] for idx in pending] if responses is not None else None,
+                failure_logs
+            )
+        else:
+            recognized = []
+
+        for idx, csv_text, failure_log in zip(pending, recognized, failure_logs):
+            results[idx] = csv_text
+            if csv_text:
+                self._cache_store(cache_keys[idx], csv_text)
+            elif failures is not None:
+                failures[idx] = failure_log[-1] if failure_log else None
+        return results
+
+    def _profile_prompt_builder(self, profile: PromptProfile) -> Callable[[int], str]:
+        """画像识别的提示词构建函数（重试时追加列数提醒），输出格式取自 self.wire_format"""
+        def build_prompt(attempt: int) -> str:
             retry_note = ""
             if attempt > 0:
                 retry_note = "请严格按照列数与列标题输出，保持每行列数一致。"
+            return self._build_user_prompt_from_profile(profile, retry_note=retry_note,
+                                                        wire_format=self.wire_format)
+        return build_prompt
 
-            user_prompt = self._build_user_prompt_from_profile(profile, retry_note=retry_note)
-            success, content = self._call_api(image_path, user_prompt)
+    def _profile_compact_headers(self, profile: PromptProfile) -> Optional[List[str]]:
+        """画像识别使用紧凑格式时返回画像的列标题，否则返回None"""
+        return profile.headers if self.wire_format == WIRE_COMPACT else None
 
-            if not success:
-                if attempt == max_retries - 1:
-                    print(f"  [ERROR] API调用失败: {content}")
-                continue
+    async def async_plan_batches(self, image_paths: List[ImageInput]) -> List[List[int]]:
+        """
+        按小图合并配置把图片分组，未启用时每张图片单独成组
 
-            csv_text = CSVParser.clean_markdown(content)
-            headers, rows, parse_error = CSVParser.parse(csv_text)
+        返回: 每组图片在 image_paths 中的下标列表（保持原始顺序）
+        """
+        if not self.batching.enabled:
+            return [[idx] for idx in range(len(image_paths))]
+        images = await asyncio.gather(*(self.async_prepare_image(path) for path in image_paths))
+        return plan_batches(list(images), self.batching)
 
-            if parse_error:
-                if attempt == max_retries - 1:
-                    print(f"  [ERROR] CSV解析失败: {parse_error}")
-                continue
+    # ==================== 异步接口 ====================
 
-            if len(headers) != profile.column_count:
-                if attempt < max_retries - 1:
-                    print(f"  [RETRY] 列数不匹配，期望{profile.column_count}列，实际{len(headers)}列")
-                    continue
-                return None
+    async def async_generate_prompt_profile(self, image_path: ImageInput,
+                                            max_retries: int = 2) -> Optional[PromptProfile]:
+        """基于试运行图片生成结构化PromptProfile（异步）"""
+        image = await self.async_prepare_image(image_path)
+        user_prompt = self._build_profile_user_prompt()
 
-            for idx, row in enumerate(rows, start=2):
-                if len(row) != profile.column_count:
-                    if attempt < max_retries - 1:
-                        print(f"  [RETRY] 第{idx}行列数不匹配，重试中...")
-                        break
-                    return None
+        profile, _ = await self._call_with_retries(
+            image,
+            lambda attempt: user_prompt,
+            self._validate_profile,
+            max_retries=max_retries,
+            system_prompt=PROFILE_SYSTEM_PROMPT,
+            label="画像生成",
+            response_schema=PROFILE_RESPONSE_SCHEMA
+        )
+        return profile
 
-            return csv_text
+    async def async_refine_prompt_profile(
+        self,
+        image_path: ImageInput,
+        base_profile: PromptProfile,
+        feedback_text: str,
+        max_retries: int = 2
+    ) -> Optional[PromptProfile]:
+        """Refine an existing prompt profile using user feedback (async)."""
+        if not feedback_text or not feedback_text.strip():
+            return base_profile
 
-        return None
+        image = await self.async_prepare_image(image_path)
+        user_prompt = self._build_feedback_profile_prompt(base_profile, feedback_text)
 
-    def process_image(self, image_path: str,
-                     max_retries: int = 3) -> Tuple[Optional[TableData], Optional[str]]:
+        profile, _ = await self._call_with_retries(
+            image,
+            lambda attempt: user_prompt,
+            self._validate_profile,
+            max_retries=max_retries,
+            system_prompt=PROFILE_FEEDBACK_SYSTEM_PROMPT,
+            label="画像优化",
+            response_schema=PROFILE_RESPONSE_SCHEMA
+        )
+        return profile
+
+    async def async_process_image_with_profile(self, image_path: ImageInput, profile: PromptProfile,
+                                               max_retries: int = 3) -> Optional[str]:
         """
-        处理单张图片，支持自动重试
+        使用试运行生成的结构化提示词识别图片（异步）
+        Returns:
+            CSV文本或None
+        """
+        results = await self._process_images(
+            [image_path], self._profile_prompt_builder(profile), profile.column_count, max_retries,
+            self._profile_compact_headers(profile), profile.headers
+        )
+        return results[0]
+
+    async def async_process_batch_with_profile(self, image_paths: List[ImageInput], profile: PromptProfile,
+                                               max_retries: int = 3,
+                                               responses: Optional[List[list]] = None,
+                                               failures: Optional[List[Optional[str]]] = None
+                                               ) -> List[Optional[str]]:
+        """
+        使用结构化提示词在一个请求中识别多张小图（异步）
+
+        responses: 可选，按图片收集原始API响应（见 _process_images）
+        failures: 可选，按图片记录失败原因（见 _process_images）
+        Returns:
+            与 image_paths 顺序一致的CSV文本列表（失败为None）
+        """
+        return await self._process_images(
+            image_paths, self._profile_prompt_builder(profile), profile.column_count, max_retries,
+            self._profile_compact_headers(profile), profile.headers, responses, failures
+        )
+
+    async def async_process_image(self, image_path: ImageInput,
+                                  max_retries: int = 3) -> Tuple[Optional[TableData], Optional[str]]:
+        """
+        处理单张图片，支持自动重试（异步）
 
         返回: (TableData, error_message)
         """
-        file_name = os.path.basename(image_path)
-        expected_columns = None
+        image = await self.async_prepare_image(image_path)
+        file_name = os.path.basename(image.path)
+        state = {"expected_columns": None}
 
-        for attempt in range(max_retries):
-            # 构建提示词
-            user_prompt = self._build_user_prompt(
-                image_path,
+        def build_prompt(attempt: int) -> str:
+            return self._build_user_prompt(
+                image.path,
                 retry_count=attempt,
-                expected_columns=expected_columns
+                expected_columns=state["expected_columns"]
             )
 
-            # 调用API
-            success, content = self._call_api(image_path, user_prompt)
-
-            if not success:
-                if attempt == max_retries - 1:
-                    return None, f"API调用失败: {content}"
-                continue
-
-            # 清理响应
+        def validate(content: str) -> Tuple[Optional[TableData], Optional[str]]:
+            # 清理响应并解析CSV
             csv_text = CSVParser.clean_markdown(content)
-
-            # 解析CSV
             headers, rows, parse_error = CSVParser.parse(csv_text)
 
             if parse_error:
-                expected_columns = None  # 重置预期列数
-                if attempt == max_retries - 1:
-                    return None, f"CSV解析失败: {parse_error}"
-                continue
+                state["expected_columns"] = None  # 重置预期列数
+                return None, f"CSV解析失败: {parse_error}"
 
             # 创建表格数据对象
             table_data = TableData(
@@ -532,122 +1890,141 @@ Please revise the JSON profile to satisfy the feedback while matching the image.
 
             # 验证结构
             is_valid, error_msg = TableStructureAnalyzer.validate_structure(table_data)
-
             if not is_valid:
-                expected_columns = len(headers)  # 记录识别出的列数用于下次重试
-                if attempt == max_retries - 1:
-                    return None, f"结构验证失败: {error_msg}"
-                continue
+                state["expected_columns"] = len(headers)  # 记录识别出的列数用于下次重试
+                return None, f"结构验证失败: {error_msg}"
 
-            # 成功
             return table_data, None
 
-        return None, "达到最大重试次数"
+        table_data, error = await self._call_with_retries(
+            image,
+            build_prompt,
+            validate,
+            max_retries=max_retries,
+            label="识别"
+        )
+        return table_data, error
 
-    def process_image_with_headers(self, image_path: str,
-                                   expected_headers: List[str],
-                                   max_retries: int = 3) -> Optional[str]:
+    async def async_process_image_with_headers(self, image_path: ImageInput,
+                                               expected_headers: List[str],
+                                               max_retries: int = 3) -> Optional[str]:
         """
-        处理单张图片，使用预定义的列标题
+        处理单张图片，使用预定义的列标题（异步）
 
         Args:
-            image_path: 图片路径
+            image_path: 图片路径或已准备好的图片
             expected_headers: 预定义的列标题列表
             max_retries: 最大重试次数
 
         Returns:
             CSV文本或None
         """
-        expected_column_count = len(expected_headers)
-        file_name = os.path.basename(image_path)
-
-        # 构建包含列标题的提示
-        headers_str = " | ".join(expected_headers)
+        results = await self.async_process_batch_with_headers([image_path], expected_headers, max_retries)
+        return results[0]
+
+    async def async_process_batch_with_headers(self, image_paths: List[ImageInput],
+                                               expected_headers: List[str],
+                                               max_retries: int = 3,
+                                               responses: Optional[List[list]] = None,
+                                               failures: Optional[List[Optional[str]]] = None
+                                               ) -> List[Optional[str]]:
+        """
+        使用预定义的列标题在一个请求中识别多张小图（异步）
 
-        for attempt in range(max_retries):
-            # 构建特殊的用户提示
-            user_prompt = f"""请识别这张图片中的表格数据。
+        responses: 可选，按图片收集原始API响应（见 _process_images）
+        failures: 可选，按图片记录失败原因（见 _process_images）
+        Returns:
+            与 image_paths 顺序一致的CSV文本列表（失败为None）
+        """
+        # 只检查列数，不检查标题内容，因为OCR可能有误差
+        return await self._process_images(
+            image_paths,
+            lambda attempt: self._build_user_prompt_with_headers(expected_headers, attempt),
+            len(expected_headers),
+            max_retries,
+            headers=expected_headers,
+            responses=responses,
+            failures=failures
+        )
 
-任务目标：将图片中的数据原封不动地提取为CSV格式。
+    # ==================== 同步接口（供脚本使用，内部复用异步实现） ====================
 
-输出要求：
-- 列数：{expected_column_count} 列
-- 列标题（第一行）：{headers_str}
+    def generate_prompt_profile(self, image_path: ImageInput, max_retries: int = 2) -> Optional[PromptProfile]:
+        """基于试运行图片生成结构化PromptProfile"""
+        return _run_sync(self.async_generate_prompt_profile(image_path, max_retries))
 
-数据提取规则：
-1. 从左到右扫描图片，识别所有数据列
-2. 根据数据之间的视觉间隙划分列（手写数据可能没有网格线）
-3. 将识别出的每一列数据，按顺序填入对应的列标题下
-4. 第一行输出指定的列标题
-5. 从第二行开始，按行输出数据
+    def refine_prompt_profile(
+        self,
+        image_path: ImageInput,
+        base_profile: PromptProfile,
+        feedback_text: str,
+        max_retries: int = 2
+    ) -> Optional[PromptProfile]:
+        """Refine an existing prompt profile using user feedback."""
+        return _run_sync(self.async_refine_prompt_profile(
+            image_path, base_profile, feedback_text, max_retries
+        ))
 
-**提取原则（核心）：**
-- 看到什么提取什么，不做任何理解、判断或解释
-- 不要猜测或推断数据含义
-- 不要修改、翻译或美化原始内容
-- 纯粹的数据搬运：图片中的内容 → CSV格式
-- 确保每一列都被识别到，按从左到右的顺序
+    def process_image_with_profile(self, image_path: ImageInput, profile: PromptProfile,
+                                   max_retries: int = 3) -> Optional[str]:
+        """
+        使用试运行生成的结构化提示词识别图片
+        Returns:
+            CSV文本或None
+        """
+        return _run_sync(self.async_process_image_with_profile(image_path, profile, max_retries))
 
-**精度要求：**
-- 逐个单元格仔细识别
-- 即使内容模糊、字迹较轻，也要尽可能识别
-- 数字、符号要特别准确（小数点、负号、%等）
-- 只有单元格完全空白时才留空
-- 每一行都必须有 {expected_column_count} 列数据
+    def process_image(self, image_path: ImageInput,
+                     max_retries: int = 3) -> Tuple[Optional[TableData], Optional[str]]:
+        """
+        处理单张图片，支持自动重试
 
-输出格式：纯CSV文本，不添加任何标记或说明"""
+        返回: (TableData, error_message)
+        """
+        return _run_sync(self.async_process_image(image_path, max_retries))
 
-            if attempt > 0:
-                user_prompt += f"\n\n重试：必须是 {expected_column_count} 列，列标题为：{headers_str}。\n提醒：\n1)从左到右识别所有列\n2)每行必须有 {expected_column_count} 列\n3)不要遗漏任何列的数据"
+    def process_image_with_headers(self, image_path: ImageInput,
+                                   expected_headers: List[str],
+                                   max_retries: int = 3) -> Optional[str]:
+        """
+        处理单张图片，使用预定义的列标题
 
-            # 调用API
-            success, content = self._call_api(image_path, user_prompt)
+        Args:
+            image_path: 图片路径或已准备好的图片
+            expected_headers: 预定义的列标题列表
+            max_retries: 最大重试次数
 
-            if not success:
-                if attempt == max_retries - 1:
-                    print(f"  [ERROR] API调用失败: {content}")
-                continue
+        Returns:
+            CSV文本或None
+        """
+        return _run_sync(self.async_process_image_with_headers(
+            image_path, expected_headers, max_retries
+        ))
 
-            # 清理响应
-            csv_text = CSVParser.clean_markdown(content)
+    def process_batch_with_profile(self, image_paths: List[ImageInput], profile: PromptProfile,
+                                   max_retries: int = 3) -> List[Optional[str]]:
+        """使用结构化提示词在一个请求中识别多张小图"""
+        return _run_sync(self.async_process_batch_with_profile(image_paths, profile, max_retries))
 
-            # 解析CSV
-            headers, rows, parse_error = CSVParser.parse(csv_text)
+    def process_batch_with_headers(self, image_paths: List[ImageInput],
+                                   expected_headers: List[str],
+                                   max_retries: int = 3) -> List[Optional[str]]:
+        """使用预定义的列标题在一个请求中识别多张小图"""
+        return _run_sync(self.async_process_batch_with_headers(
+            image_paths, expected_headers, max_retries
+        ))
 
-            if parse_error:
-                if attempt == max_retries - 1:
-                    print(f"  [ERROR] CSV解析失败: {parse_error}")
-                continue
-
-            # 验证列数
-            if len(headers) != expected_column_count:
-                if attempt < max_retries - 1:
-                    print(f"  [RETRY] 列数不匹配，期望{expected_column_count}列，实际{len(headers)}列，重试中...")
-                    continue
-                else:
-                    print(f"  [ERROR] 列数不匹配: 期望{expected_column_count}列，实际{len(headers)}列")
-                    print(f"  识别的表头: {headers}")
-                    return None
-
-            # 验证列标题是否匹配（可选，宽松匹配）
-            # 这里我们只检查列数，不检查标题内容，因为OCR可能有误差
-
-            # 验证所有行列数一致
-            valid = True
-            for idx, row in enumerate(rows, start=2):
-                if len(row) != expected_column_count:
-                    if attempt < max_retries - 1:
-                        print(f"  [RETRY] 第{idx}行列数不匹配，重试中...")
-                        valid = False
-                        break
-                    else:
-                        print(f"  [ERROR] 第{idx}行列数不匹配")
-                        return None
 
-            if not valid:
-                continue
+def _run_sync(coro):
+    """
+    在同步上下文中执行协程，并在结束时关闭该事件循环上的连接池
 
-            # 成功
-            return csv_text
+    注意：不能在运行中的事件循环内调用，异步代码请直接使用 async_* 方法。
+    """
+    async def _runner():
+        try:
+            return await coro
+        finally:
+            await http_client.close_async_client()
 
-        return None
+    return asyncio.run(_runner())
@@ -0,0 +1,180 @@
+"""
+页面感知哈希模块
+上传时为每张图片计算感知哈希（差值哈希），用于发现同一页面的重复拍摄/重复扫描：
+感知哈希只用来找出候选页面（同一印刷表格的不同填写件哈希几乎相同），逐像素比较确认后才视为重复。
+任务内的重复页面直接跳过，与历史任务重复的页面复用已有的识别结果
+"""
+
+import io
+import os
+from dataclasses import dataclass, asdict
+from typing import Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+try:
+    from PIL import Image, ImageChops, ImageFilter, ImageOps
+except ImportError:  # 未安装Pillow时不计算感知哈希
+    Image = None
+    ImageChops = None
+    ImageFilter = None
+    ImageOps = None
+
+
+# 哈希边长：缩放到 (HASH_SIZE+1) x HASH_SIZE 灰度图后比较相邻像素，共 HASH_SIZE*HASH_SIZE 位
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+# 深色像素阈值，用于裁到内容区域（消除取景、页边距不同带来的差异）
+INK_THRESHOLD = 128
+
+# 逐像素确认时，裁到内容区域后缩放到的尺寸
+COMPARE_SIZE = 1024
+# 缩小后墨迹覆盖率不低于该值（0-255）的像素计为墨迹
+MASK_COVERAGE = 32
+# 逐像素确认时容许的偏移（最大值滤波窗口边长，5即上下左右各2像素）
+COMPARE_TOLERANCE = 5
+# 同一表格的大量填写件感知哈希都相近，每个页面最多读取 MAX_CANDIDATES 个候选，
+# 按墨迹像素数排序后最多逐像素比较 MAX_CONFIRMATIONS 个，避免两两比较
+MAX_CANDIDATES = 64
+MAX_CONFIRMATIONS = 16
+
+T = TypeVar("T")
+
+
+@dataclass
+class DedupSettings:
+    """重复页面检测配置"""
+    enabled: bool = os.environ.get("PAGE_DEDUP", "0") == "1"
+    max_distance: int = int(os.environ.get("PAGE_DEDUP_MAX_DISTANCE", "8"))  # 汉明距离不超过该值的页面作为候选（共64位）
+    max_diff_pixels: int = int(os.environ.get("PAGE_DEDUP_MAX_DIFF_PIXELS", "8"))  # 候选页面墨迹对不上的像素数不超过该值才视为同一页面
+    cross_task: bool = os.environ.get("PAGE_DEDUP_CROSS_TASK", "0") == "1"  # 与历史任务的页面比对并复用识别结果
+    lookback_days: int = int(os.environ.get("PAGE_DEDUP_LOOKBACK_DAYS", "30"))  # 只比对最近若干天的历史结果，0表示不限
+    lookback_limit: int = int(os.environ.get("PAGE_DEDUP_LOOKBACK_LIMIT", "10000"))  # 最多比对的历史结果数（从新到旧）
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DedupSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            max_distance=int(data.get("max_distance", defaults.max_distance)),
+            max_diff_pixels=int(data.get("max_diff_pixels", defaults.max_diff_pixels)),
+            cross_task=bool(data.get("cross_task", defaults.cross_task)),
+            lookback_days=int(data.get("lookback_days", defaults.lookback_days)),
+            lookback_limit=int(data.get("lookback_limit", defaults.lookback_limit)),
+        )
+
+
+def perceptual_hash(content: bytes) -> Optional[str]:
+    """
+    计算图片的差值哈希（16位十六进制字符串）
+
+    先按EXIF校正方向并裁到内容区域，再缩放比较相邻像素，对缩放、亮度、JPEG压缩和取景偏移不敏感。
+    未安装Pillow或图片无法读取时返回None。
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as opened:
+            img = ImageOps.exif_transpose(opened).convert("L")
+    except Exception:
+        return None
+
+    bbox = img.point(lambda value: 255 if value < INK_THRESHOLD else 0).getbbox()
+    if bbox is not None:
+        img = img.crop(bbox)
+    pixels = img.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX).tobytes()
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return f"{value:0{HASH_BITS // 4}x}"
+
+
+def ink_mask(content: bytes) -> Optional["Image.Image"]:
+    """裁到内容区域并缩放到 COMPARE_SIZE 的墨迹掩码（1位图，墨迹为1），用于逐像素确认；无法读取时返回None"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as opened:
+            img = ImageOps.exif_transpose(opened).convert("L")
+    except Exception:
+        return None
+
+    mask = img.point(lambda value: 255 if value < INK_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is not None:
+        mask = mask.crop(bbox)
+    # 缩小后只要覆盖少量墨迹即算墨迹像素，细线和文字笔画不会在缩小时丢失
+    mask = mask.resize((COMPARE_SIZE, COMPARE_SIZE), Image.BOX)
+    return mask.point(lambda value: 255 if value >= MASK_COVERAGE else 0).convert("1")
+
+
+def pixel_difference(left: "Image.Image", right: "Image.Image") -> int:
+    """
+    两个墨迹掩码对不上的像素数
+
+    一侧的墨迹像素在另一侧附近（容许2像素偏移）没有墨迹即计为差异。
+    同一页面的重新编码或缩放接近0；同一表格的不同填写件即使只差一个数字也会有数十个差异像素。
+    """
+    left, right = left.convert("L"), right.convert("L")
+    missing_left = ImageChops.subtract(left, right.filter(ImageFilter.MaxFilter(COMPARE_TOLERANCE)))
+    missing_right = ImageChops.subtract(right, left.filter(ImageFilter.MaxFilter(COMPARE_TOLERANCE)))
+    return missing_left.histogram()[255] + missing_right.histogram()[255]
+
+
+def ink_pixels(mask: "Image.Image") -> int:
+    """墨迹掩码中的墨迹像素数，用于给候选页面排序"""
+    return mask.histogram()[255]
+
+
+def hash_distance(left: str, right: str) -> int:
+    """两个哈希的汉明距离"""
+    return bin(int(left, 16) ^ int(right, 16)).count("1")
+
+
+class HashIndex(Generic[T]):
+    """
+    感知哈希相似度索引（多索引哈希）
+
+    把哈希切成 max_distance+1 段，距离不超过 max_distance 的两个哈希至少有一段完全相同，
+    查询时只需比较与查询哈希有相同分段的候选项，不必与全部哈希逐一计算距离。
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max(0, min(max_distance, HASH_BITS - 1))
+        segments = self.max_distance + 1
+        bounds = [HASH_BITS * idx // segments for idx in range(segments + 1)]
+        self._segments = list(zip(bounds[:-1], bounds[1:]))
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in self._segments]
+        self._entries: List[Tuple[int, T]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _keys(self, value: int) -> Iterator[int]:
+        for start, end in self._segments:
+            yield (value >> (HASH_BITS - end)) & ((1 << (end - start)) - 1)
+
+    def add(self, phash: str, item: T):
+        value = int(phash, 16)
+        position = len(self._entries)
+        self._entries.append((value, item))
+        for table, key in zip(self._tables, self._keys(value)):
+            table.setdefault(key, []).append(position)
+
+    def candidates(self, phash: str) -> List[Tuple[T, int]]:
+        """返回所有相似项及其距离，按距离从近到远（距离相同时先加入的在前）排列"""
+        value = int(phash, 16)
+        found = {}
+        for table, key in zip(self._tables, self._keys(value)):
+            for position in table.get(key, ()):
+                if position not in found:
+                    distance = bin(self._entries[position][0] ^ value).count("1")
+                    if distance <= self.max_distance:
+                        found[position] = distance
+        return [(self._entries[position][1], distance)
+                for position, distance in sorted(found.items(), key=lambda item: (item[1], item[0]))]
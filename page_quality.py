@@ -0,0 +1,134 @@
+"""
+页面质量检查模块
+在调用大模型之前用本地指标（墨迹覆盖率、灰度方差、清晰度、分辨率）识别空白页与无法辨认的页面，
+这些页面可直接跳过，不再消耗多次API调用后才计为失败
+"""
+
+import os
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+try:
+    from PIL import Image, ImageFilter, ImageOps, ImageStat
+except ImportError:  # 未安装Pillow时不做质量检查
+    Image = None
+
+
+PAGE_OK = "ok"
+PAGE_BLANK = "blank"  # 空白页、分隔页
+PAGE_UNREADABLE = "unreadable"  # 严重模糊或分辨率过低
+
+# 计算清晰度时使用的缩略图长边（不同尺寸的图片在同一尺度上比较）
+SHARPNESS_SAMPLE_EDGE = 1024
+# 估算墨迹比例时缩小到的长边
+INK_SAMPLE_EDGE = 1024
+# 比页面背景（灰度中位数）暗出该值以上的像素视为墨迹
+INK_CONTRAST = 64
+
+# 拉普拉斯算子（偏移128使负值也能落在灰度范围内）
+_LAPLACIAN = (0, 1, 0, 1, -4, 1, 0, 1, 0)
+
+
+@dataclass
+class QualityGateSettings:
+    """页面质量检查配置"""
+    enabled: bool = os.environ.get("PAGE_QUALITY_GATE", "0") == "1"  # 阈值尚未在真实扫描件上校准，默认关闭
+    blank_max_ink: float = float(os.environ.get("PAGE_BLANK_MAX_INK", "0.002"))  # 墨迹比例低于该值视为空白页
+    blank_max_stddev: float = float(os.environ.get("PAGE_BLANK_MAX_STDDEV", "4"))  # 灰度标准差低于该值视为空白页（纯色页）
+    min_short_side: int = int(os.environ.get("PAGE_MIN_SHORT_SIDE", "200"))  # 短边像素低于该值视为无法辨认
+    min_sharpness: float = float(os.environ.get("PAGE_MIN_SHARPNESS", "10"))  # 拉普拉斯方差低于该值视为严重模糊
+    skip_unreadable: bool = os.environ.get("PAGE_SKIP_UNREADABLE", "1") == "1"  # False时只标记，仍调用大模型识别
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QualityGateSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            blank_max_ink=float(data.get("blank_max_ink", defaults.blank_max_ink)),
+            blank_max_stddev=float(data.get("blank_max_stddev", defaults.blank_max_stddev)),
+            min_short_side=int(data.get("min_short_side", defaults.min_short_side)),
+            min_sharpness=float(data.get("min_sharpness", defaults.min_sharpness)),
+            skip_unreadable=bool(data.get("skip_unreadable", defaults.skip_unreadable)),
+        )
+
+
+@dataclass
+class PageQuality:
+    """单个页面的检查结果"""
+    status: str  # ok / blank / unreadable
+    reason: str = ""
+    ink: Optional[float] = None
+    sharpness: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _sharpness(img: "Image.Image") -> float:
+    """拉普拉斯方差：边缘越清晰值越大，严重模糊的照片接近0"""
+    sample = img.convert("L")
+    sample.thumbnail((SHARPNESS_SAMPLE_EDGE, SHARPNESS_SAMPLE_EDGE))
+    edges = sample.filter(ImageFilter.Kernel((3, 3), _LAPLACIAN, scale=1, offset=128))
+    # 卷积不处理最外圈像素（保留原灰度），计算方差前去掉
+    edges = edges.crop((1, 1, edges.width - 1, edges.height - 1))
+    return ImageStat.Stat(edges).var[0]
+
+
+def _ink_ratio(img: "Image.Image") -> float:
+    """
+    深色像素（文字、线条）占比
+
+    逐级减半缩小，每级缩小前先做最小值滤波加粗笔画，细表格线和文字笔画不会被平均成浅灰；
+    阈值相对页面背景取值，纸张偏灰或整体偏暗时同样适用。
+    """
+    sample = img.convert("L")
+    while max(sample.size) > INK_SAMPLE_EDGE:
+        sample = sample.filter(ImageFilter.MinFilter(3))
+        scale = max(0.5, INK_SAMPLE_EDGE / max(sample.size))
+        sample = sample.resize((max(1, round(sample.width * scale)), max(1, round(sample.height * scale))), Image.BOX)
+    histogram = sample.histogram()
+    total = sum(histogram)
+    # 灰度中位数作为背景亮度
+    count = 0
+    background = 255
+    for level, n in enumerate(histogram):
+        count += n
+        if count * 2 >= total:
+            background = level
+            break
+    return sum(histogram[:max(0, background - INK_CONTRAST)]) / total
+
+
+def assess_page(image_path: str, settings: QualityGateSettings) -> PageQuality:
+    """
+    检查页面是否为空白页或无法辨认
+
+    未启用、未安装Pillow或图片无法读取时返回 ok，由后续识别流程处理。
+    """
+    if not settings.enabled or Image is None:
+        return PageQuality(PAGE_OK)
+
+    try:
+        with Image.open(image_path) as opened:
+            img = ImageOps.exif_transpose(opened)
+            width, height = img.size
+            if min(width, height) < settings.min_short_side:
+                return PageQuality(PAGE_UNREADABLE, f"分辨率过低（{width}x{height}）")
+
+            ink = _ink_ratio(img)
+            stddev = ImageStat.Stat(img.convert("L")).stddev[0]
+            # 墨迹比例和灰度方差都很低才判为空白页，单一指标误判时宁可交给大模型识别
+            if ink < settings.blank_max_ink and stddev < settings.blank_max_stddev:
+                return PageQuality(PAGE_BLANK, "空白页", ink=ink)
+
+            sharpness = _sharpness(img)
+            if sharpness < settings.min_sharpness:
+                return PageQuality(PAGE_UNREADABLE, f"图片严重模糊（清晰度{sharpness:.1f}）",
+                                   ink=ink, sharpness=sharpness)
+            return PageQuality(PAGE_OK, ink=ink, sharpness=sharpness)
+    except Exception as e:
+        print(f"  [WARN] 页面质量检查失败，按正常页面处理: {e}")
+        return PageQuality(PAGE_OK)
@@ -0,0 +1,63 @@
+"""
+画像自动选择模块
+按版面指纹把每张图片分配给最相近的识别画像，同一批图片中混有多种表格时可一次处理完成
+"""
+
+import os
+from dataclasses import dataclass, asdict
+from typing import Generic, List, Optional, Tuple, TypeVar
+
+from table_layout import fingerprint_similarity
+
+T = TypeVar("T")
+
+
+@dataclass
+class ProfileRoutingSettings:
+    """画像自动选择配置"""
+    enabled: bool = os.environ.get("PROFILE_AUTO_ROUTE", "0") == "1"
+    min_similarity: float = float(os.environ.get("PROFILE_ROUTE_MIN_SIMILARITY", "0.8"))  # 版面指纹相关系数下限
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ProfileRoutingSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            min_similarity=float(data.get("min_similarity", defaults.min_similarity)),
+        )
+
+
+class ProfileIndex(Generic[T]):
+    """画像版面指纹索引"""
+
+    def __init__(self, min_similarity: float):
+        self.min_similarity = min_similarity
+        self._entries: List[Tuple[T, List[float]]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, item: T, fingerprint: List[float]):
+        """加入一个画像；相似度相同时先加入的优先，调用方应按优先级（如最近使用）顺序加入"""
+        self._entries.append((item, fingerprint))
+
+    def route(self, fingerprint: List[float], preferred: Optional[T] = None) -> Optional[Tuple[T, float]]:
+        """
+        为图片选择画像
+
+        preferred（当前指定或启用的画像）达到相似度下限时直接使用，同一版式有多个画像版本时不会被其他版本替换；
+        否则返回相似度最高且达到下限的画像，都未达到时返回None（由调用方回退到默认画像）
+        """
+        best = None
+        for item, candidate in self._entries:
+            score = fingerprint_similarity(fingerprint, candidate)
+            if score < self.min_similarity:
+                continue
+            if preferred is not None and item == preferred:
+                return item, score
+            if best is None or score > best[1]:
+                best = (item, score)
+        return best
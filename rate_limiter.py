@@ -0,0 +1,129 @@
+"""
+限流模块
+按 提供商 + API密钥 共享的令牌桶限流器，同时限制每分钟请求数(RPM)和每分钟token数(TPM)
+"""
+
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket:
+    """令牌桶（预约式：允许余额为负，调用方按返回的等待时间排队）"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0  # 每秒补充的令牌数
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """预约令牌，返回需要等待的秒数"""
+        self._refill(now)
+        # 单次请求不能超过桶容量，否则永远无法满足
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def resize(self, per_minute: int, now: float):
+        """调整限额，保留已消耗的令牌（余额不超过新容量）"""
+        self._refill(now)
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = min(self.capacity, self.tokens)
+
+    def adjust(self, delta: float, now: float):
+        """修正令牌余额（正数退还，负数追加扣除）"""
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class RateLimiter:
+    """单个 提供商+密钥 的限流器，RPM/TPM 为 None 表示不限制"""
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self._lock = threading.Lock()
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+
+    def update_limits(self, rpm: Optional[int], tpm: Optional[int]):
+        """
+        以其他限额再次注册时取较严格的限额（只收紧、不放宽）
+
+        同一 提供商+密钥 的额度由级联各档、备用模型与并行的任务共享，任何一方的配置都不能撤销其他方的限流；
+        收紧时保留已消耗的令牌，不重置余额
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.rpm, self._requests = self._tighten(self.rpm, self._requests, rpm, now)
+            self.tpm, self._tokens = self._tighten(self.tpm, self._tokens, tpm, now)
+
+    @staticmethod
+    def _tighten(current: Optional[int], bucket: Optional[TokenBucket], limit: Optional[int],
+                 now: float) -> Tuple[Optional[int], Optional[TokenBucket]]:
+        if not limit or (current and current <= limit):
+            return current, bucket
+        if bucket is None:
+            return limit, TokenBucket(limit)
+        bucket.resize(limit, now)
+        return limit, bucket
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        now = time.monotonic()
+        wait = 0.0
+        with self._lock:
+            if self._requests:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens:
+                wait = max(wait, self._tokens.reserve(estimated_tokens, now))
+        return wait
+
+    async def acquire(self, estimated_tokens: int = 0):
+        """异步获取一次调用额度（按需等待）"""
+        wait = self._reserve(estimated_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """调用完成后按实际用量修正TPM预约"""
+        if not self._tokens or actual_tokens is None:
+            return
+        with self._lock:
+            self._tokens.adjust(estimated_tokens - actual_tokens, time.monotonic())
+
+
+# ==================== 全局限流器注册表 ====================
+
+_limiters: Dict[str, RateLimiter] = {}
+_registry_lock = threading.Lock()
+
+
+def _limiter_key(provider: str, api_key: str) -> str:
+    # 不在内存键中保存明文密钥
+    key_digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    return f"{provider}:{key_digest}"
+
+
+def get_rate_limiter(provider: str, api_key: str,
+                     rpm: Optional[int] = None, tpm: Optional[int] = None) -> RateLimiter:
+    """获取进程内共享的限流器（同一 提供商+密钥 的所有任务共用一个额度）"""
+    key = _limiter_key(provider, api_key)
+    with _registry_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(rpm, tpm)
+            _limiters[key] = limiter
+        else:
+            limiter.update_limits(rpm, tpm)
+        return limiter
@@ -0,0 +1,103 @@
+"""
+原始响应存储模块
+把每张图片识别时的原始模型输出（连同模型、提示词哈希、token用量）压缩保存，
+解析器或校验规则修改后可直接用保存的输出重新解析、校验整个任务，无需再次调用大模型
+"""
+
+import os
+import gzip
+import json
+from typing import List, Optional, Tuple
+
+from table_processor import CSVParser, CSVRepair, CompactTableParser, WIRE_COMPACT
+
+
+RESPONSE_STORE_ENABLED = os.environ.get("RESPONSE_STORE", "1") == "1"
+
+# 重新解析时可作为整页结果的响应用途（条带、修复、续写的响应只是页面的一部分）
+WHOLE_PAGE_SCOPES = {"page", "batch"}
+
+
+def pack_responses(headers: List[str], output: Optional[str], responses: List[dict]) -> bytes:
+    """
+    压缩保存一张图片的识别记录
+
+    Args:
+        headers: 期望的列标题
+        output: 识别流程最终返回的CSV（失败为None）
+        responses: 识别期间成功的原始API响应（见 OCRProcessor._process_images 的 responses 参数）
+    """
+    record = {"headers": headers, "output": output, "responses": responses}
+    return gzip.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+
+
+def unpack_responses(payload: bytes) -> dict:
+    return json.loads(gzip.decompress(payload).decode("utf-8"))
+
+
+def summarize_responses(responses: List[dict]) -> Tuple[Optional[str], Optional[str], int, int]:
+    """
+    汇总一张图片的响应
+
+    返回: (模型, 提示词哈希, 输入token数, 输出token数)；模型与提示词哈希取最后一个整页响应
+    """
+    whole = [response for response in responses if response.get("scope") in WHOLE_PAGE_SCOPES]
+    last = (whole or responses or [{}])[-1]
+    prompt_tokens = sum(response.get("usage", {}).get("prompt_tokens", 0) for response in responses)
+    completion_tokens = sum(response.get("usage", {}).get("completion_tokens", 0) for response in responses)
+    return last.get("model"), last.get("prompt_hash"), int(prompt_tokens), int(completion_tokens)
+
+
+def _revalidate(content: str, column_count: int) -> Tuple[Optional[str], Optional[str]]:
+    """按当前规则校验，列数不符时只做本地启发式修复（不发送修复请求）"""
+    csv_text, error = CSVParser.validate(content, column_count)
+    if csv_text is not None:
+        return csv_text, None
+
+    headers, rows, parse_error = CSVParser.parse(CSVParser.clean_markdown(content))
+    if parse_error or len(headers) != column_count:
+        return None, error
+    rows = CSVRepair.fix_rows(rows, column_count)
+    if any(len(row) != column_count for row in rows):
+        return None, error
+    return CSVParser.to_csv(headers, rows), None
+
+
+def reparse_record(record: dict) -> Tuple[Optional[List[str]], Optional[List[List[str]]], Optional[str]]:
+    """
+    用保存的输出重新解析、校验一张图片
+
+    从后往前用当前解析器重新解析保存的整页原始响应（紧凑格式的响应按列标题转换为标准CSV后再校验），
+    这样解析器的修正对每一页都生效；没有可解析的原始响应时才退回识别流程当时返回的CSV
+    （例如由条带拼接或修复请求产生、没有整页响应的结果）。
+
+    返回: (列标题, 数据行, 错误信息)
+    """
+    headers = record.get("headers") or []
+    column_count = len(headers)
+
+    candidates = []
+    for response in reversed(record.get("responses") or []):
+        if response.get("scope") not in WHOLE_PAGE_SCOPES or not response.get("content"):
+            continue
+        content = response["content"]
+        if response.get("wire_format") == WIRE_COMPACT:
+            content = CompactTableParser.to_csv(content, headers)
+        candidates.append(content)
+    if record.get("output"):
+        candidates.append(record["output"])
+
+    if not candidates:
+        return None, None, "没有可重新解析的输出"
+
+    error = None
+    for content in candidates:
+        csv_text, error = _revalidate(content, column_count)
+        if csv_text is None:
+            continue
+        parsed_headers, rows, parse_error = CSVParser.parse(csv_text)
+        if parse_error:
+            error = parse_error
+            continue
+        return parsed_headers, rows, None
+    return None, None, error
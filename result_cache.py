@@ -0,0 +1,164 @@
+"""
+识别结果缓存模块
+以 图片内容哈希 + 提示词 + 模型 为键持久化已校验的CSV结果，支持按条数、总大小和存活时间淘汰
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Optional
+
+
+# ==================== 缓存配置 ====================
+
+CACHE_ENABLED = os.environ.get("OCR_CACHE_ENABLED", "1") == "1"
+CACHE_PATH = os.environ.get("OCR_CACHE_PATH", str(Path("cache") / "ocr_results.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.environ.get("OCR_CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+CACHE_MAX_AGE_DAYS = float(os.environ.get("OCR_CACHE_MAX_AGE_DAYS", "30"))
+
+# 每写入多少次执行一次淘汰
+EVICT_EVERY = 100
+
+
+class OCRResultCache:
+    """基于SQLite的识别结果缓存（线程安全）"""
+
+    def __init__(self, db_path: str = CACHE_PATH, max_entries: int = CACHE_MAX_ENTRIES,
+                 max_bytes: int = CACHE_MAX_BYTES, max_age_days: float = CACHE_MAX_AGE_DAYS):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS ocr_results (
+                cache_key TEXT PRIMARY KEY,
+                csv_text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ocr_results_accessed ON ocr_results (accessed_at)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image_hash: str, user_prompt: str, system_prompt: str,
+                 provider: str, model: str, extra: str = "") -> str:
+        """
+        生成缓存键
+
+        Args:
+            image_hash: 图片内容的SHA-256
+            user_prompt: 首次尝试时渲染出的用户提示词（包含画像内容，画像变化即失效）
+            system_prompt: 系统提示词
+            provider: 提供商ID
+            model: 模型名称
+            extra: 其他影响结果的因素（如图片预处理配置指纹）
+        """
+        digest = hashlib.sha256()
+        for part in (image_hash, system_prompt, user_prompt, provider, model, extra):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, cache_key: str) -> Optional[str]:
+        """读取缓存，过期条目视为未命中并删除"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT csv_text, created_at FROM ocr_results WHERE cache_key = ?",
+                (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            csv_text, created_at = row
+            if self.max_age_seconds and now - created_at > self.max_age_seconds:
+                self._conn.execute("DELETE FROM ocr_results WHERE cache_key = ?", (cache_key,))
+                self._conn.commit()
+                return None
+
+            self._conn.execute(
+                "UPDATE ocr_results SET accessed_at = ? WHERE cache_key = ?",
+                (now, cache_key)
+            )
+            self._conn.commit()
+            return csv_text
+
+    def put(self, cache_key: str, csv_text: str):
+        """写入缓存"""
+        now = time.time()
+        size = len(csv_text.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_results (cache_key, csv_text, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (cache_key, csv_text, size, now, now)
+            )
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """按存活时间、条数、总大小淘汰（最近最少访问优先），调用方需持有锁"""
+        if self.max_age_seconds:
+            self._conn.execute(
+                "DELETE FROM ocr_results WHERE created_at < ?",
+                (now - self.max_age_seconds,)
+            )
+
+        count, total_bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_results"
+        ).fetchone()
+
+        if self.max_entries and count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM ocr_results WHERE cache_key IN "
+                "(SELECT cache_key FROM ocr_results ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            total_bytes = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM ocr_results"
+            ).fetchone()[0]
+
+        if self.max_bytes and total_bytes > self.max_bytes:
+            excess = total_bytes - self.max_bytes
+            victims = []
+            for cache_key, size in self._conn.execute(
+                "SELECT cache_key, size FROM ocr_results ORDER BY accessed_at ASC"
+            ):
+                victims.append((cache_key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self._conn.executemany("DELETE FROM ocr_results WHERE cache_key = ?", victims)
+
+        self._conn.commit()
+
+
+# ==================== 全局缓存实例 ====================
+
+_result_cache: Optional[OCRResultCache] = None
+
+
+def get_result_cache() -> Optional[OCRResultCache]:
+    """获取全局结果缓存实例（单例模式），禁用时返回None"""
+    global _result_cache
+    if not CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        _result_cache = OCRResultCache()
+    return _result_cache
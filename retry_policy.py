@@ -0,0 +1,95 @@
+"""
+重试策略模块
+区分传输错误（限流、5xx、超时）与内容错误（CSV结构不符），提供指数退避+抖动、Retry-After支持和任务级重试预算
+"""
+
+import os
+import random
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+# ==================== 错误类型 ====================
+
+# 传输错误：限流、服务端错误、超时、连接失败，等待后重试通常可以成功
+ERROR_TRANSPORT = "transport"
+# 内容错误：模型返回了结果但不符合要求（列数不符、无法解析），可立即修改提示词重试
+ERROR_CONTENT = "content"
+# 致命错误：鉴权失败、请求参数错误等，重试无意义
+ERROR_FATAL = "fatal"
+
+# 可重试的HTTP状态码
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429}
+
+
+def classify_status(status_code: int) -> str:
+    """根据HTTP状态码判断错误类型"""
+    if status_code in RETRYABLE_STATUS_CODES or status_code >= 500:
+        return ERROR_TRANSPORT
+    return ERROR_FATAL
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数或HTTP日期），返回等待秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    """重试策略配置"""
+    base_delay: float = float(os.environ.get("RETRY_BASE_DELAY", "1.0"))  # 首次退避时间（秒）
+    max_delay: float = float(os.environ.get("RETRY_MAX_DELAY", "30"))  # 单次退避上限（秒）
+    multiplier: float = 2.0  # 退避倍数
+    max_retry_after: float = 120.0  # 服务端 Retry-After 的采纳上限（秒）
+    max_transport_retries: int = int(os.environ.get("RETRY_MAX_TRANSPORT", "4"))  # 每次调用的传输错误重试次数
+    content_retry_delay: float = 0.0  # 内容错误重试前的等待（秒）
+    task_retry_budget: Optional[int] = (
+        int(os.environ["RETRY_TASK_BUDGET"]) if os.environ.get("RETRY_TASK_BUDGET") else None
+    )  # 整个任务允许的重试总次数，None表示不限制
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def transport_delay(self, retry_index: int, retry_after: Optional[float] = None) -> float:
+        """
+        计算传输错误的退避时间：指数退避 + 全抖动；服务端给出 Retry-After 时以其为下限
+
+        Args:
+            retry_index: 第几次重试（从0开始）
+            retry_after: 服务端要求的等待秒数
+        """
+        ceiling = min(self.max_delay, self.base_delay * (self.multiplier ** retry_index))
+        delay = random.uniform(ceiling / 2, ceiling)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after) + random.uniform(0, self.base_delay))
+        return delay
+
+
+class RetryBudget:
+    """任务级重试预算：同一任务内所有图片共享，避免服务异常时重试无限放大"""
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.used = 0
+
+    def try_consume(self) -> bool:
+        """消耗一次重试额度，额度用尽时返回False"""
+        if self.limit is not None and self.used >= self.limit:
+            return False
+        self.used += 1
+        return True
@@ -0,0 +1,303 @@
+"""
+表格版面分析模块
+在本地用网格线/空白投影分析定位表格区域和列分隔位置：上传前裁掉页边距和标题，并把检测到的列数与列边界写入提示词
+"""
+
+import io
+import os
+import json
+import hashlib
+from dataclasses import dataclass, asdict, field
+from typing import List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装Pillow时不做版面分析
+    Image = None
+    ImageOps = None
+
+
+# 版面分析使用的缩略图长边（只用于检测，裁剪在原图上进行）
+ANALYSIS_LONG_EDGE = 1600
+
+# 版面指纹的分段数：内容区域按宽度等分后每段的墨迹比例
+FINGERPRINT_BINS = 32
+
+
+@dataclass
+class LayoutSettings:
+    """版面分析配置"""
+    enabled: bool = os.environ.get("TABLE_LAYOUT", "0") == "1"
+    line_coverage: float = 0.6  # 深色像素占整行/整列的比例达到该值视为网格线
+    gap_ink: float = float(os.environ.get("TABLE_LAYOUT_GAP_INK", "0.01"))  # 墨迹比例不高于该值的列视为空白
+    min_column_gap: float = float(os.environ.get("TABLE_LAYOUT_MIN_GAP", "0.008"))  # 列间空白的最小宽度（占表格宽度）
+    block_gap: float = float(os.environ.get("TABLE_LAYOUT_BLOCK_GAP", "0.03"))  # 分隔标题与表格的最小空白高度（占内容高度）
+    padding: float = 0.01  # 裁剪时在表格区域四周保留的边距（占原图尺寸）
+    min_crop_saving: float = 0.05  # 裁剪掉的面积比例低于该值且没有列边界时不做处理
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LayoutSettings":
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get("enabled", defaults.enabled)),
+            line_coverage=float(data.get("line_coverage", defaults.line_coverage)),
+            gap_ink=float(data.get("gap_ink", defaults.gap_ink)),
+            min_column_gap=float(data.get("min_column_gap", defaults.min_column_gap)),
+            block_gap=float(data.get("block_gap", defaults.block_gap)),
+            padding=float(data.get("padding", defaults.padding)),
+            min_crop_saving=float(data.get("min_crop_saving", defaults.min_crop_saving)),
+        )
+
+    def fingerprint(self) -> str:
+        """配置指纹（用于缓存键），未启用时为空字符串"""
+        if not self.enabled or Image is None:
+            return ""
+        raw = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class TableLayout:
+    """版面分析结果"""
+    box: Optional[Tuple[int, int, int, int]]  # 裁剪区域在原图（EXIF校正后）中的 (left, top, right, bottom)，None表示不裁剪
+    column_bounds: List[float] = field(default_factory=list)  # 列分隔位置（占裁剪后宽度的比例，不含左右边缘）
+    source: str = ""  # lines: 网格线；whitespace: 空白投影
+
+    @property
+    def column_count(self) -> int:
+        return len(self.column_bounds) + 1 if self.column_bounds else 0
+
+
+# ==================== 投影分析 ====================
+
+def _binarize(img: "Image.Image") -> "Image.Image":
+    return img.convert("L").point(lambda value: 0 if value < 128 else 255)
+
+
+def _ink_profile(binary: "Image.Image", axis: str) -> List[float]:
+    """每行（axis="rows"）或每列（axis="cols"）的墨迹比例，BOX 重采样即求平均"""
+    if axis == "rows":
+        squeezed = binary.resize((1, binary.height), Image.BOX)
+    else:
+        squeezed = binary.resize((binary.width, 1), Image.BOX)
+    return [1 - value / 255 for value in squeezed.getdata()]
+
+
+def _runs(flags: List[bool]) -> List[Tuple[int, int]]:
+    """连续为True的区间列表 [(start, end)]（end不含）"""
+    runs = []
+    start = None
+    for pos, flag in enumerate(flags):
+        if flag and start is None:
+            start = pos
+        elif not flag and start is not None:
+            runs.append((start, pos))
+            start = None
+    if start is not None:
+        runs.append((start, len(flags)))
+    return runs
+
+
+def _line_positions(profile: List[float], coverage: float) -> List[int]:
+    """墨迹比例达到 coverage 的连续行/列合并为一条线，返回各条线的中心坐标"""
+    return [(start + end - 1) // 2 for start, end in _runs([value >= coverage for value in profile])]
+
+
+def detect_grid(img: "Image.Image", line_coverage: float = 0.6) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    检测表格的水平/垂直网格线
+
+    先在内容区域内找水平线，再只在首末水平线之间找垂直线，表格只占页面一部分（上方有标题等）时也能检测。
+
+    返回: (水平线y坐标, 垂直线x坐标)，坐标相对于传入图片；两个方向都至少有两条线时才返回，否则返回None
+    """
+    binary = _binarize(img)
+    bbox = ImageOps.invert(binary).getbbox()
+    if bbox is None:
+        return None
+    left, top, _, _ = bbox
+
+    content = binary.crop(bbox)
+    rows = _line_positions(_ink_profile(content, "rows"), line_coverage)
+    if len(rows) < 2:
+        return None
+
+    table = content.crop((0, rows[0], content.width, rows[-1] + 1))
+    cols = _line_positions(_ink_profile(table, "cols"), line_coverage)
+    if len(cols) < 2:
+        return None
+    return [top + y for y in rows], [left + x for x in cols]
+
+
+def _main_block(binary: "Image.Image", settings: LayoutSettings) -> Tuple[int, int]:
+    """
+    按较大的水平空白把内容切成若干块（标题、表格、页脚等），返回最高的一块的 (top, bottom)
+
+    表格行之间的空白通常远小于标题与表格之间的空白，小于 block_gap 的空白不切分。
+    """
+    profile = _ink_profile(binary, "rows")
+    min_gap = max(1, int(binary.height * settings.block_gap))
+    gaps = [(start, end) for start, end in _runs([value <= 0.002 for value in profile]) if end - start >= min_gap]
+
+    blocks = []
+    position = 0
+    for start, end in gaps:
+        if start > position:
+            blocks.append((position, start))
+        position = end
+    if position < binary.height:
+        blocks.append((position, binary.height))
+    if not blocks:
+        return 0, binary.height
+    return max(blocks, key=lambda block: block[1] - block[0])
+
+
+def _whitespace_columns(binary: "Image.Image", settings: LayoutSettings,
+                        expected_columns: Optional[int]) -> List[int]:
+    """
+    按列方向的空白投影找列分隔位置（无网格线的手写表格）
+
+    给出期望列数时只取最宽的 expected_columns-1 条空白；空白数量不足时返回空列表。
+    """
+    profile = _ink_profile(binary, "cols")
+    min_width = max(2, int(binary.width * settings.min_column_gap))
+    gaps = [
+        (start, end) for start, end in _runs([value <= settings.gap_ink for value in profile])
+        if end - start >= min_width and start > 0 and end < binary.width  # 不含左右边缘的空白
+    ]
+    if expected_columns:
+        if len(gaps) < expected_columns - 1:
+            return []
+        gaps = sorted(gaps, key=lambda gap: gap[1] - gap[0], reverse=True)[:expected_columns - 1]
+    return sorted((start + end) // 2 for start, end in gaps)
+
+
+def detect_layout(img: "Image.Image", settings: LayoutSettings,
+                  expected_columns: Optional[int] = None) -> Optional[TableLayout]:
+    """
+    定位表格区域与列分隔位置
+
+    1. 有网格线且列数与期望一致时，以网格外框为表格区域、内部垂直线为列边界
+    2. 否则取内容中最高的一块（去掉标题、页脚），按列方向空白投影找列边界
+    3. 都找不到与期望一致的列边界时只裁掉页边距
+
+    Args:
+        img: EXIF校正后的图片
+        expected_columns: 期望列数（可选），用于挑选列边界
+
+    返回: TableLayout；页面空白或裁剪收益太小且没有列边界时返回None
+    """
+    scale = min(1.0, ANALYSIS_LONG_EDGE / max(img.size))
+    sample = img.convert("L")
+    if scale < 1.0:
+        sample = sample.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.BOX)
+    binary = _binarize(sample)
+    bbox = ImageOps.invert(binary).getbbox()
+    if bbox is None:
+        return None
+
+    region, bounds, source = bbox, [], ""
+    grid = detect_grid(sample, settings.line_coverage)
+    if grid is not None and (not expected_columns or len(grid[1]) - 1 == expected_columns):
+        rows, cols = grid
+        region = (cols[0], rows[0], cols[-1] + 1, rows[-1] + 1)
+        bounds = [x - cols[0] for x in cols[1:-1]]
+        source = "lines"
+    else:
+        content = binary.crop(bbox)
+        top, bottom = _main_block(content, settings)
+        block_box = (bbox[0], bbox[1] + top, bbox[2], bbox[1] + bottom)
+        block = binary.crop(block_box)
+        block_bbox = ImageOps.invert(block).getbbox()
+        if block_bbox is not None:
+            block_box = (block_box[0] + block_bbox[0], block_box[1] + block_bbox[1],
+                         block_box[0] + block_bbox[2], block_box[1] + block_bbox[3])
+            block = binary.crop(block_box)
+        bounds = _whitespace_columns(block, settings, expected_columns)
+        if bounds:
+            region, source = block_box, "whitespace"
+        else:
+            # 无法确认列边界时不按内容块裁剪，避免误裁掉表格的一部分
+            bounds = _whitespace_columns(content, settings, expected_columns)
+            source = "whitespace" if bounds else ""
+
+    # 按检测比例换算回原图坐标，并在四周保留少量边距
+    pad_x, pad_y = int(img.width * settings.padding), int(img.height * settings.padding)
+    box = (
+        max(0, int(region[0] / scale) - pad_x),
+        max(0, int(region[1] / scale) - pad_y),
+        min(img.width, int(region[2] / scale) + pad_x),
+        min(img.height, int(region[3] / scale) + pad_y),
+    )
+    saving = 1 - (box[2] - box[0]) * (box[3] - box[1]) / (img.width * img.height)
+    if saving < settings.min_crop_saving:
+        if not bounds:
+            return None
+        box = None
+
+    # 列边界换算为（裁剪后）图片宽度的比例
+    left, right = (box[0], box[2]) if box else (0, img.width)
+    column_bounds = [round(((region[0] + x) / scale - left) / (right - left), 3) for x in bounds]
+    return TableLayout(box=box, column_bounds=column_bounds, source=source)
+
+
+def analyze_layout(content: bytes, settings: LayoutSettings, expected_columns: Optional[int] = None,
+                   fix_orientation: bool = True) -> Optional[TableLayout]:
+    """
+    读取原图字节并做版面分析，未启用、未安装Pillow或分析失败时返回None
+
+    fix_orientation 应与图片预处理配置一致，保证裁剪坐标与编码时的图片方向相同
+    """
+    if not settings.enabled or Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as opened:
+            img = ImageOps.exif_transpose(opened) if fix_orientation else opened
+            return detect_layout(img, settings, expected_columns)
+    except Exception as e:
+        print(f"  [WARN] 版面分析失败: {e}")
+        return None
+
+
+# ==================== 版面指纹 ====================
+
+def layout_fingerprint(content: bytes, fix_orientation: bool = True) -> Optional[List[float]]:
+    """
+    计算版面指纹：内容区域在列方向上的墨迹分布（FINGERPRINT_BINS 段）
+
+    同一种表格的竖线与各列的文字位置基本固定，列方向分布相近；行数、填写内容不同时影响较小。
+    未安装Pillow、图片无法读取或页面空白时返回None。
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as opened:
+            img = ImageOps.exif_transpose(opened) if fix_orientation else opened
+            sample = img.convert("L")
+    except Exception:
+        return None
+
+    sample.thumbnail((ANALYSIS_LONG_EDGE, ANALYSIS_LONG_EDGE))
+    binary = _binarize(sample)
+    bbox = ImageOps.invert(binary).getbbox()
+    if bbox is None:
+        return None
+    squeezed = binary.crop(bbox).resize((FINGERPRINT_BINS, 1), Image.BOX)
+    return [round(1 - value / 255, 4) for value in squeezed.tobytes()]
+
+
+def fingerprint_similarity(left: List[float], right: List[float]) -> float:
+    """两个版面指纹的相关系数（-1 到 1），长度不同或分布无变化时返回0"""
+    if len(left) != len(right) or not left:
+        return 0.0
+    left_mean = sum(left) / len(left)
+    right_mean = sum(right) / len(right)
+    left_dev = [value - left_mean for value in left]
+    right_dev = [value - right_mean for value in right]
+    norm = (sum(value * value for value in left_dev) * sum(value * value for value in right_dev)) ** 0.5
+    if not norm:
+        return 0.0
+    return sum(a * b for a, b in zip(left_dev, right_dev)) / norm
@@ -5,11 +5,21 @@
 
 import re
 import csv
+import math
+import unicodedata
 from io import StringIO
-from typing import List, Tuple, Optional
+from typing import List, Optional, Set, Tuple
 from dataclasses import dataclass, field
 
 
+# 识别输出的传输格式
+# csv: 第一行为列标题的标准CSV（含引号转义）
+# compact: 不输出列标题（由画像确定），制表符分隔、不加引号，每行一条记录
+WIRE_CSV = "csv"
+WIRE_COMPACT = "compact"
+WIRE_FORMATS = (WIRE_CSV, WIRE_COMPACT)
+
+
 @dataclass
 class TableData:
     """表格数据结构"""
@@ -75,6 +85,316 @@ class CSVParser:
 
         return headers, data_rows, None
 
+    @staticmethod
+    def parse_rows(csv_text: str) -> Tuple[List[List[str]], Optional[str]]:
+        """
+        解析不含表头的CSV文本（过滤空行）
+
+        返回: (rows, error_message)
+        """
+        try:
+            rows = list(csv.reader(StringIO(csv_text.strip())))
+        except Exception as e:
+            return [], f"CSV解析异常: {str(e)}"
+        return [row for row in rows if any(cell.strip() for cell in row)], None
+
+    @staticmethod
+    def drop_partial_line(csv_text: str) -> str:
+        """去掉被截断输出末尾不完整的一行（保留最后一个换行符之前的内容）"""
+        cut = csv_text.rfind("\n")
+        return csv_text[:cut] if cut >= 0 else ""
+
+    @staticmethod
+    def format_row(row: List[str]) -> str:
+        """将单行序列化为CSV文本"""
+        buffer = StringIO()
+        csv.writer(buffer, lineterminator="").writerow(row)
+        return buffer.getvalue()
+
+    @staticmethod
+    def to_csv(headers: List[str], rows: List[List[str]]) -> str:
+        """将表头和数据行重新序列化为CSV文本"""
+        buffer = StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(headers)
+        writer.writerows(rows)
+        return buffer.getvalue().strip()
+
+    @staticmethod
+    def validate(content: str, column_count: int) -> Tuple[Optional[str], Optional[str]]:
+        """
+        清理并校验模型返回的CSV：可解析，且表头与每一行都等于期望列数
+
+        返回: (csv_text, error_message)
+        """
+        csv_text = CSVParser.clean_markdown(content)
+        headers, rows, parse_error = CSVParser.parse(csv_text)
+
+        if parse_error:
+            return None, f"CSV解析失败: {parse_error}"
+
+        if len(headers) != column_count:
+            return None, f"列数不匹配，期望{column_count}列，实际{len(headers)}列"
+
+        for idx, row in enumerate(rows, start=2):
+            if len(row) != column_count:
+                return None, f"第{idx}行列数不匹配"
+
+        return csv_text, None
+
+
+class CompactTableParser:
+    """紧凑格式解析器：按行、按制表符切分，不处理引号，比 csv 模块更快"""
+
+    DELIMITER = "\t"
+
+    @classmethod
+    def parse_rows(cls, text: str) -> List[List[str]]:
+        """解析不含表头的紧凑格式文本（过滤空行）"""
+        rows = []
+        for line in text.split("\n"):
+            line = line.rstrip("\r")
+            if line.strip():
+                rows.append(line.split(cls.DELIMITER))
+        return rows
+
+    @classmethod
+    def parse(cls, text: str, headers: List[str]) -> Tuple[List[str], List[List[str]], Optional[str]]:
+        """
+        解析紧凑格式文本，列标题取自 headers；模型仍输出了列标题行时自动去掉
+
+        返回: (headers, rows, error_message)，与 CSVParser.parse 一致
+        """
+        text = CSVParser.clean_markdown(text)
+        rows = cls.parse_rows(text)
+        normalized_headers = [cell.strip() for cell in headers]
+        if rows and [cell.strip() for cell in rows[0]] == normalized_headers:
+            rows = rows[1:]
+        return list(headers), rows, None
+
+    @classmethod
+    def to_csv(cls, text: str, headers: List[str]) -> str:
+        """把紧凑格式文本转换为带表头的标准CSV"""
+        headers, rows, _ = cls.parse(text, headers)
+        return CSVParser.to_csv(headers, rows)
+
+    @classmethod
+    def format_row(cls, row: List[str]) -> str:
+        """将单行序列化为紧凑格式（单元格内的制表符、换行替换为空格）"""
+        return cls.DELIMITER.join(re.sub(r"[\t\r\n]", " ", cell) for cell in row)
+
+
+class CSVRepair:
+    """本地CSV修复：处理模型输出中常见、可确定修正的列数错误"""
+
+    # 被拆开的千分位数字：左侧 1-3 位数字（可带负号），右侧恰好3位整数（可带小数）
+    _THOUSANDS_LEFT = re.compile(r"^-?\d{1,3}$")
+    _THOUSANDS_RIGHT = re.compile(r"^\d{3}(\.\d+)?$")
+    # 带千分位的数字（如 1,234 / -12,345.60）
+    _THOUSANDS_NUMBER = re.compile(r"^-?\d{1,3}(,\d{3})+(\.\d+)?$")
+    # 普通数字
+    _PLAIN_NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+
+    @classmethod
+    def thousands_columns(cls, rows: List[List[str]], expected_columns: int) -> Set[int]:
+        """
+        从列数正确的行推断哪些列是带千分位的数字列
+
+        该列所有非空值都是数字，且至少有一个值带千分位或整数部分超过3位时才算。
+        """
+        columns = set()
+        good_rows = [row for row in rows if len(row) == expected_columns]
+        for col in range(expected_columns):
+            values = [row[col].strip() for row in good_rows if row[col].strip()]
+            if not values:
+                continue
+            if not all(cls._THOUSANDS_NUMBER.match(value) or cls._PLAIN_NUMBER.match(value) for value in values):
+                continue
+            if any(cls._THOUSANDS_NUMBER.match(value) or len(value.lstrip("-").split(".")[0]) > 3
+                   for value in values):
+                columns.add(col)
+        return columns
+
+    @classmethod
+    def fix_rows(cls, rows: List[List[str]], expected_columns: int) -> List[List[str]]:
+        """修复表格中各行的列数，无法确定修正方式的行原样返回（交给纯文本修复请求）"""
+        columns = cls.thousands_columns(rows, expected_columns)
+        return [cls.fix_row(row, expected_columns, columns) or row for row in rows]
+
+    @classmethod
+    def fix_row(cls, row: List[str], expected_columns: int,
+                thousands_columns: Optional[Set[int]] = None) -> Optional[List[str]]:
+        """
+        尝试修复单行的列数，无法确定修正方式时返回None
+
+        规则：
+        1. 多出的列全部是行尾空单元格时，直接去掉
+        2. 未加引号的千分位数字（如 1,234）被拆成两列时，合并回去；
+           只合并到 thousands_columns 中的列（见 thousands_columns），避免把相邻的独立数字列误合并
+        """
+        if len(row) == expected_columns:
+            return row
+
+        if len(row) > expected_columns:
+            extra = row[expected_columns:]
+            if not any(cell.strip() for cell in extra):
+                return row[:expected_columns]
+            if not thousands_columns:
+                return None
+
+            # 只有候选位置数恰好等于多出的列数时才合并；候选位置按合并后所在的列判断
+            candidates = []
+            idx = 0
+            while idx < len(row) - 1:
+                left, right = row[idx].strip(), row[idx + 1].strip()
+                column = idx - len(candidates)
+                if (column in thousands_columns and cls._THOUSANDS_LEFT.match(left)
+                        and cls._THOUSANDS_RIGHT.match(right)):
+                    candidates.append(idx)
+                    idx += 2
+                    continue
+                idx += 1
+
+            if len(candidates) == len(row) - expected_columns:
+                merged = []
+                idx = 0
+                while idx < len(row):
+                    if idx in candidates:
+                        merged.append(f"{row[idx]},{row[idx + 1]}")
+                        idx += 2
+                    else:
+                        merged.append(row[idx])
+                        idx += 1
+                return merged
+
+        return None
+
+
+class StreamingCSVValidator:
+    """流式CSV校验器：逐块接收模型输出，每凑齐一条完整记录就检查列数"""
+
+    def __init__(self, expected_columns: int, wire_format: str = WIRE_CSV, has_header: bool = True):
+        self.expected_columns = expected_columns
+        self.wire_format = wire_format
+        self.has_header = has_header  # 续写的输出只有数据行
+        self._buffer = ""
+        self._pos = 0  # 已扫描到的位置
+        self._in_quotes = False
+        self._line_no = 0  # 已校验的非空记录数（有表头时第1条为表头）
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """
+        追加一段输出
+
+        返回: 发现的错误信息，未发现问题时返回None
+        """
+        self._buffer += chunk
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+            if char == '"' and self.wire_format == WIRE_CSV:
+                self._in_quotes = not self._in_quotes
+            elif char == "\n" and not self._in_quotes:
+                record = self._buffer[:self._pos]
+                self._buffer = self._buffer[self._pos + 1:]
+                self._pos = 0
+                error = self._check_record(record)
+                if error:
+                    return error
+                continue
+            self._pos += 1
+        return None
+
+    def _check_record(self, record: str) -> Optional[str]:
+        """校验一条完整记录，跳过空行和Markdown代码块标记"""
+        record = record.strip("\r")
+        if not record.strip() or record.strip().startswith("```"):
+            return None
+
+        if self.wire_format == WIRE_COMPACT:
+            cells = record.split(CompactTableParser.DELIMITER)
+        else:
+            try:
+                cells = next(csv.reader([record]))
+            except Exception as e:
+                return f"CSV解析异常: {str(e)}"
+
+        # 与 CSVParser.parse 一致：全空的数据行会被过滤，不参与列数校验
+        is_header = self.has_header and self.wire_format == WIRE_CSV and self._line_no == 0
+        if not is_header and not any(cell.strip() for cell in cells):
+            return None
+
+        self._line_no += 1
+        if len(cells) != self.expected_columns:
+            if is_header:
+                return f"表头列数不匹配，期望{self.expected_columns}列，实际{len(cells)}列"
+            if not self.has_header:
+                return f"续写第{self._line_no}行列数({len(cells)})与期望({self.expected_columns})不一致"
+            return f"第{self._line_no}行列数({len(cells)})与期望({self.expected_columns})不一致"
+        return None
+
+
+class TableStitcher:
+    """拼接分条识别的结果：按顺序合并各条带的数据行，去除重叠区域重复识别的行"""
+
+    # 重叠区域内至少连续这么多行完全相同才视为重复识别（重叠区域只容得下一行时为一行）
+    MIN_RUN = 2
+
+    @staticmethod
+    def _normalize(row: List[str]) -> List[str]:
+        return [re.sub(r"\s+", "", unicodedata.normalize("NFKC", cell)) for cell in row]
+
+    @staticmethod
+    def overlap_windows(parts: List[List[List[str]]], spans: List[Tuple[float, float]]) -> List[int]:
+        """
+        按条带的上下边界估算每对相邻条带重叠区域内最多有几行
+
+        重叠高度占条带高度的比例乘以该条带的行数，再多留一行给跨越重叠边缘的行；
+        取相邻两个条带估算值中较大的一个。
+        """
+        windows = []
+        for (rows, (top, bottom)), (next_rows, (next_top, next_bottom)) in zip(
+            zip(parts, spans), zip(parts[1:], spans[1:])
+        ):
+            shared = max(0.0, bottom - next_top)
+            if shared <= 0:
+                windows.append(0)
+                continue
+            windows.append(max(
+                math.ceil(len(rows) * shared / (bottom - top)),
+                math.ceil(len(next_rows) * shared / (next_bottom - next_top))
+            ) + 1)
+        return windows
+
+    @classmethod
+    def _overlap_length(cls, previous: List[List[str]], current: List[List[str]], window: int) -> int:
+        """在重叠区域内找出 previous 末尾与 current 开头完全相同的最长连续行数，不足 MIN_RUN 行时返回0"""
+        limit = min(len(previous), len(current), window)
+        min_run = min(cls.MIN_RUN, window)
+        for size in range(limit, min_run - 1, -1):
+            tail = previous[-size:]
+            if all(cls._normalize(a) == cls._normalize(b) for a, b in zip(tail, current[:size])):
+                return size
+        return 0
+
+    @classmethod
+    def stitch(cls, parts: List[List[List[str]]], windows: List[int]) -> Tuple[List[List[str]], int]:
+        """
+        按顺序拼接各条带的数据行
+
+        Args:
+            parts: 各条带的数据行（不含表头），按从上到下排列
+            windows: 每对相邻条带重叠区域内最多的行数（见 overlap_windows），只在该范围内去重
+
+        返回: (合并后的数据行, 去除的重复行数)
+        """
+        merged: List[List[str]] = []
+        removed = 0
+        for idx, rows in enumerate(parts):
+            overlap = cls._overlap_length(merged, rows, windows[idx - 1]) if idx and merged else 0
+            merged.extend(rows[overlap:])
+            removed += overlap
+        return merged, removed
+
 
 class TableStructureAnalyzer:
     """表格结构分析器"""